@@ -5,6 +5,9 @@ from tardis.microtardis.models import Dataset_Hidden
 from tardis.microtardis.models import Datafile_Hidden
 from tardis.microtardis.models import Dataset_Harvest
 from tardis.microtardis.models import Datafile_Harvest
+from tardis.microtardis.models import Filter_Job
+from tardis.microtardis.models import Datafile_Fingerprint
+from tardis.microtardis.models import Datafile_Raw_Metadata
 
 class Experiment_Hidden_Admin(admin.ModelAdmin):
     list_display = ('experiment', 'hidden',)
@@ -39,4 +42,24 @@ class Datafile_Harvest_Admin(admin.ModelAdmin):
     ordering = ('id',)
     list_filter = ('instrument',)
 
-admin.site.register(Datafile_Harvest, Datafile_Harvest_Admin)
\ No newline at end of file
+admin.site.register(Datafile_Harvest, Datafile_Harvest_Admin)
+
+class Filter_Job_Admin(admin.ModelAdmin):
+    list_display = ('datafile', 'status', 'attempts', 'created_time', 'updated_time',)
+    ordering = ('id',)
+    list_filter = ('status',)
+
+admin.site.register(Filter_Job, Filter_Job_Admin)
+
+class Datafile_Fingerprint_Admin(admin.ModelAdmin):
+    list_display = ('datafile', 'size', 'hash', 'updated_time',)
+    ordering = ('id',)
+
+admin.site.register(Datafile_Fingerprint, Datafile_Fingerprint_Admin)
+
+class Datafile_Raw_Metadata_Admin(admin.ModelAdmin):
+    list_display = ('datafile', 'kind', 'instrument', 'updated_time',)
+    ordering = ('id',)
+    list_filter = ('kind', 'instrument',)
+
+admin.site.register(Datafile_Raw_Metadata, Datafile_Raw_Metadata_Admin)
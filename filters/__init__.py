@@ -48,47 +48,97 @@ from django.core.exceptions import MiddlewareNotUsed
 logger = logging.getLogger(__name__)
 
 
+def load_filters():
+    """Return the ``(path, filter)`` pairs configured in
+    ``settings.POST_SAVE_FILTERS``.
+    """
+    filters = []
+    for f in settings.POST_SAVE_FILTERS:
+        cls = f[0]
+        args = []
+        kw = {}
+
+        if len(f) == 2:
+            args = f[1]
+
+        if len(f) == 3:
+            kw = f[2]
+
+        hook = _safe_import(cls, args, kw)
+        if hook:
+            filters.append((cls, hook))
+    return filters
+
+
+def get_post_save_hooks():
+    """Return the ``(dispatch_uid, hook)`` pairs to connect to ``post_save``.
+
+    Filters which declare the file types they handle share a single
+    :class:`~tardis.microtardis.filters.dispatcher.FilterDispatcher`, any
+    other filter is wrapped in an
+    :class:`~tardis.microtardis.filters.instrumentation.InstrumentedFilter`.
+    """
+    from tardis.microtardis.filters.dispatcher import FilterDispatcher
+    from tardis.microtardis.filters.instrumentation import InstrumentedFilter
+    dispatched = []
+    hooks = []
+    for path, hook in load_filters():
+        if hasattr(hook, 'extensions') and hasattr(hook, 'process'):
+            dispatched.append((path, hook))
+        else:
+            hooks.append((path, InstrumentedFilter(path, hook)))
+    if dispatched:
+        hooks.insert(0, ('tardis.microtardis.filters.dispatcher',
+                         FilterDispatcher(dispatched)))
+    return hooks
+
+
+def _safe_import(path, args, kw):
+    try:
+        dot = path.rindex('.')
+    except ValueError:
+        raise ImproperlyConfigured('%s isn\'t a filter module' % path)
+    filter_module, filter_classname = path[:dot], path[dot + 1:]
+    try:
+        mod = import_module(filter_module)
+    except ImportError, e:
+        raise ImproperlyConfigured('Error importing filter %s: "%s"' %
+                                   (filter_module, e))
+    try:
+        filter_class = getattr(mod, filter_classname, None)
+    except AttributeError:
+        raise ImproperlyConfigured('Filter module "%s" does not define a "%s" attribute' %
+                                   (filter_module, filter_classname))
+    filter_instance = None
+    if filter_class:
+        filter_instance = filter_class(*args, **kw)
+    return filter_instance
+
+
 class FilterInitMiddleware(object):
     def __init__(self):
         from tardis.tardis_portal.models import Dataset_File
-        for f in settings.POST_SAVE_FILTERS:
-            cls = f[0]
-            args = []
-            kw = {}
-
-            if len(f) == 2:
-                args = f[1]
 
-            if len(f) == 3:
-                kw = f[2]
+        if getattr(settings, 'FILTER_QUEUE_ENABLED', False):
+            # the filters run in the run_filter_queue workers, saving a
+            # datafile only records a job for them
+            from tardis.microtardis.filters.queue import enqueue_job
+            post_save.connect(enqueue_job, sender=Dataset_File, weak=False,
+                              dispatch_uid='tardis.microtardis.filters.queue')
+            logger.debug('Initialised postsave hook %s' % post_save.receivers)
+            return
 
-            hook = self._safe_import(cls, args, kw)
+        for cls, hook in get_post_save_hooks():
             # XXX seems to requre a strong ref else it won't fire,
             # could be because some hooks are classes not functions.
-            if hook:
-                post_save.connect(hook, sender=Dataset_File, weak=False, dispatch_uid=cls)
+            post_save.connect(hook, sender=Dataset_File, weak=False, dispatch_uid=cls)
             logger.debug('Initialised postsave hook %s' % post_save.receivers)
 
         # disable middleware
         #raise MiddlewareNotUsed()
 
-    def _safe_import(self, path, args, kw):
-        try:
-            dot = path.rindex('.')
-        except ValueError:
-            raise ImproperlyConfigured('%s isn\'t a filter module' % path)
-        filter_module, filter_classname = path[:dot], path[dot + 1:]
-        try:
-            mod = import_module(filter_module)
-        except ImportError, e:
-            raise ImproperlyConfigured('Error importing filter %s: "%s"' %
-                                       (filter_module, e))
-        try:
-            filter_class = getattr(mod, filter_classname, None)
-        except AttributeError:
-            raise ImproperlyConfigured('Filter module "%s" does not define a "%s" attribute' %
-                                       (filter_module, filter_classname))
-        filter_instance = None
-        if filter_class:
-            filter_instance = filter_class(*args, **kw)
-        return filter_instance
\ No newline at end of file
+    def process_exception(self, request, exception):
+        # TransactionMiddleware rolls back the request's transaction, and
+        # with it any schemas and parameter names the filters cached
+        from tardis.microtardis import registry
+        registry.invalidate()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011-2011, RMIT e-Research Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2011, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+backfill.py
+
+Re-runs the post save filters over datafiles which are already stored, see
+the ``reextract_metadata`` management command.
+
+"""
+import logging
+
+from django.db import transaction
+
+from tardis.tardis_portal.models import Dataset_File
+from tardis.microtardis import registry
+from tardis.microtardis.filters.queue import get_hooks
+
+
+logger = logging.getLogger(__name__)
+
+
+def select_datafiles(experiments=None, datasets=None, instrument=None,
+                     since=None, until=None):
+    """Return the ids of the datafiles to re-extract, in ascending order.
+
+    :param experiments: experiment ids to limit the selection to.
+    :type experiments: list of ints
+    :param datasets: dataset ids to limit the selection to.
+    :type datasets: list of ints
+    :param instrument: instrument name recorded when the datafile was
+        harvested.
+    :type instrument: string
+    :param since: earliest harvest time.
+    :type since: :class:`datetime.datetime`
+    :param until: harvest time the selection ends before.
+    :type until: :class:`datetime.datetime`
+    """
+    datafiles = Dataset_File.objects.all()
+    if experiments:
+        datafiles = datafiles.filter(dataset__experiment__id__in=experiments)
+    if datasets:
+        datafiles = datafiles.filter(dataset__id__in=datasets)
+    if instrument:
+        datafiles = datafiles.filter(datafile_harvest__instrument=instrument)
+    if since:
+        datafiles = datafiles.filter(datafile_harvest__created_time__gte=since)
+    if until:
+        datafiles = datafiles.filter(datafile_harvest__created_time__lt=until)
+    return list(datafiles.order_by('id').values_list('id', flat=True).distinct())
+
+
+def reextract(datafile_ids):
+    """Run the filters over a batch of datafiles in a single transaction.
+
+    Each datafile is re-extracted under a savepoint of its own; if a filter
+    raises, for instance a database error, only that datafile's changes are
+    rolled back and the rest of the batch carries on in a usable
+    transaction. Returns the number of datafiles re-extracted.
+    """
+    with transaction.commit_on_success():
+        datafiles = Dataset_File.objects.filter(id__in=datafile_ids) \
+                                        .select_related('dataset')
+        count = 0
+        for datafile in datafiles:
+            sid = transaction.savepoint()
+            try:
+                for path, hook in get_hooks():
+                    hook(sender=Dataset_File, instance=datafile,
+                         created=False, force=True)
+            except Exception:
+                logger.exception("re-extracting datafile %s with %s "
+                                 "failed" % (datafile.id, path))
+                transaction.savepoint_rollback(sid)
+                # the rolled back rows may have been cached
+                registry.invalidate()
+            else:
+                transaction.savepoint_commit(sid)
+                count += 1
+    return count
@@ -39,9 +39,13 @@ dattags.py
 
 """
 
-from tardis.tardis_portal.models import Schema, DatafileParameterSet
-from tardis.tardis_portal.models import ParameterName, DatafileParameter
-from tardis.tardis_portal.models import DatasetParameter
+from tardis.tardis_portal.models import Schema
+from tardis.microtardis.registry import get_or_create_schema
+from tardis.microtardis.filters.dispatcher import map_file
+from tardis.microtardis.filters.instruments import get_instrument
+from tardis.microtardis.filters.parsecache import get_or_parse
+from tardis.microtardis.filters.persistence import save_parameters
+from tardis.microtardis.filters.persistence import get_parameters
 import logging
 import string
 import csv
@@ -67,6 +71,10 @@ class DATTagsFilter(object):
     :param tagsToExclude: a list of the tags to exclude.
     :type tagsToExclude: list of strings
     """
+    # file types handled by this filter, see filters.dispatcher
+    extensions = ('.dat',)
+    magic = None
+
     def __init__(self, name, schema, tagsToFind=[], tagsToExclude=[]):
         self.name = name
         self.schema = schema
@@ -100,27 +108,27 @@ class DATTagsFilter(object):
         #ignore non-dat file
         if filepath[-4:].lower() != ".dat":
             return
+
+        data = map_file(filepath)
+        if data is None:
+            return
+        try:
+            self.process(instance, filepath, data)
+        finally:
+            data.close()
+
+    def process(self, instance, filepath, data):
+        """Extract the metadata of a datafile from its contents.
+
+        :param instance: The datafile being saved.
+        :param filepath: The absolute path of the datafile.
+        :param data: The file contents as returned by
+            :func:`~tardis.microtardis.filters.dispatcher.map_file`.
+        :returns: the name of the instrument whose metadata was extracted,
+            or None if the file was skipped.
+        """
         
-        # Find instrument name in filepath
-        instr_name = None 
-        import re
-        pathSep = re.compile(r'\\|\/')
-        for part in pathSep.split(filepath):
-            if part in self.instruments.keys():
-                instr_name = part
-        
-        # Find instrument name in dataset metadata
-        if not instr_name:
-            # couldn't find it in filepath, then try dataset metadata
-            dataset_params = DatasetParameter.objects.filter(parameterset__dataset__id=instance.dataset.id)
-            for dataset_param in dataset_params:
-                str_value = str(dataset_param.string_value)
-                if str_value.startswith('http://'):
-                    parts = str_value.split('/')
-                    if len(parts) > 4:
-                        instr_name = parts[4]
-                else:
-                    continue
+        instr_name = get_instrument(instance, filepath, self.instruments)
 
         logger.debug("filepath=%s" % filepath)
         logger.debug("instr_name=%s" % instr_name)
@@ -128,7 +136,7 @@ class DATTagsFilter(object):
         if (instr_name != None and len(instr_name) > 1):
             
             # get spectral metadata 
-            metadata = self.getSpectra(filepath)
+            metadata = get_or_parse('dat', filepath, data, self.getSpectra)
         
             # get schema (create schema if needed)
             instrSchemas = self.instruments[instr_name]
@@ -140,89 +148,23 @@ class DATTagsFilter(object):
                 logger.debug("Schema %s doesn't exist for instrument %s" % (schema_name, instr_name))
                 return
             instrNamespace = ''.join([self.schema, "/" , schemaSuffix]) 
-            (schema, created) = Schema.objects.get_or_create(namespace=instrNamespace, name=schemaName,type=Schema.DATAFILE)
-            if created: # new object was created
-                schema.save()
+            schema = get_or_create_schema(instrNamespace, schemaName)
                 
             # save spectral metadata
             self.saveSpectraMetadata(instance, schema, metadata)
+            return instr_name
 
     def saveSpectraMetadata(self, instance, schema, metadata):
         """Save all the metadata to a Dataset_Files paramamter set.
         """
-        parameters = self.getParamaters(schema, metadata)
-        if not parameters:
-            return None
-        
-        (ps, created) = DatafileParameterSet.objects.get_or_create(schema=schema, dataset_file=instance)
-        if created: # new object was created
-            ps.save()
-        else: # if parameter set already exists then just return it
-            return ps 
-
-        # save datafile parameters
-        for p in parameters:
-            if p.name in metadata:
-                dfp = DatafileParameter(parameterset=ps,
-                                        name=p)
-                if p.isNumeric():
-                    dfp.numerical_value = metadata[p.name][0]
-                else:
-                    dfp.string_value = metadata[p.name][0]
-                dfp.save()
-                
-        return ps
+        return save_parameters(instance, schema, metadata,
+                               self.tagsToFind, self.tagsToExclude)
 
     def getParamaters(self, schema, metadata):
         """Return a list of the paramaters that will be saved.
         """
-        param_objects = ParameterName.objects.filter(schema=schema)
-        parameters = []
-        for p in metadata:
-
-            if self.tagsToFind and not p in self.tagsToFind:
-                continue
-
-            if p in self.tagsToExclude:
-                continue
-
-            parameter = filter(lambda x: x.name == p, param_objects)
-
-            if parameter:
-                parameters.append(parameter[0])
-                continue
-
-            # detect type of parameter
-            datatype = ParameterName.STRING
-             
-            # integer data type test
-            try:
-                int(metadata[p][0])
-            except (ValueError, TypeError):
-                pass
-            else:
-                datatype = ParameterName.NUMERIC
-            
-            # float data type test
-            try:
-                float(metadata[p][0])
-            except (ValueError, TypeError):
-                pass
-            else:
-                datatype = ParameterName.NUMERIC
-
-            unit = ""
-            if metadata[p][1]:
-                unit = metadata[p][1]
-      
-            new_param = ParameterName(schema=schema,
-                                      name=p,
-                                      full_name=p,
-                                      data_type=datatype,
-                                      units=unit)
-            new_param.save()
-            parameters.append(new_param)
-        return parameters
+        return get_parameters(schema, metadata,
+                              self.tagsToFind, self.tagsToExclude)
 
     def getSchema(self):
         """Return the schema object that the paramaterset will use.
@@ -240,11 +182,16 @@ class DATTagsFilter(object):
 
     def getSpectra(self, filename):
         """Return a dictionary of the metadata.
+
+        :param filename: the path of the metadata file, or its contents.
         """
         logger.debug("Extracting spectral metadata from *.dat file...")
         ret = {}
         try:
-            dat = open(filename)
+            if isinstance(filename, basestring):
+                dat = open(filename)
+            else:
+                dat = filename[:].splitlines()
             csvReader = csv.reader(dat, delimiter=',')
             value = ""
             unit = ""
@@ -274,13 +221,9 @@ class DATTagsFilter(object):
                     value = float(row[1])
                     unit = "kV"
                     ret[field] = [value, unit]
-        except:
-            #print "Failed to extract spectral metadata from *.dat file."
-            import sys
-            #print sys.exc_info()
-            #print ret
+        except Exception:
             logger.debug("Failed to extract spectral metadata from *.dat file.")
-            return ret
+            raise
         
         logger.debug("Successed extracting spectral metadata from *.dat file.")
         return ret
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011-2011, RMIT e-Research Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2011, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+dispatcher.py
+
+Routes a saved datafile to the filter which handles its file type. The file
+is mapped into memory once and the mapped buffer is handed to that filter
+only; files no filter handles are never opened, and files whose contents
+haven't changed since their metadata was extracted are skipped. Each filter
+is wrapped in an
+:class:`~tardis.microtardis.filters.instrumentation.InstrumentedFilter`.
+
+"""
+import logging
+import mmap
+import os
+
+from tardis.microtardis.filters import metrics
+from tardis.microtardis.filters.fingerprint import fast_hash
+from tardis.microtardis.filters.fingerprint import get_fingerprint
+from tardis.microtardis.filters.fingerprint import record_fingerprint
+from tardis.microtardis.filters.fingerprint import stat_matches
+from tardis.microtardis.filters.instrumentation import InstrumentedFilter
+from tardis.microtardis.filters.instrumentation import FAILED
+from tardis.microtardis.filters.instrumentation import SKIPPED
+from tardis.microtardis.filters.instrumentation import record
+from tardis.microtardis.spectra.cache import invalidate
+
+
+logger = logging.getLogger(__name__)
+
+
+def map_file(filepath):
+    """Return a read only memory map of a file, or None if it can't be read.
+
+    The map can be used as a string (slicing, :func:`struct.unpack_from`) and
+    as a file object (``seek``, ``read``, ``readline``).
+    """
+    try:
+        f = open(filepath, 'rb')
+    except IOError:
+        return None
+    try:
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            # empty files can't be mapped
+            return None
+    finally:
+        f.close()
+
+
+class FilterDispatcher(object):
+    """post save callback which runs exactly one filter for each datafile.
+
+    Filters take part by defining ``extensions``, a tuple of lower case file
+    extensions, ``magic``, a tuple of byte strings one of which the file
+    has to start with (or None to accept any contents), and a
+    ``process(instance, filepath, data)`` method returning the name of the
+    instrument whose metadata was extracted, or None.
+
+    :param filters: the ``(path, filter)`` pairs to dispatch to.
+    :type filters: list of tuples
+    """
+    def __init__(self, filters):
+        self.filters = {}
+        for path, f in filters:
+            f = InstrumentedFilter(path, f)
+            for extension in f.extensions:
+                self.filters.setdefault(extension, []).append(f)
+
+    def __call__(self, sender, **kwargs):
+        """post save callback entry point.
+
+        :param sender: The model class.
+        :param instance: The actual instance being saved.
+        :param created: A boolean; True if a new record was created.
+        :type created: bool
+        :param force: Extract the metadata even if the file is unchanged.
+        :type force: bool
+        :param raise_errors: Raise the errors of the filters, and an
+            EnvironmentError if the file can't be read, rather than only
+            logging them.
+        :type raise_errors: bool
+        """
+        instance = kwargs.get('instance')
+        force = kwargs.get('force', False)
+        raise_errors = kwargs.get('raise_errors', False)
+
+        filepath = instance.get_absolute_filepath()
+        if not filepath:
+            return
+
+        candidates = self.get_filters(filepath)
+        if not candidates:
+            return
+
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            logger.debug("can't stat %s" % filepath)
+            record(candidates[0].name, filepath, FAILED)
+            if raise_errors:
+                raise
+            return
+
+        # skip files whose contents haven't changed since the last extraction
+        fingerprint = get_fingerprint(instance)
+        if fingerprint and not force and stat_matches(fingerprint, stat):
+            metrics.incr('fingerprint.unchanged')
+            record(candidates[0].name, filepath, SKIPPED)
+            return
+
+        data = map_file(filepath)
+        if data is None:
+            logger.debug("can't read %s" % filepath)
+            record(candidates[0].name, filepath, FAILED)
+            if raise_errors:
+                raise IOError("can't read %s" % filepath)
+            return
+        try:
+            content_hash = fast_hash(data)
+            if fingerprint and not force and fingerprint.hash == content_hash:
+                # touched but not modified
+                record_fingerprint(instance, fingerprint, stat, content_hash)
+                metrics.incr('fingerprint.unchanged')
+                record(candidates[0].name, filepath, SKIPPED)
+                return
+
+            f = self.match(candidates, data)
+            if f:
+                instrument = f.process(instance, filepath, data,
+                                       raise_errors=raise_errors)
+                # the cached spectrum images show the old peaks
+                invalidate(instance.id)
+                if not instrument:
+                    # the instrument isn't known yet or the parse failed,
+                    # extract the file again the next time it is saved
+                    return
+            else:
+                record(candidates[0].name, filepath, SKIPPED)
+            record_fingerprint(instance, fingerprint, stat, content_hash)
+        finally:
+            data.close()
+
+    def get_filters(self, filepath):
+        """Return the filters registered for the extension of a file.
+        """
+        extension = os.path.splitext(filepath)[1].lower()
+        return self.filters.get(extension, [])
+
+    def match(self, candidates, data):
+        """Return the first filter whose magic bytes match the data.
+        """
+        for f in candidates:
+            if not f.magic:
+                return f
+            for magic in f.magic:
+                if data[:len(magic)] == magic:
+                    return f
+        return None
@@ -41,19 +41,26 @@ exiftags.py
 """
 import logging
 import os
-import random
 import ConfigParser
+import StringIO
 import Image
 
 from django.core.exceptions import ImproperlyConfigured
 from django.conf import settings
 
-from tardis.tardis_portal.models import Schema, DatafileParameterSet
-from tardis.tardis_portal.models import ParameterName, DatafileParameter
-from tardis.tardis_portal.models import DatasetParameter
-from tardis.microtardis.views import write_thumbnails
-
-from fractions import Fraction
+from tardis.tardis_portal.models import Schema
+from tardis.microtardis.thumbnails import thumbnails_exist
+from tardis.microtardis.thumbnails import write_thumbnails
+from tardis.microtardis.registry import get_or_create_schema
+from tardis.microtardis.filters.dispatcher import map_file
+from tardis.microtardis.filters.instruments import get_instrument
+from tardis.microtardis.filters.fingerprint import get_fingerprint
+from tardis.microtardis.filters.fingerprint import stat_matches
+from tardis.microtardis.filters.parsecache import lookup
+from tardis.microtardis.filters.parsecache import store
+from tardis.microtardis.filters.rawmetadata import store_raw_metadata
+from tardis.microtardis.filters.persistence import save_parameters
+from tardis.microtardis.filters.persistence import get_parameters
 
 
 logger = logging.getLogger(__name__)
@@ -64,6 +71,108 @@ except ImportError:
     logger.debug("Error: Can't find the file 'EXIF.py' in the directory containing %r" % __file__)
     sys.exit(1)
 
+def parse_ini(text):
+    """Parse the INI formatted instrument settings held in an image tag.
+
+    :returns: the options of each section, keyed by section name and lower
+        case option name as :class:`ConfigParser.RawConfigParser` does.
+    :rtype: dict of dicts
+    """
+    config = ConfigParser.RawConfigParser()
+    config.readfp(StringIO.StringIO(text))
+    sections = {}
+    for section in config.sections():
+        sections[section] = dict(config.items(section))
+    return sections
+
+
+def make_converter(section, option, multiplier):
+    """Return the function converting the raw value of an option.
+    """
+    steps = []
+    # convert value with specified multiplier
+    if multiplier:
+        steps.append(lambda value: float(value) * multiplier)
+    # round values
+    if option in ["WorkingDistance", "Contrast", "Brightness"]:
+        steps.append(lambda value: round(float(value), 1))
+    if option in ["Magnification"]:
+        steps.append(lambda value: int(round(float(value))))
+    # get Chamber Pressure
+    if section == "Vacuum" and option.lower() == "chpressure":
+        steps.append(lambda value: "%.4G Torr (%.4G mbar)" % (float(value) / 133.322368,
+                                                             float(value) / 100))
+    if not steps:
+        return None
+    if len(steps) == 1:
+        return steps[0]
+
+    def convert(value):
+        for step in steps:
+            value = step(value)
+        return value
+    return convert
+
+
+def compile_tag_plan(tagsToFind):
+    """Compile a schema's ``(section, option, fieldname, unit, multiplier)``
+    tags into the steps :func:`apply_tag_plan` runs.
+
+    Each step is ``(section, option, key, unit, convert, role)``. The
+    section is None where it is the name of the detector, found in
+    ``[Detectors] Name``. The option is lower case, as the parsed INI
+    options are. The key is None where the metadata name depends on the
+    detector. The role marks the options used later on, the detector name
+    and the pixel width.
+    """
+    plan = []
+    for (section, option, fieldname, unit, multiplier) in tagsToFind:
+        role = None
+        if section == "Detectors" and option == "Name":
+            role = 'detector'
+        if section == "Scan" and option == "PixelWidth":
+            role = 'pixel_width'
+        key = None
+        if section == "Detector_Name":
+            section = None
+        else:
+            key = "[%s] %s" % (section, fieldname)
+        plan.append((section, option.lower(), key or fieldname, unit,
+                     make_converter(section, option, multiplier), role))
+    return plan
+
+
+def apply_tag_plan(plan, sections):
+    """Return the metadata a compiled tag plan finds in the parsed INI
+    sections, and the pixel width.
+    """
+    metadata = {}
+    detector_name = ""
+    pixel_width = 0
+    for (section, option, key, unit, convert, role) in plan:
+        if section is None:
+            # get values in detector section
+            if detector_name == "":
+                continue
+            value = sections.get(detector_name, {}).get(option)
+            key = "[%s] %s" % (detector_name, key)
+        else:
+            value = sections.get(section, {}).get(option)
+        if value is None:
+            continue
+        if convert:
+            value = convert(value)
+        # get metadata
+        metadata[key] = [value, unit]
+        # get Detector Name
+        if role == 'detector':
+            detector_name = value
+        # get Pixel Width for calculating magnification
+        elif role == 'pixel_width':
+            pixel_width = float(value)
+    return metadata, pixel_width
+
+
 class EXIFTagsFilter(object):
     """This filter provides extraction of metadata extraction of images from the RMMF
     from images.
@@ -80,6 +189,14 @@ class EXIFTagsFilter(object):
     :param tagsToExclude: a list of the tags to exclude.
     :type tagsToExclude: list of strings
     """
+    # file types handled by this filter, see filters.dispatcher
+    extensions = ('.tif', '.tiff')
+    magic = ('II*\x00', 'MM\x00*')
+    # TIFF tags holding the instrument settings as INI text, FEI and Philips
+    metadata_tags = (0x877A, 0x8778)
+    # the raw metadata kept for remap, see filters.rawmetadata
+    raw_kinds = ('Image Tag 0x877A', 'Image Tag 0x8778')
+
     def __init__(self, name, schema, tagsToFind=[], tagsToExclude=[]):
         self.name = name
         self.schema = schema
@@ -135,6 +252,11 @@ class EXIFTagsFilter(object):
                       ),
                      ),
         }
+        # the tags of each schema compiled once, see compile_tag_plan
+        self.tag_plans = {}
+        for instr_name, instrSchemas in self.instruments.items():
+            self.tag_plans[instr_name] = [(schemaName, schemaSuffix, compile_tag_plan(tagsToFind))
+                                          for (schemaName, schemaSuffix, tagsToFind) in instrSchemas]
         
         logger.debug('initialising EXIFTagsFilter')
 
@@ -158,38 +280,54 @@ class EXIFTagsFilter(object):
             # TODO log that exited early
             return
         
-        # generate thumbnails for image file
+        # ignore non-image file
+        if os.path.splitext(filepath)[1].lower() not in self.extensions:
+            return
+
+        data = map_file(filepath)
+        if data is None:
+            return
         try:
-            img =  Image.open(filepath)
-            write_thumbnails(instance, img)
-        except IOError:
-            # file not an image file
-            pass
+            self.process(instance, filepath, data)
+        finally:
+            data.close()
+
+    def process(self, instance, filepath, data):
+        """Extract the metadata of a datafile from its contents.
+
+        :param instance: The datafile being saved.
+        :param filepath: The absolute path of the datafile.
+        :param data: The file contents as returned by
+            :func:`~tardis.microtardis.filters.dispatcher.map_file`.
+        :returns: the name of the instrument whose metadata was extracted,
+            or None if the file was skipped.
+        """
+        # the metadata tags of an unchanged file are in the parse cache,
+        # and its thumbnails have been written already; the image is only
+        # opened if one of them is missing
+        exifs = lookup('exif', filepath)
+        needs_thumbnails = self.needsThumbnails(instance, filepath)
+        image_tags = {}
+        if exifs is None or needs_thumbnails:
+            try:
+                data.seek(0)
+                img =  Image.open(data)
+                # PIL has read the TIFF directory already, take the metadata
+                # tags before the thumbnails resize the image
+                if exifs is None:
+                    image_tags = self.getImageTags(img, self.metadata_tags)
+                # generate thumbnails for image file
+                if needs_thumbnails:
+                    write_thumbnails(instance, img)
+            except IOError:
+                # file not an image file
+                pass
         
         # ignore non-image file
         if filepath[-4:].lower() != ".tif":
             return
        
-        # Find instrument name in filepath
-        instr_name = None 
-        import re
-        pathSep = re.compile(r'\\|\/')
-        for part in pathSep.split(filepath):
-            if part in self.instruments.keys():
-                instr_name = part
-
-        # Find instrument name in dataset metadata
-        if not instr_name:
-            # couldn't find it in filepath, then try dataset metadata
-            dataset_params = DatasetParameter.objects.filter(parameterset__dataset__id=instance.dataset.id)
-            for dataset_param in dataset_params:
-                str_value = str(dataset_param.string_value)
-                if str_value.startswith('http://'):
-                    parts = str_value.split('/')
-                    if len(parts) > 4:
-                        instr_name = parts[4]
-                else:
-                    continue
+        instr_name = get_instrument(instance, filepath, self.instruments)
 
         logger.debug("filepath=%s" % filepath)
         logger.debug("instr_name=%s" % instr_name)
@@ -197,172 +335,90 @@ class EXIFTagsFilter(object):
         if (instr_name != None and len(instr_name) > 1):
             
             logger.debug("instr_name %s" % instr_name)
-            exifs = self.getExif(filepath)
+            if exifs is None:
+                exifs = image_tags or self.getExif(data, self.metadata_tags)
+                store('exif', filepath, exifs)
             
             for exifTag in exifs:
                 logger.debug("exifTag=%s" % exifTag)
-                if exifTag == 'Image Tag 0x877A' or exifTag == 'Image Tag 0x8778':
-                    tmpfile = "/tmp/workfile_%s" % random.randint(1, 9999)
-                    f = open(tmpfile, 'w')
-                    f.write(exifs[exifTag])
-                    f.close()
-                    x877a_tags = ConfigParser.RawConfigParser()
-                    x877a_tags.read(tmpfile)
-                    
-                    instrSchemas = self.instruments[instr_name]
-                    # for each schema for this instrument 
-                    for sch in instrSchemas:
-                     
-                        (schemaName,schemaSuffix,tagsToFind) = sch
-                        logger.debug("schemaTuple %s  = %s %s %s" %(sch,schemaName,schemaSuffix,tagsToFind))
-
-                        # find values in tags
-                        metadata = {}
-                        detector_name = ""
-                        pixel_width = 0
-                        for tag in tagsToFind:
-                            (section, option, fieldname, unit, multiplier) = tag
-                            try:
-                                # get values in detector section
-                                if section == "Detector_Name" and detector_name != "":
-                                    section = detector_name
-                                value = x877a_tags.get(section, option)
-                                # convert value with specified multiplier
-                                if multiplier:
-                                    value = float(value) * multiplier
-                                # round values
-                                if option in ["WorkingDistance", "Contrast", "Brightness"]:
-                                    value = round(float(value), 1)
-                                if option in ["Magnification"]:
-                                    value = int(round(float(value)))
-                                # get Chamber Pressure
-                                if section == "Vacuum" and option.lower() == "chpressure":
-                                    value_in_torr = float(value) / 133.322368
-                                    value_in_mbar = float(value) / 100
-                                    value = "%.4G Torr (%.4G mbar)" % (value_in_torr, value_in_mbar)
-                                # get metadata
-                                metadata["[%s] %s" % (section, fieldname)] = [value, unit]
-                                # get Detector Name
-                                if section == "Detectors" and option == "Name":
-                                    detector_name = value
-                                # get Pixel Width for calculating magnification
-                                if section == "Scan" and option == "PixelWidth":
-                                    pixel_width = float(value)
-                            except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
-                                pass
-                            
-                        # Calculate Magnification
-                        if pixel_width and instr_name in ["Quanta200", "NovaNanoSEM"]:
-                            section = "Scan"
-                            option = "Original Magnification (Full Screen)"
-                            
-                            if instr_name == "Quanta200":
-                                monitor_pixel_width = 0.00025
-                            if instr_name == "NovaNanoSEM":
-                                monitor_pixel_width = 0.000291406
-                            value = round( monitor_pixel_width / pixel_width )
-                            unit = "X"
-                            # get metadata
-                            metadata["[%s] %s" % (section, option)] = [value, unit]
-
-                        # only save exif data if we found some expected metadata
-                        logger.debug("metadata = %s" % metadata)
-                        if len(metadata) > 0:
-                            # Make instrument specific schema                          
-                            instrNamespace = ''.join([self.schema, "/" , schemaSuffix]) 
-
-                            # create schema if needed
-                            try:
-                                schema =  Schema.objects.get(namespace__exact=instrNamespace)
-                                logger.debug("found existing metadata schema %s" % schema)
-                            except Schema.DoesNotExist:
-                                schema = Schema(namespace=instrNamespace, name=schemaName,type=Schema.DATAFILE)
-                                logger.debug("creating new metadata schema %s" % schema)
-                                schema.save()
-                            # and save metadata
-                            ps = self.saveExifMetadata(instance, schema, metadata)
-                            logger.debug("ps=%s" % ps)
-                            
-                    os.remove(tmpfile)
+                if exifTag in self.raw_kinds:
+                    store_raw_metadata(instance, exifTag, instr_name, exifs[exifTag])
+                    self.saveInstrumentMetadata(instance, instr_name, exifs[exifTag])
+
+            return instr_name
+
+    def needsThumbnails(self, instance, filepath):
+        """Return True unless the thumbnails of the datafile have been
+        written from the file as it is now.
+        """
+        fingerprint = get_fingerprint(instance)
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            return True
+        if fingerprint is None or not stat_matches(fingerprint, stat):
+            return True
+        return not thumbnails_exist(instance)
+
+    def remap(self, instance, instrument, kind, raw):
+        """Derive the parameters of a datafile from its stored raw metadata.
+
+        :param instance: the datafile.
+        :param instrument: the name of the instrument.
+        :param kind: one of :attr:`raw_kinds`.
+        :param raw: the settings text of the image.
+        """
+        if instrument in self.tag_plans:
+            self.saveInstrumentMetadata(instance, instrument, raw)
+
+    def saveInstrumentMetadata(self, instance, instr_name, text):
+        """Save the metadata found in the settings text of an image.
+        """
+        x877a_tags = parse_ini(text)
+        
+        # for each schema for this instrument 
+        for (schemaName, schemaSuffix, plan) in self.tag_plans[instr_name]:
+
+            # find values in tags
+            metadata, pixel_width = apply_tag_plan(plan, x877a_tags)
+
+            # Calculate Magnification
+            if pixel_width and instr_name in ["Quanta200", "NovaNanoSEM"]:
+                section = "Scan"
+                option = "Original Magnification (Full Screen)"
+
+                if instr_name == "Quanta200":
+                    monitor_pixel_width = 0.00025
+                if instr_name == "NovaNanoSEM":
+                    monitor_pixel_width = 0.000291406
+                value = round( monitor_pixel_width / pixel_width )
+                unit = "X"
+                # get metadata
+                metadata["[%s] %s" % (section, option)] = [value, unit]
+
+            # only save exif data if we found some expected metadata
+            logger.debug("metadata = %s" % metadata)
+            if len(metadata) > 0:
+                # Make instrument specific schema                          
+                instrNamespace = ''.join([self.schema, "/" , schemaSuffix]) 
+
+                # create schema if needed
+                schema = get_or_create_schema(instrNamespace, schemaName)
+                # and save metadata
+                ps = self.saveExifMetadata(instance, schema, metadata)
+                logger.debug("ps=%s" % ps)
 
     def saveExifMetadata(self, instance, schema, metadata):
         """Save all the metadata to a Dataset_Files paramamter set.
         """
-        parameters = self.getParamaters(schema, metadata)
-        if not parameters:
-            return None
-
-        (ps, created) = DatafileParameterSet.objects.get_or_create(schema=schema, dataset_file=instance)
-        if created: # new object was created
-            ps.save()
-        else: # if parameter set already exists then just return it
-            return ps 
-
-        for p in parameters:
-            if p.name in metadata:
-                dfp = DatafileParameter(parameterset=ps,
-                                        name=p)
-                if p.isNumeric():
-                    dfp.numerical_value = metadata[p.name][0]
-                else:
-                    dfp.string_value = metadata[p.name][0]
-                dfp.save()
-        return ps
+        return save_parameters(instance, schema, metadata,
+                               self.tagsToFind, self.tagsToExclude)
 
     def getParamaters(self, schema, metadata):
         """Return a list of the paramaters that will be saved.
         """
-        param_objects = ParameterName.objects.filter(schema=schema)
-        parameters = []
-        for p in metadata:
-
-            if self.tagsToFind and not p in self.tagsToFind:
-                continue
-
-            if p in self.tagsToExclude:
-                continue
-
-            parameter = filter(lambda x: x.name == p, param_objects)
-
-            if parameter:
-                parameters.append(parameter[0])
-                continue
-
-            # detect type of parameter
-            datatype = ParameterName.STRING
-             
-            # integer data type test
-            try:
-                int(metadata[p][0])
-            except (ValueError, TypeError):
-                pass
-            else:
-                datatype = ParameterName.NUMERIC
-            
-            # float data type test
-            try:
-                float(metadata[p][0])
-            except (ValueError, TypeError):
-                pass
-            else:
-                datatype = ParameterName.NUMERIC
-            
-            # fraction data type test
-            if isinstance(metadata[p][0], Fraction):
-                datatype = ParameterName.NUMERIC
-
-            unit = ""
-            if metadata[p][1]:
-                unit = metadata[p][1]
-                
-            new_param = ParameterName(schema=schema,
-                                      name=p,
-                                      full_name=p,
-                                      data_type=datatype,
-                                      units=unit)
-            new_param.save()
-            parameters.append(new_param)
-        return parameters
+        return get_parameters(schema, metadata,
+                              self.tagsToFind, self.tagsToExclude)
 
     def getSchema(self):
         """Return the schema object that the paramaterset will use.
@@ -378,14 +434,49 @@ class EXIFTagsFilter(object):
 
 
 
-    def getExif(self, filename):
+    def getImageTags(self, img, tags):
+        """Return the tags PIL read from a TIFF image, keyed like
+        :meth:`getExif`, or an empty dictionary if it has none of them.
+
+        :param img: the image opened by PIL.
+        :param tags: the tag IDs to return.
+        :type tags: tuple of ints
+        """
+        ret = {}
+        directory = getattr(img, 'tag', None)
+        if directory is None:
+            return ret
+        for tag in tags:
+            value = directory.get(tag)
+            if value is None:
+                continue
+            if isinstance(value, tuple):
+                # newer PIL versions return tuples of values
+                value = ''.join([str(v) for v in value])
+            # like EXIF.py, drop any garbage after a null
+            ret['Image Tag 0x%04X' % tag] = str(value).split('\x00', 1)[0]
+        return ret
+
+    def getExif(self, filename, tags=None):
         """Return a dictionary of the metadata.
+
+        :param filename: the path of the image, or the image file object.
+        :param tags: only look for these tag IDs, rather than decoding every
+            tag, maker note and thumbnail.
+        :type tags: tuple of ints
         """
         logger.debug("Extracting EXIF metadata from image...")
         ret = {}
         try:
-            img = open(filename)
-            exif_tags = EXIF.process_file(img)
+            if isinstance(filename, basestring):
+                img = open(filename, 'rb')
+            else:
+                img = filename
+                img.seek(0)
+            if tags:
+                exif_tags = EXIF.find_tags(img, tags)
+            else:
+                exif_tags = EXIF.process_file(img)
             for tag in exif_tags:
                 # EXIF.py has custom str function, use it to get correct values.
                 s = str(exif_tags[tag])
@@ -393,9 +484,9 @@ class EXIFTagsFilter(object):
                     ret[tag] = float(s)
                 except ValueError:
                     ret[tag] = s
-        except:
+        except Exception:
             logger.debug("Failed to extract EXIF metadata from image.")
-            return ret
+            raise
         
         logger.debug("Successed extracting EXIF metadata from image.")
         return ret
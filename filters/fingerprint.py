@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011-2011, RMIT e-Research Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2011, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+fingerprint.py
+
+Content fingerprints of datafiles, recorded after the filters have run so a
+datafile which is saved again with unchanged contents isn't re-extracted.
+
+"""
+import hashlib
+import os
+
+from tardis.microtardis.models import Datafile_Fingerprint
+
+
+# bytes hashed from each end of a file
+SAMPLE_SIZE = 64 * 1024
+
+
+def fast_hash(data):
+    """Return the md5 of the size and the first and last ``SAMPLE_SIZE``
+    bytes of the file contents.
+    """
+    h = hashlib.md5(str(len(data)))
+    h.update(data[:SAMPLE_SIZE])
+    h.update(data[-SAMPLE_SIZE:])
+    return h.hexdigest()
+
+
+def get_fingerprint(instance):
+    """Return the recorded fingerprint of a datafile, or None.
+    """
+    try:
+        return Datafile_Fingerprint.objects.get(datafile=instance)
+    except Datafile_Fingerprint.DoesNotExist:
+        return None
+
+
+def stat_matches(fingerprint, stat):
+    return fingerprint.size == stat.st_size and \
+           fingerprint.mtime == stat.st_mtime
+
+
+def record_fingerprint(instance, fingerprint, stat, content_hash):
+    """Create or update the fingerprint of a datafile.
+    """
+    if fingerprint is None:
+        fingerprint = Datafile_Fingerprint(datafile=instance)
+    fingerprint.size = stat.st_size
+    fingerprint.mtime = stat.st_mtime
+    fingerprint.hash = content_hash
+    fingerprint.save()
+    return fingerprint
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011-2011, RMIT e-Research Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2011, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+instrumentation.py
+
+Records how long each post save filter takes, how many bytes it is given,
+how many queries it issues and whether it parsed, skipped or failed on a
+file, broken down by filter, file type and instrument. The numbers go into
+:mod:`~tardis.microtardis.filters.metrics` as::
+
+    filter.<filter>.<file type>.<instrument>.<parsed|skipped|failed>
+    filter.<filter>.<file type>.<instrument>.seconds
+    filter.<filter>.<file type>.<instrument>.bytes
+    filter.<filter>.<file type>.<instrument>.queries
+
+"""
+import logging
+import os
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.db import DatabaseError
+
+from tardis.microtardis.filters import metrics
+from tardis.microtardis.filters.persistence import in_transaction
+
+
+logger = logging.getLogger(__name__)
+
+PARSED = 'parsed'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+
+def get_prefix(name, filepath, instrument=None):
+    extension = os.path.splitext(filepath or '')[1].lower().lstrip('.')
+    return 'filter.%s.%s.%s' % (name, extension or 'none',
+                                instrument or 'unknown')
+
+
+def record(name, filepath, outcome, instrument=None, seconds=None,
+           size=None, queries=None):
+    """Record the outcome of running the filter ``name`` on a file.
+    """
+    prefix = get_prefix(name, filepath, instrument)
+    metrics.incr('%s.%s' % (prefix, outcome))
+    if seconds is not None:
+        metrics.observe('%s.seconds' % prefix, seconds)
+    if size is not None:
+        metrics.observe('%s.bytes' % prefix, size)
+    if queries is not None:
+        metrics.observe('%s.queries' % prefix, queries)
+
+
+class QueryCounter(object):
+    """Counts the queries run on the default connection between
+    :meth:`start` and :meth:`stop`.
+
+    Django only keeps a query log with the debug cursor, so it is switched
+    on for the duration. If it was off, the log is trimmed back afterwards;
+    a log kept because of ``settings.DEBUG`` is left alone.
+    """
+    def start(self):
+        self.debug_cursor = connection.use_debug_cursor
+        # Django logs the queries if use_debug_cursor is set, or is None
+        # with settings.DEBUG on
+        self.logging = self.debug_cursor or \
+                       (self.debug_cursor is None and settings.DEBUG)
+        connection.use_debug_cursor = True
+        self.logged = len(connection.queries)
+
+    def stop(self):
+        count = len(connection.queries) - self.logged
+        if not self.logging:
+            del connection.queries[self.logged:]
+        connection.use_debug_cursor = self.debug_cursor
+        return max(count, 0)
+
+
+class InstrumentedFilter(object):
+    """Wraps a filter and records the metrics of every file it handles.
+
+    Filters driven by the
+    :class:`~tardis.microtardis.filters.dispatcher.FilterDispatcher` are
+    measured around ``process``, which returns the name of the instrument
+    whose metadata was extracted, or None if the file was skipped. Other
+    filters are measured around the post save callback itself.
+
+    A filter raising a database error fails the save as before; any other
+    error is logged and counted as a failure, so a corrupt file doesn't
+    stop the datafile being stored. Callers which have to know about the
+    failure, such as the filter queue, pass ``raise_errors=True`` to have
+    every error raised.
+
+    :param path: the dotted path the filter was configured with.
+    :param f: the filter.
+    """
+    def __init__(self, path, f):
+        self.path = path
+        self.filter = f
+        self.name = f.__class__.__name__
+
+    def __getattr__(self, name):
+        return getattr(self.filter, name)
+
+    def __call__(self, sender, **kwargs):
+        raise_errors = kwargs.pop('raise_errors', False)
+        instance = kwargs.get('instance')
+        filepath = None
+        if instance is not None:
+            filepath = instance.get_absolute_filepath()
+        self.measure(filepath, None, False, raise_errors, self.filter,
+                     sender, **kwargs)
+
+    def process(self, instance, filepath, data, raise_errors=False):
+        """Run the filter's ``process`` in a transaction of its own.
+        """
+        return self.measure(filepath, len(data), True, raise_errors,
+                            in_transaction, self.filter.process, instance,
+                            filepath, data)
+
+    def measure(self, filepath, size, dispatched, raise_errors, func,
+                *args, **kwargs):
+        counter = QueryCounter()
+        counter.start()
+        start = time.time()
+        outcome = PARSED
+        instrument = None
+        try:
+            try:
+                result = func(*args, **kwargs)
+                if dispatched:
+                    instrument = result
+                    if not instrument:
+                        outcome = SKIPPED
+            except DatabaseError:
+                outcome = FAILED
+                raise
+            except Exception:
+                outcome = FAILED
+                if raise_errors:
+                    raise
+                logger.exception("%s failed on %s" % (self.path, filepath))
+        finally:
+            seconds = time.time() - start
+            queries = counter.stop()
+            record(self.name, filepath, outcome, instrument=instrument,
+                   seconds=seconds, size=size, queries=queries)
+        return instrument
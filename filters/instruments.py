@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011-2011, RMIT e-Research Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2011, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+instruments.py
+
+Works out which instrument a datafile came from: either a directory in its
+path is named after the instrument, or the dataset's metadata links to the
+instrument. The dataset lookup is memoized in a per-process LRU and stored
+in :class:`~tardis.microtardis.models.Dataset_Harvest`, so it runs once per
+dataset rather than once per datafile.
+
+"""
+import re
+import threading
+
+from django.conf import settings
+
+from tardis.tardis_portal.models import DatasetParameter
+from tardis.microtardis.models import Dataset_Harvest
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # python < 2.7, the cache just isn't least recently used ordered
+    OrderedDict = dict
+
+
+pathSep = re.compile(r'\\|\/')
+
+_lock = threading.Lock()
+# {dataset id: instrument name}
+_dataset_instruments = OrderedDict()
+
+
+def get_instrument(instance, filepath, instruments):
+    """Return the name of the instrument a datafile came from, if it is one
+    of ``instruments``.
+
+    :param instance: the datafile.
+    :param filepath: the absolute path of the datafile.
+    :param instruments: the instruments a filter handles, keyed by name.
+    :type instruments: dict
+    """
+    # Find instrument name in filepath
+    instr_name = None
+    for part in pathSep.split(filepath):
+        if part in instruments:
+            instr_name = part
+
+    # Find instrument name in dataset metadata
+    if not instr_name:
+        instr_name = get_dataset_instrument(instance.dataset_id)
+
+    if instr_name in instruments:
+        return instr_name
+    return None
+
+
+def get_dataset_instrument(dataset_id):
+    """Return the instrument named in a dataset's metadata, or None.
+    """
+    _lock.acquire()
+    try:
+        if dataset_id in _dataset_instruments:
+            instr_name = _dataset_instruments.pop(dataset_id)
+            _dataset_instruments[dataset_id] = instr_name
+            return instr_name
+    finally:
+        _lock.release()
+
+    instr_name = None
+    harvests = Dataset_Harvest.objects.filter(dataset__id=dataset_id) \
+                                      .values_list('instrument', flat=True)
+    for instrument in harvests:
+        if instrument:
+            instr_name = instrument
+
+    if not instr_name:
+        instr_name = find_dataset_instrument(dataset_id)
+        if not instr_name:
+            # not cached, the metadata may still be on its way
+            return None
+        if harvests:
+            Dataset_Harvest.objects.filter(dataset__id=dataset_id) \
+                                   .update(instrument=instr_name)
+        else:
+            Dataset_Harvest(dataset_id=dataset_id,
+                            instrument=instr_name).save()
+
+    size = getattr(settings, 'INSTRUMENT_CACHE_SIZE', 1024)
+    _lock.acquire()
+    try:
+        _dataset_instruments[dataset_id] = instr_name
+        while len(_dataset_instruments) > size:
+            del _dataset_instruments[iter(_dataset_instruments).next()]
+    finally:
+        _lock.release()
+    return instr_name
+
+
+def reset():
+    """Forget the instruments of all datasets.
+    """
+    _lock.acquire()
+    try:
+        _dataset_instruments.clear()
+    finally:
+        _lock.release()
+
+
+def find_dataset_instrument(dataset_id):
+    """Return the instrument named in the last ``http://host/path/path/NAME``
+    link of a dataset's parameters.
+    """
+    instr_name = None
+    dataset_params = DatasetParameter.objects.filter(parameterset__dataset__id=dataset_id) \
+                                             .values_list('string_value', flat=True)
+    for string_value in dataset_params:
+        str_value = str(string_value)
+        if str_value.startswith('http://'):
+            parts = str_value.split('/')
+            if len(parts) > 4:
+                instr_name = parts[4]
+    return instr_name
@@ -82,6 +82,9 @@
 # ----- See 'changes.txt' file for all contributors and changes ----- #
 #
 
+import mmap
+import struct
+
 
 # Don't throw an exception when given an out of range character.
 def make_string(seq):
@@ -119,6 +122,13 @@ FIELD_TYPES = (
     (8, 'SR', 'Signed Ratio'),
     )
 
+# struct byte order prefixes of the EXIF endian flags
+ENDIAN_PREFIXES = {'I': '<', 'M': '>'}
+
+# struct format characters of the numeric field types, ratios are pairs
+ARRAY_CODES = {1: 'B', 3: 'H', 4: 'I', 5: 'I', 6: 'b', 7: 'B', 8: 'h',
+               9: 'i', 10: 'i'}
+
 # dictionary of main EXIF tag names
 # first element of tuple is tag name, optional second element is
 # another dictionary giving names to values
@@ -418,6 +428,9 @@ GPS_TAGS = {
 # 0x9286 is user comment
 IGNORE_TAGS=(0x9286, 0x927C)
 
+# whether the tags above are decoded, set by process_file
+detailed = True
+
 # http://tomtia.plala.jp/DigitalCamera/MakerNote/index.asp
 def nikon_ev_bias(seq):
     # First digit seems to be in steps of 1/6 EV.
@@ -1252,8 +1265,7 @@ class EXIF_header:
     # start of the EXIF information.  For some cameras that use relative tags,
     # this offset may be relative to some other starting point.
     def s2n(self, offset, length, signed=0):
-        self.file.seek(self.offset+offset)
-        slice=self.file.read(length)
+        slice=self.read_bytes(offset, length)
         if self.endian == 'I':
             val=s2n_intel(slice)
         else:
@@ -1265,6 +1277,11 @@ class EXIF_header:
                 val=val-(msb << 1)
         return val
 
+    # return the bytes at offset, relative to the start of the EXIF information
+    def read_bytes(self, offset, length):
+        self.file.seek(self.offset+offset)
+        return self.file.read(length)
+
     # convert offset to string
     def n2s(self, offset, length):
         s = ''
@@ -1295,12 +1312,23 @@ class EXIF_header:
         return a
 
     # return list of entries in this IFD
-    def dump_IFD(self, ifd, ifd_name, dict=EXIF_TAGS, relative=0, stop_tag='UNDEF'):
+    # if tags is given only the entries with those tag IDs are decoded, and
+    # the IFD is left as soon as all of them are found
+    def dump_IFD(self, ifd, ifd_name, dict=EXIF_TAGS, relative=0, stop_tag='UNDEF',
+                 tags=None):
+        if tags is not None:
+            wanted = set(tags)
         entries=self.s2n(ifd, 2)
+        entry_tags, field_types, counts, pointers = self.read_IFD_entries(ifd, entries)
         for i in range(entries):
             # entry is index of start of this IFD in the file
             entry = ifd + 2 + 12 * i
-            tag = self.s2n(entry, 2)
+            tag = entry_tags[i]
+
+            if tags is not None:
+                if tag not in wanted:
+                    continue
+                wanted.discard(tag)
 
             # get tag name early to avoid errors, help debug
             tag_entry = dict.get(tag)
@@ -1311,7 +1339,7 @@ class EXIF_header:
 
             # ignore certain tags for faster processing
             if not (not detailed and tag in IGNORE_TAGS):
-                field_type = self.s2n(entry + 2, 2)
+                field_type = field_types[i]
                 
                 # unknown field type
                 if not 0 < field_type < len(FIELD_TYPES):
@@ -1321,7 +1349,7 @@ class EXIF_header:
                         raise ValueError('unknown type %d in tag 0x%04X' % (field_type, tag))
 
                 typelen = FIELD_TYPES[field_type][0]
-                count = self.s2n(entry + 4, 4)
+                count = counts[i]
                 # Adjust for tag id/type/count (2+2+4 bytes)
                 # Now we point at either the data or the 2nd level offset
                 offset = entry + 8
@@ -1336,12 +1364,12 @@ class EXIF_header:
                     # other relative offsets, which would have to be computed here
                     # slightly differently.
                     if relative:
-                        tmp_offset = self.s2n(offset, 4)
+                        tmp_offset = pointers[i]
                         offset = tmp_offset + ifd - 8
                         if self.fake_exif:
                             offset = offset + 18
                     else:
-                        offset = self.s2n(offset, 4)
+                        offset = pointers[i]
 
                 field_offset = offset
                 if field_type == 2:
@@ -1349,8 +1377,7 @@ class EXIF_header:
                     # XXX investigate
                     # sometimes gets too big to fit in int value
                     if count != 0 and count < (2**31):
-                        self.file.seek(self.offset + offset)
-                        values = self.file.read(count)
+                        values = self.read_bytes(offset, count)
                         #print values
                         # Drop any garbage after a null.
                         values = values.split('\x00', 1)[0]
@@ -1358,28 +1385,20 @@ class EXIF_header:
                         values = ''
                 else:
                     values = []
-                    signed = (field_type in [6, 8, 9, 10])
                     
                     # XXX investigate
                     # some entries get too big to handle could be malformed
                     # file or problem with self.s2n
                     if count < 1000:
-                        for dummy in range(count):
-                            if field_type in (5, 10):
-                                # a ratio
-                                value = Ratio(self.s2n(offset, 4, signed),
-                                              self.s2n(offset + 4, 4, signed))
-                            else:
-                                value = self.s2n(offset, typelen, signed)
-                            values.append(value)
-                            offset = offset + typelen
+                        values = self.s2n_array(offset, field_type, count)
                     # The test above causes problems with tags that are 
                     # supposed to have long values!  Fix up one important case.
                     elif tag_name == 'MakerNote' :
-                        for dummy in range(count):
-                            value = self.s2n(offset, typelen, signed)
-                            values.append(value)
-                            offset = offset + typelen
+                        if field_type in (5, 10):
+                            values = self.s2n_values(offset, field_type, count,
+                                                     ratios=False)
+                        else:
+                            values = self.s2n_array(offset, field_type, count)
                     #else :
                     #    print "Warning: dropping large tag:", tag, tag_name
                 
@@ -1414,6 +1433,68 @@ class EXIF_header:
 
             if tag_name == stop_tag:
                 break
+            if tags is not None and not wanted:
+                break
+
+    # return the tag IDs, field types, counts and value fields (as offsets)
+    # of the entries in an IFD, read and unpacked in one go
+    def read_IFD_entries(self, ifd, entries):
+        block = self.read_bytes(ifd + 2, 12 * entries)
+        try:
+            table = struct.unpack(ENDIAN_PREFIXES[self.endian] + 'HHII' * entries,
+                                  block)
+        except struct.error:
+            # truncated IFD, decode what is there field by field
+            table = []
+            for i in range(entries):
+                entry = ifd + 2 + 12 * i
+                table.extend((self.s2n(entry, 2), self.s2n(entry + 2, 2),
+                              self.s2n(entry + 4, 4), self.s2n(entry + 8, 4)))
+        else:
+            # same types as s2n
+            if self.endian == 'I':
+                table = map(long, table)
+        return table[0::4], table[1::4], table[2::4], table[3::4]
+
+    # return a list of count values of a field type, value by value
+    def s2n_values(self, offset, field_type, count, ratios=True):
+        typelen = FIELD_TYPES[field_type][0]
+        signed = (field_type in [6, 8, 9, 10])
+        values = []
+        for dummy in range(count):
+            if ratios and field_type in (5, 10):
+                # a ratio
+                value = Ratio(self.s2n(offset, 4, signed),
+                              self.s2n(offset + 4, 4, signed))
+            else:
+                value = self.s2n(offset, typelen, signed)
+            values.append(value)
+            offset = offset + typelen
+        return values
+
+    # return a list of count values of a field type, unpacked in one go
+    def s2n_array(self, offset, field_type, count):
+        typelen = FIELD_TYPES[field_type][0]
+        signed = (field_type in [6, 8, 9, 10])
+        ratio = field_type in (5, 10)
+        n = count
+        if ratio:
+            n = count * 2
+        format = '%s%d%s' % (ENDIAN_PREFIXES[self.endian], n,
+                             ARRAY_CODES[field_type])
+        try:
+            numbers = struct.unpack(format, self.read_bytes(offset, count * typelen))
+        except struct.error:
+            # truncated value, decode what is there value by value
+            return self.s2n_values(offset, field_type, count)
+        # same types as s2n, they show in the printable values
+        if self.endian == 'I':
+            numbers = map(long, numbers)
+        elif signed:
+            numbers = [x < 0 and long(x) or x for x in numbers]
+        if ratio:
+            return [Ratio(numbers[i], numbers[i + 1]) for i in range(0, n, 2)]
+        return list(numbers)
 
     # extract uncompressed TIFF thumbnail (like pulling teeth)
     # we take advantage of the pre-existing layout in the thumbnail IFD as
@@ -1426,8 +1507,7 @@ class EXIF_header:
         else:
             tiff = 'II*\x00\x08\x00\x00\x00'
         # ... plus thumbnail IFD data plus a null "next IFD" pointer
-        self.file.seek(self.offset+thumb_ifd)
-        tiff += self.file.read(entries*12+2)+'\x00\x00\x00\x00'
+        tiff += self.read_bytes(thumb_ifd, entries*12+2)+'\x00\x00\x00\x00'
 
         # fix up large value offset pointers into data area
         for i in range(entries):
@@ -1454,8 +1534,7 @@ class EXIF_header:
                     strip_off = newoff
                     strip_len = 4
                 # get original data and store it
-                self.file.seek(self.offset + oldoff)
-                tiff += self.file.read(count * typelen)
+                tiff += self.read_bytes(oldoff, count * typelen)
 
         # add pixel strips and update strip offset info
         old_offsets = self.tags['Thumbnail StripOffsets'].values
@@ -1466,8 +1545,7 @@ class EXIF_header:
             tiff = tiff[:strip_off] + offset + tiff[strip_off + strip_len:]
             strip_off += strip_len
             # add pixel strip to end
-            self.file.seek(self.offset + old_offsets[i])
-            tiff += self.file.read(old_counts[i])
+            tiff += self.read_bytes(old_offsets[i], old_counts[i])
 
         self.tags['TIFFThumbnail'] = tiff
 
@@ -1592,14 +1670,55 @@ class EXIF_header:
             self.tags['MakerNote '+name]=IFD_Tag(str(val), None, 0, None,
                                                  None, None)
 
-# process an image file (expects an open file object)
-# this is the function that has to deal with all the arbitrary nasty bits
-# of the EXIF standard
-def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
-    # yah it's cheesy...
-    global detailed
-    detailed = details
+# precompiled structs for the integer sizes, keyed by (endian, length, signed)
+NUMBER_STRUCTS = {}
+for _endian, _prefix in ENDIAN_PREFIXES.items():
+    for _length, _code in ((1, 'B'), (2, 'H'), (4, 'I'), (8, 'Q')):
+        NUMBER_STRUCTS[(_endian, _length, 0)] = struct.Struct(_prefix + _code)
+        NUMBER_STRUCTS[(_endian, _length, 1)] = struct.Struct(_prefix + _code.lower())
+
+# EXIF header reading from a buffer (a memory map or a string) holding the
+# whole file, rather than seeking and reading the file for every field.
+# Numbers are decoded in place with struct.unpack_from.
+class EXIF_buffer_header(EXIF_header):
+    def __init__(self, buffer, endian, offset, fake_exif, strict, debug=0):
+        EXIF_header.__init__(self, buffer, endian, offset, fake_exif, strict,
+                             debug)
+        self.buffer = buffer
+
+    def read_bytes(self, offset, length):
+        start = self.offset + offset
+        return self.buffer[start:start + length]
 
+    def s2n(self, offset, length, signed=0):
+        number = NUMBER_STRUCTS.get((self.endian, length, signed))
+        if number is None:
+            return EXIF_header.s2n(self, offset, length, signed)
+        try:
+            val = number.unpack_from(self.buffer, self.offset + offset)[0]
+        except struct.error:
+            # truncated file
+            return EXIF_header.s2n(self, offset, length, signed)
+        # same types as EXIF_header.s2n, they show in the printable values
+        if self.endian == 'I' or val < 0:
+            val = long(val)
+        return val
+
+# return a memory map of an open file, or None if it can't be mapped
+def map_file(f):
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, ValueError, EnvironmentError):
+        return None
+
+# find the EXIF header of an image file (expects an open file object).
+# returns the header, the offset of the EXIF information and the memory
+# map the header reads from if one was opened here, or None if the file
+# has no EXIF information.
+#
+# Memory maps and real files are read through a memory map of the whole
+# file, other file objects with seek and read.
+def open_header(f, strict=False, debug=False):
     # by default do not fake an EXIF beginning
     fake_exif = 0
 
@@ -1625,15 +1744,78 @@ def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
             endian = f.read(1)
         else:
             # no EXIF information
-            return {}
+            return None
     else:
         # file format not recognized
-        return {}
+        return None
 
     # deal with the EXIF info we found
     if debug:
         print {'I': 'Intel', 'M': 'Motorola'}[endian], 'format'
-    hdr = EXIF_header(f, endian, offset, fake_exif, strict, debug)
+    buffer = None
+    if isinstance(f, mmap.mmap):
+        hdr = EXIF_buffer_header(f, endian, offset, fake_exif, strict, debug)
+    else:
+        buffer = map_file(f)
+        if buffer is not None:
+            hdr = EXIF_buffer_header(buffer, endian, offset, fake_exif,
+                                     strict, debug)
+        else:
+            hdr = EXIF_header(f, endian, offset, fake_exif, strict, debug)
+    return hdr, offset, buffer
+
+# process an image file (expects an open file object)
+# this is the function that has to deal with all the arbitrary nasty bits
+# of the EXIF standard
+def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
+    # yah it's cheesy...
+    global detailed
+    detailed = details
+
+    header = open_header(f, strict, debug)
+    if header is None:
+        return {}
+    hdr, offset, buffer = header
+    try:
+        return process_header(hdr, f, offset, stop_tag, debug)
+    finally:
+        if buffer is not None:
+            buffer.close()
+
+# return only the tags with the given tag IDs, e.g. (0x877A, 0x8778), from
+# the IFDs of an image file, stopping as soon as all of them are found.
+# Only the requested entries are decoded; sub IFDs, MakerNotes and
+# thumbnails are skipped. The keys are the same as from process_file.
+def find_tags(f, tags, strict=False, debug=False):
+    header = open_header(f, strict, debug)
+    if header is None:
+        return {}
+    hdr, offset, buffer = header
+    try:
+        wanted = set(tags)
+        ctr = 0
+        i = hdr.first_IFD()
+        while i and wanted:
+            if ctr == 0:
+                IFD_name = 'Image'
+            elif ctr == 1:
+                IFD_name = 'Thumbnail'
+            else:
+                IFD_name = 'IFD %d' % ctr
+            if debug:
+                print ' IFD %d (%s) at offset %d:' % (ctr, IFD_name, i)
+            hdr.dump_IFD(i, IFD_name, tags=wanted)
+            for tag in hdr.tags.values():
+                wanted.discard(tag.tag)
+            i = hdr.next_IFD(i)
+            ctr += 1
+        return hdr.tags
+    finally:
+        if buffer is not None:
+            buffer.close()
+
+# read the tags of an EXIF header found by open_header
+def process_header(hdr, f, offset, stop_tag='UNDEF', debug=False):
     ifd_list = hdr.list_IFDs()
     ctr = 0
     for i in ifd_list:
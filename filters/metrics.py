@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011-2011, RMIT e-Research Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2011, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+metrics.py
+
+Process wide counters and histograms for the post save filters.
+
+Histograms keep a count, sum, minimum and maximum, and count the values in
+power of two buckets, which is enough to tell a 10ms filter from a 1s one
+without configuring bucket boundaries per metric.
+
+The metrics live in the memory of the process which recorded them; nothing
+is shared between web server processes. Worker pools hand theirs to the
+parent with :func:`collect` and :func:`merge`, so the management commands
+can report the metrics of a whole run.
+
+"""
+import json
+import math
+import threading
+
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+
+
+def incr(name, value=1):
+    """Add ``value`` to the counter ``name``.
+    """
+    _lock.acquire()
+    try:
+        _counters[name] = _counters.get(name, 0) + value
+    finally:
+        _lock.release()
+
+
+def get_counters():
+    """Return a copy of all the counters.
+    """
+    _lock.acquire()
+    try:
+        return dict(_counters)
+    finally:
+        _lock.release()
+
+
+def observe(name, value):
+    """Add ``value`` to the histogram ``name``.
+    """
+    if value > 0:
+        # upper bound of the power of two bucket the value falls in
+        bucket = 2.0 ** math.ceil(math.log(value, 2))
+    else:
+        bucket = 0.0
+    _lock.acquire()
+    try:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = {'count': 0, 'sum': 0,
+                                             'min': value, 'max': value,
+                                             'buckets': {}}
+        histogram['count'] += 1
+        histogram['sum'] += value
+        histogram['min'] = min(histogram['min'], value)
+        histogram['max'] = max(histogram['max'], value)
+        histogram['buckets'][bucket] = histogram['buckets'].get(bucket, 0) + 1
+    finally:
+        _lock.release()
+
+
+def get_histograms():
+    """Return a copy of all the histograms. Bucket keys are the upper bound
+    of the bucket.
+    """
+    _lock.acquire()
+    try:
+        histograms = {}
+        for name, histogram in _histograms.items():
+            histograms[name] = dict(histogram, buckets=dict(histogram['buckets']))
+        return histograms
+    finally:
+        _lock.release()
+
+
+def collect():
+    """Return the counters and histograms and forget them, so that a worker
+    process can hand them to its parent.
+    """
+    _lock.acquire()
+    try:
+        collected = {'counters': dict(_counters),
+                     'histograms': dict(_histograms)}
+        _counters.clear()
+        _histograms.clear()
+        return collected
+    finally:
+        _lock.release()
+
+
+def merge(collected):
+    """Add the metrics returned by :func:`collect` in another process.
+    """
+    _lock.acquire()
+    try:
+        for name, value in collected['counters'].items():
+            _counters[name] = _counters.get(name, 0) + value
+        for name, other in collected['histograms'].items():
+            histogram = _histograms.get(name)
+            if histogram is None:
+                histogram = _histograms[name] = {'count': 0, 'sum': 0,
+                                                 'min': other['min'],
+                                                 'max': other['max'],
+                                                 'buckets': {}}
+            histogram['count'] += other['count']
+            histogram['sum'] += other['sum']
+            histogram['min'] = min(histogram['min'], other['min'])
+            histogram['max'] = max(histogram['max'], other['max'])
+            for bucket, count in other['buckets'].items():
+                histogram['buckets'][bucket] = histogram['buckets'].get(bucket, 0) + count
+    finally:
+        _lock.release()
+
+
+def to_json():
+    """Return the counters and histograms as a JSON document.
+    """
+    histograms = get_histograms()
+    for histogram in histograms.values():
+        histogram['buckets'] = dict(('%g' % bound, count)
+                                    for bound, count in histogram['buckets'].items())
+    return json.dumps({'counters': get_counters(), 'histograms': histograms})
+
+
+def reset():
+    """Forget all the counters and histograms.
+    """
+    _lock.acquire()
+    try:
+        _counters.clear()
+        _histograms.clear()
+    finally:
+        _lock.release()
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011-2011, RMIT e-Research Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2011, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+parsecache.py
+
+On-disk cache of the metadata the filters parse out of files, so extracting
+the metadata of an unchanged file again (backfills, re-saves, re-indexing
+after a schema change) doesn't parse it again.
+
+Entries are JSON files under ``settings.PARSE_CACHE_PATH``, named by a hash
+of the parser and the file's path, size and modification time, so a cached
+result is found without reading the file. Once
+``settings.PARSE_CACHE_MAX_BYTES`` is exceeded the least recently used
+entries are removed. The cache is off when ``PARSE_CACHE_PATH`` isn't set.
+
+"""
+import hashlib
+import json
+import logging
+import os
+
+from django.conf import settings
+
+from tardis.microtardis.filters import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# part of every key, change it when the parsers' results change
+CACHE_VERSION = 2
+
+# bytes written by this process since the cache size was last checked
+_written = 0
+
+
+def get_entry_path(kind, filepath):
+    """Return the path of the cache entry of a file, or None if the cache
+    is off or the file is gone.
+    """
+    root = getattr(settings, 'PARSE_CACHE_PATH', None)
+    if not root:
+        return None
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return None
+    key = hashlib.md5('\0'.join([str(CACHE_VERSION), kind, filepath,
+                                 str(stat.st_size), repr(stat.st_mtime)])).hexdigest()
+    return os.path.join(root, key[:2], key + '.json')
+
+
+def lookup(kind, filepath):
+    """Return the cached result of a parser for a file, or None.
+
+    :param kind: names the parser and its options, e.g. ``'spc'``.
+    :param filepath: the absolute path of the file.
+    """
+    path = get_entry_path(kind, filepath)
+    if path is None:
+        return None
+    result = read_entry(path)
+    if result is None:
+        metrics.incr('parse_cache.miss')
+    else:
+        metrics.incr('parse_cache.hit')
+    return result
+
+
+def store(kind, filepath, result):
+    """Cache the result of a parser for a file.
+
+    :param result: the parser's result, which has to be JSON serializable.
+    """
+    path = get_entry_path(kind, filepath)
+    if path is not None:
+        write_entry(settings.PARSE_CACHE_PATH, path, result)
+
+
+def get_or_parse(kind, filepath, data, parse):
+    """Return the cached result of ``parse(data)`` for a file, parsing and
+    caching it if there is none.
+
+    :param kind: names the parser and its options, e.g. ``'spc'``.
+    :param filepath: the absolute path of the file.
+    :param data: the file contents as returned by
+        :func:`~tardis.microtardis.filters.dispatcher.map_file`.
+    :param parse: the parser, its result has to be JSON serializable.
+    """
+    result = lookup(kind, filepath)
+    if result is None:
+        result = parse(data)
+        store(kind, filepath, result)
+    return result
+
+
+def decode(value):
+    """Turn the unicode strings json returns back into the byte strings the
+    parsers returned.
+    """
+    if isinstance(value, unicode):
+        return value.encode('latin-1')
+    if isinstance(value, list):
+        return [decode(v) for v in value]
+    if isinstance(value, dict):
+        return dict((decode(k), decode(v)) for k, v in value.items())
+    return value
+
+
+def read_entry(path):
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        try:
+            result = decode(json.load(f, encoding='latin-1'))
+        except ValueError:
+            logger.debug("corrupt parse cache entry %s" % path)
+            return None
+    finally:
+        f.close()
+    # the modification time orders the entries for eviction
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+    return result
+
+
+def write_entry(root, path, result):
+    global _written
+    # latin-1 round trips any byte string the parsers return
+    content = json.dumps(result, encoding='latin-1', separators=(',', ':'))
+    tmppath = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        f = open(tmppath, 'wb')
+        try:
+            f.write(content)
+        finally:
+            f.close()
+        os.rename(tmppath, path)
+    except EnvironmentError, e:
+        logger.debug("can't write parse cache entry %s: %s" % (path, e))
+        return
+
+    _written += len(content)
+    max_bytes = getattr(settings, 'PARSE_CACHE_MAX_BYTES', 256 * 1024 * 1024)
+    if _written > max_bytes / 10:
+        _written = 0
+        evict(root, max_bytes)
+
+
+def evict(root, max_bytes, metric='parse_cache.evicted'):
+    """Remove the least recently used entries until the cache takes up at
+    most 90% of ``max_bytes``.
+
+    :param metric: the counter of removed entries.
+    """
+    entries = []
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+    if total <= max_bytes:
+        return
+
+    entries.sort()
+    for mtime, size, path in entries:
+        if total <= max_bytes * 0.9:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        metrics.incr(metric)
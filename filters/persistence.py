@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011-2011, RMIT e-Research Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2011, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+persistence.py
+
+Saves extracted metadata as datafile parameters with as few queries as
+possible: new parameter names and the parameters of a parameter set are
+each written with one bulk insert.
+
+"""
+from fractions import Fraction
+
+from django.db import connection
+from django.db import transaction
+from django.db.models import AutoField
+
+from tardis.tardis_portal.models import DatafileParameterSet
+from tardis.tardis_portal.models import ParameterName, DatafileParameter
+from tardis.microtardis import registry
+from tardis.microtardis.registry import get_parameter_names
+from tardis.microtardis.registry import add_parameter_names
+
+
+def in_transaction(func, *args, **kwargs):
+    """Call ``func`` in a transaction of its own, unless the caller already
+    manages one (a backfill batch or a request under TransactionMiddleware).
+
+    If ``func`` raises, the registry is cleared: the schemas and parameter
+    names it cached in the transaction are rolled back with it.
+    """
+    try:
+        if transaction.is_managed():
+            return func(*args, **kwargs)
+        return transaction.commit_on_success(func)(*args, **kwargs)
+    except Exception:
+        registry.invalidate()
+        raise
+
+
+def bulk_insert(objects):
+    """Insert unsaved model instances of a single class with one query.
+
+    The instances don't get primary keys and no signals are sent.
+    """
+    if not objects:
+        return
+    model = objects[0].__class__
+    if hasattr(model.objects, 'bulk_create'):
+        model.objects.bulk_create(objects)
+        return
+
+    # Django < 1.4 has no bulk_create
+    qn = connection.ops.quote_name
+    fields = [f for f in model._meta.local_fields
+              if not isinstance(f, AutoField)]
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+          qn(model._meta.db_table),
+          ', '.join([qn(f.column) for f in fields]),
+          ', '.join(['%s'] * len(fields)))
+    rows = []
+    for obj in objects:
+        rows.append([f.get_db_prep_save(f.pre_save(obj, True),
+                                        connection=connection)
+                     for f in fields])
+    cursor = connection.cursor()
+    cursor.executemany(sql, rows)
+    transaction.commit_unless_managed()
+
+
+def get_datatype(value):
+    """Return the ParameterName data type for an extracted value.
+    """
+    if isinstance(value, Fraction):
+        return ParameterName.NUMERIC
+    try:
+        float(value)
+    except (ValueError, TypeError):
+        return ParameterName.STRING
+    return ParameterName.NUMERIC
+
+
+def get_parameters(schema, metadata, tagsToFind=[], tagsToExclude=[]):
+    """Return the parameter names the metadata will be saved as, creating
+    the missing ones.
+
+    :param metadata: ``{name: [value, unit]}``
+    :type metadata: dict
+    """
+    param_objects = get_parameter_names(schema)
+    names = []
+    missing = []
+    for p in metadata:
+
+        if tagsToFind and not p in tagsToFind:
+            continue
+
+        if p in tagsToExclude:
+            continue
+
+        names.append(p)
+        if p in param_objects:
+            continue
+
+        unit = ""
+        if metadata[p][1]:
+            unit = metadata[p][1]
+
+        missing.append(ParameterName(schema=schema,
+                                     name=p,
+                                     full_name=p,
+                                     data_type=get_datatype(metadata[p][0]),
+                                     units=unit))
+    if missing:
+        # another process may have created them since they were cached
+        found = list(ParameterName.objects.filter(schema=schema,
+                                  name__in=[p.name for p in missing]))
+        for p in found:
+            param_objects[p.name] = p
+        missing = [p for p in missing if p.name not in param_objects]
+        if missing:
+            bulk_insert(missing)
+            found += list(ParameterName.objects.filter(schema=schema,
+                                  name__in=[p.name for p in missing]))
+            for p in found:
+                param_objects[p.name] = p
+        add_parameter_names(schema, found)
+    return [param_objects[name] for name in names if name in param_objects]
+
+
+def save_parameters(instance, schema, metadata, tagsToFind=[], tagsToExclude=[]):
+    """Save the metadata to the datafile's parameter set of a schema.
+
+    An existing parameter set only gets the parameters it is missing, so
+    re-extraction picks up newly mapped tags without duplicates.
+
+    :param instance: the datafile.
+    :param schema: the schema of the parameter set.
+    :param metadata: ``{name: [value, unit]}``
+    :type metadata: dict
+    :returns: the parameter set, or None if there was nothing to save.
+    """
+    parameters = get_parameters(schema, metadata, tagsToFind, tagsToExclude)
+    if not parameters:
+        return None
+
+    (ps, created) = DatafileParameterSet.objects.get_or_create(schema=schema, dataset_file=instance)
+    existing = set()
+    if not created:
+        existing = set(ps.datafileparameter_set.values_list('name', flat=True))
+
+    new_parameters = []
+    for p in parameters:
+        if p.name in metadata and p.id not in existing:
+            dfp = DatafileParameter(parameterset=ps,
+                                    name=p)
+            if p.isNumeric():
+                dfp.numerical_value = metadata[p.name][0]
+            else:
+                dfp.string_value = metadata[p.name][0]
+            new_parameters.append(dfp)
+    bulk_insert(new_parameters)
+    return ps
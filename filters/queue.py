@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011-2011, RMIT e-Research Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2011, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+queue.py
+
+Database backed job queue for the post save filters. When
+``settings.FILTER_QUEUE_ENABLED`` is set, saving a datafile only records a
+:class:`~tardis.microtardis.models.Filter_Job`; the ``run_filter_queue``
+management command claims the jobs and runs the filters in worker processes.
+
+"""
+import logging
+from datetime import datetime
+from datetime import timedelta
+
+from django.conf import settings
+
+from tardis.tardis_portal.models import Dataset_File
+from tardis.microtardis.models import Filter_Job
+
+
+logger = logging.getLogger(__name__)
+
+# filters are loaded once per worker process
+_hooks = None
+
+
+def get_hooks():
+    global _hooks
+    if _hooks is None:
+        from tardis.microtardis.filters import get_post_save_hooks
+        _hooks = get_post_save_hooks()
+    return _hooks
+
+
+def enqueue_job(sender, **kwargs):
+    """post save callback which queues the filters for the saved datafile.
+
+    :param sender: The model class.
+    :param instance: The actual instance being saved.
+    :param created: A boolean; True if a new record was created.
+    :type created: bool
+    """
+    instance = kwargs.get('instance')
+    created = kwargs.get('created', False)
+
+    # the filters read the file when the job runs, so one pending job per
+    # datafile covers any number of saves
+    pending = Filter_Job.objects.filter(datafile=instance,
+                                        status=Filter_Job.PENDING)
+    if pending.exists():
+        return
+    Filter_Job(datafile=instance, created=created).save()
+    logger.debug("queued filter job for datafile %s" % instance.id)
+
+
+def requeue_stale_jobs():
+    """Put jobs which have been running for longer than
+    ``settings.FILTER_QUEUE_STALE_SECONDS`` back in the queue; their runner
+    has most likely died.
+    """
+    stale_seconds = getattr(settings, 'FILTER_QUEUE_STALE_SECONDS', 3600)
+    cutoff = datetime.now() - timedelta(seconds=stale_seconds)
+    requeued = Filter_Job.objects.filter(status=Filter_Job.RUNNING,
+                                         updated_time__lt=cutoff) \
+                                 .update(status=Filter_Job.PENDING)
+    if requeued:
+        logger.warning("requeued %d stale filter jobs" % requeued)
+    return requeued
+
+
+def claim_jobs(limit):
+    """Mark up to ``limit`` pending jobs as running and return their ids.
+
+    A job is only claimed if it is still pending when it is updated, so
+    several queue runners can share the table. Stale running jobs are
+    requeued first.
+    """
+    requeue_stale_jobs()
+    candidates = Filter_Job.objects.filter(status=Filter_Job.PENDING) \
+                                   .order_by('id') \
+                                   .values_list('id', flat=True)[:limit]
+    claimed = []
+    for job_id in list(candidates):
+        updated = Filter_Job.objects.filter(pk=job_id,
+                                            status=Filter_Job.PENDING) \
+                                    .update(status=Filter_Job.RUNNING,
+                                            updated_time=datetime.now())
+        if updated:
+            claimed.append(job_id)
+    return claimed
+
+
+def run_job(job_id):
+    """Run every configured filter for a claimed job and record the outcome.
+
+    A job fails if a filter raises, or its file can't be read; it goes back
+    to pending until it has been attempted
+    ``settings.FILTER_QUEUE_MAX_ATTEMPTS`` times. Returns None if the job
+    has been deleted, e.g. together with its datafile.
+    """
+    max_attempts = getattr(settings, 'FILTER_QUEUE_MAX_ATTEMPTS', 3)
+    try:
+        job = Filter_Job.objects.get(pk=job_id)
+    except Filter_Job.DoesNotExist:
+        logger.debug("filter job %s no longer exists" % job_id)
+        return None
+    job.attempts += 1
+    try:
+        for path, hook in get_hooks():
+            hook(sender=Dataset_File, instance=job.datafile,
+                 created=job.created, raise_errors=True)
+    except Exception, e:
+        logger.exception("filter job %s failed" % job_id)
+        job.last_error = repr(e)
+        if job.attempts < max_attempts:
+            job.status = Filter_Job.PENDING
+        else:
+            job.status = Filter_Job.FAILED
+    else:
+        job.status = Filter_Job.DONE
+        job.last_error = ''
+    job.save()
+    return job.status
+
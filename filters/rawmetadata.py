@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011-2011, RMIT e-Research Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2011, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+rawmetadata.py
+
+Keeps the raw instrument metadata the filters read out of a datafile in
+:class:`~tardis.microtardis.models.Datafile_Raw_Metadata`, so parameters
+added to a schema later can be derived from it without reading the file.
+
+Filters take part by defining ``raw_kinds``, the kinds of raw metadata they
+store, and a ``remap(instance, instrument, kind, raw)`` method which saves
+the parameters derived from it.
+
+"""
+import base64
+import logging
+import zlib
+
+from django.db import transaction
+
+from tardis.microtardis.models import Datafile_Raw_Metadata
+from tardis.microtardis.spectra.cache import invalidate
+
+
+logger = logging.getLogger(__name__)
+
+# {kind: filter}, loaded once per process
+_filters = None
+
+
+def get_remap_filters():
+    global _filters
+    if _filters is None:
+        from tardis.microtardis.filters import load_filters
+        _filters = {}
+        for path, f in load_filters():
+            if hasattr(f, 'remap'):
+                for kind in f.raw_kinds:
+                    _filters[kind] = f
+    return _filters
+
+
+def encode(raw):
+    return base64.b64encode(zlib.compress(raw))
+
+
+def decode(data):
+    return zlib.decompress(base64.b64decode(data))
+
+
+def store_raw_metadata(instance, kind, instrument, raw):
+    """Store the raw metadata of a datafile, once.
+
+    :param instance: the datafile.
+    :param kind: what the metadata is, e.g. ``'Image Tag 0x877A'``.
+    :param instrument: the name of the instrument the datafile came from.
+    :param raw: the metadata.
+    :type raw: string
+    """
+    data = encode(raw)
+    try:
+        record = Datafile_Raw_Metadata.objects.get(datafile=instance, kind=kind)
+    except Datafile_Raw_Metadata.DoesNotExist:
+        record = Datafile_Raw_Metadata(datafile=instance, kind=kind)
+    else:
+        if record.data == data and record.instrument == instrument:
+            return record
+    record.instrument = instrument
+    record.data = data
+    record.save()
+    return record
+
+
+def select_raw_metadata(kinds=None, instrument=None):
+    """Return the ids of the stored raw metadata of some kinds and/or from
+    an instrument, in ascending order.
+    """
+    records = Datafile_Raw_Metadata.objects.all()
+    if kinds:
+        records = records.filter(kind__in=kinds)
+    if instrument:
+        records = records.filter(instrument=instrument)
+    return list(records.order_by('id').values_list('id', flat=True))
+
+
+def remap(record_ids):
+    """Save the parameters derived from stored raw metadata, in a single
+    transaction. Parameters a datafile already has are left alone.
+
+    :returns: the number of records remapped.
+    """
+    filters = get_remap_filters()
+    count = 0
+    with transaction.commit_on_success():
+        records = Datafile_Raw_Metadata.objects.filter(id__in=record_ids) \
+                                               .select_related('datafile')
+        for record in records:
+            f = filters.get(record.kind)
+            if f is None:
+                logger.debug("no filter remaps %s" % record.kind)
+                continue
+            f.remap(record.datafile, record.instrument, record.kind,
+                    decode(record.data))
+            invalidate(record.datafile_id)
+            count += 1
+    return count
@@ -38,18 +38,51 @@ spctags.py
 
 """
 
-from tardis.tardis_portal.models import Schema, DatafileParameterSet
-from tardis.tardis_portal.models import ParameterName, DatafileParameter
-from tardis.tardis_portal.models import DatasetParameter
+from tardis.tardis_portal.models import Schema
+from tardis.microtardis.registry import get_or_create_schema
+from tardis.microtardis.filters.dispatcher import map_file
+from tardis.microtardis.filters.instruments import get_instrument
+from tardis.microtardis.filters.parsecache import get_or_parse
+from tardis.microtardis.filters.persistence import save_parameters
+from tardis.microtardis.filters.persistence import get_parameters
+from tardis.microtardis.filters.rawmetadata import store_raw_metadata
 import logging
+import StringIO
 import struct
-import string
 
 from django.conf import settings
 
 
 logger = logging.getLogger(__name__)
 
+
+def compile_layout(fields):
+    """Turn the ``fields`` of the filter into a list of
+    (offset, field name, unpacker, rounded digits, unit) in file order. The
+    unpacker is a :class:`struct.Struct`, or None for NULL-terminated
+    strings.
+    """
+    layout = []
+    for offset in sorted(fields):
+        (field, format, rounded_digits, unit) = fields[offset]
+        if format == 'c':
+            unpacker = None
+        else:
+            unpacker = struct.Struct(format)
+        layout.append((offset, field, unpacker, rounded_digits, unit))
+    return layout
+
+
+def read_string(header, offset, terminator):
+    """Return the NULL-terminated string at ``offset``, or "" if there is
+    no terminator before the end of its line.
+    """
+    end = header.find(terminator, offset)
+    newline = header.find('\n', offset)
+    if end <= offset or (newline != -1 and newline < end):
+        return ""
+    return header[offset:end]
+
 class SPCTagsFilter(object):
     """This filter provides extraction of metadata extraction of 
     EDAX Genesis spectral files (*.spc) from the RMMF.
@@ -66,6 +99,14 @@ class SPCTagsFilter(object):
     :param tagsToExclude: a list of the tags to exclude.
     :type tagsToExclude: list of strings
     """
+    # file types handled by this filter, see filters.dispatcher
+    extensions = ('.spc',)
+    magic = None
+    # the raw metadata kept for remap, see filters.rawmetadata; the header
+    # is everything before the channel counts
+    raw_kinds = ('SPC header',)
+    header_size = 3840
+
     def __init__(self, name, schema, tagsToFind=[], tagsToExclude=[]):
         self.name = name
         self.schema = schema
@@ -74,14 +115,6 @@ class SPCTagsFilter(object):
         
         # NULL-terminated string, the byte value is HEX 0
         self.terminator = '\x00'
-        # binary computing format and size.
-        # example: binary_format = {"format": ("type", size)}
-        self.binary_format = {"c": ("char",   1),
-                              "f": ("float",  4),
-                              "d": ("double", 8),
-                              "h": ("short",  2),
-                              "l": ("long",   4),
-                              }
         # shown spectral fields
         # example: fields = {offset: ("field name", 
         #                             "binary format", 
@@ -93,6 +126,14 @@ class SPCTagsFilter(object):
                        532: ("Acc. Voltage",               "f",    3, "kV"),
                        638: ("Number of Peak ID Elements", "h",    0, None),
                        }
+        # the peak ID tables, one value per peak
+        # example: peak_tables = {"table": (offset, "binary format")}
+        self.peak_tables = {"atomic": (640,  "h"),
+                            "line":   (736,  "h"),
+                            "energy": (832,  "f"),
+                            "height": (1024, "I"),
+                            }
+        self.layout = compile_layout(self.fields)
         
         # Atomic elements from http://en.wikipedia.org/wiki/List_of_elements
         # example: atomic_elements = {atomic_number: "atomic_symbol"}
@@ -143,27 +184,27 @@ class SPCTagsFilter(object):
         #ignore non-spectra file
         if filepath[-4:].lower() != ".spc":
             return
+
+        data = map_file(filepath)
+        if data is None:
+            return
+        try:
+            self.process(instance, filepath, data)
+        finally:
+            data.close()
+
+    def process(self, instance, filepath, data):
+        """Extract the metadata of a datafile from its contents.
+
+        :param instance: The datafile being saved.
+        :param filepath: The absolute path of the datafile.
+        :param data: The file contents as returned by
+            :func:`~tardis.microtardis.filters.dispatcher.map_file`.
+        :returns: the name of the instrument whose metadata was extracted,
+            or None if the file was skipped.
+        """
         
-        # Find instrument name in filepath
-        instr_name = None 
-        import re
-        pathSep = re.compile(r'\\|\/')
-        for part in pathSep.split(filepath):
-            if part in self.instruments.keys():
-                instr_name = part
-                
-        # Find instrument name in dataset metadata
-        if not instr_name:
-            # couldn't find it in filepath, then try dataset metadata
-            dataset_params = DatasetParameter.objects.filter(parameterset__dataset__id=instance.dataset.id)
-            for dataset_param in dataset_params:
-                str_value = str(dataset_param.string_value)
-                if str_value.startswith('http://'):
-                    parts = str_value.split('/')
-                    if len(parts) > 4:
-                        instr_name = parts[4]
-                else:
-                    continue
+        instr_name = get_instrument(instance, filepath, self.instruments)
 
         logger.debug("filepath=%s" % filepath)
         logger.debug("instr_name=%s" % instr_name)
@@ -171,101 +212,65 @@ class SPCTagsFilter(object):
         if (instr_name != None and len(instr_name) > 1):
             
             # get spectral metadata 
-            metadata = self.getSpectra(filepath)
+            metadata = get_or_parse('spc', filepath, data, self.getSpectra)
+            store_raw_metadata(instance, 'SPC header', instr_name,
+                               data[:self.header_size])
         
-            # get schema (create schema if needed)
-            instrSchemas = self.instruments[instr_name]
-            schema_name = "EDAXGenesis_SPC"
-            for sch in instrSchemas:
-                if sch[0] == schema_name:
-                    (schemaName, schemaSuffix, tagsToFind) = sch
-            if not schemaName:
-                logger.debug("Schema %s doesn't exist for instrument %s" % (schema_name, instr_name))
-                return
-            instrNamespace = ''.join([self.schema, "/" , schemaSuffix]) 
-            (schema, created) = Schema.objects.get_or_create(namespace=instrNamespace, name=schemaName,type=Schema.DATAFILE)
-            if created: # new object was created
-                schema.save()
-                
-            # save spectral metadata
-            self.saveSpectraMetadata(instance, schema, metadata)
+            if self.saveInstrumentMetadata(instance, instr_name, metadata):
+                return instr_name
+
+    def remap(self, instance, instrument, kind, raw):
+        """Derive the parameters of a datafile from its stored raw metadata.
+
+        :param instance: the datafile.
+        :param instrument: the name of the instrument.
+        :param kind: one of :attr:`raw_kinds`.
+        :param raw: the header of the spectrum.
+        """
+        if instrument in self.instruments:
+            metadata = self.getSpectra(StringIO.StringIO(raw))
+            self.saveInstrumentMetadata(instance, instrument, metadata)
+
+    def saveInstrumentMetadata(self, instance, instr_name, metadata):
+        """Save the spectral metadata in the instrument's schema.
+
+        :returns: the schema, or None if the instrument has no SPC schema.
+        """
+        # get schema (create schema if needed)
+        instrSchemas = self.instruments[instr_name]
+        schema_name = "EDAXGenesis_SPC"
+        for sch in instrSchemas:
+            if sch[0] == schema_name:
+                (schemaName, schemaSuffix, tagsToFind) = sch
+        if not schemaName:
+            logger.debug("Schema %s doesn't exist for instrument %s" % (schema_name, instr_name))
+            return
+        instrNamespace = ''.join([self.schema, "/" , schemaSuffix]) 
+        schema = get_or_create_schema(instrNamespace, schemaName)
+            
+        # save spectral metadata
+        self.saveSpectraMetadata(instance, schema, metadata)
+        return schema
+
+    def read_peak_table(self, header, table, number_of_peak):
+        """Return the first ``number_of_peak`` values of a peak ID table.
+        """
+        if number_of_peak <= 0:
+            return ()
+        offset, format = self.peak_tables[table]
+        return struct.unpack_from('%d%s' % (number_of_peak, format), header, offset)
 
     def saveSpectraMetadata(self, instance, schema, metadata):
         """Save all the metadata to a Dataset_Files paramamter set.
         """
-        parameters = self.getParamaters(schema, metadata)
-        if not parameters:
-            return None
-        
-        (ps, created) = DatafileParameterSet.objects.get_or_create(schema=schema, dataset_file=instance)
-        if created: # new object was created
-            ps.save()
-        else: # if parameter set already exists then just return it
-            return ps 
-
-        # save datafile parameters
-        for p in parameters:
-            if p.name in metadata:
-                dfp = DatafileParameter(parameterset=ps,
-                                        name=p)
-                if p.isNumeric():
-                    dfp.numerical_value = metadata[p.name][0]
-                else:
-                    dfp.string_value = metadata[p.name][0]
-                dfp.save()
-                
-        return ps
+        return save_parameters(instance, schema, metadata,
+                               self.tagsToFind, self.tagsToExclude)
 
     def getParamaters(self, schema, metadata):
         """Return a list of the paramaters that will be saved.
         """
-        param_objects = ParameterName.objects.filter(schema=schema)
-        parameters = []
-        for p in metadata:
-
-            if self.tagsToFind and not p in self.tagsToFind:
-                continue
-
-            if p in self.tagsToExclude:
-                continue
-
-            parameter = filter(lambda x: x.name == p, param_objects)
-
-            if parameter:
-                parameters.append(parameter[0])
-                continue
-
-            # detect type of parameter
-            datatype = ParameterName.STRING
-             
-            # integer data type test
-            try:
-                int(metadata[p][0])
-            except (ValueError, TypeError):
-                pass
-            else:
-                datatype = ParameterName.NUMERIC
-            
-            # float data type test
-            try:
-                float(metadata[p][0])
-            except (ValueError, TypeError):
-                pass
-            else:
-                datatype = ParameterName.NUMERIC
-
-            unit = ""
-            if metadata[p][1]:
-                unit = metadata[p][1]
-      
-            new_param = ParameterName(schema=schema,
-                                      name=p,
-                                      full_name=p,
-                                      data_type=datatype,
-                                      units=unit)
-            new_param.save()
-            parameters.append(new_param)
-        return parameters
+        return get_parameters(schema, metadata,
+                              self.tagsToFind, self.tagsToExclude)
 
     def getSchema(self):
         """Return the schema object that the paramaterset will use.
@@ -283,49 +288,29 @@ class SPCTagsFilter(object):
 
     def getSpectra(self, filename):
         """Return a dictionary of the metadata.
+
+        :param filename: the path of the spectra file, or its file object.
         """
         logger.debug("Extracting spectral metadata from *.spc file...")
         ret = {}
         try:
-            spc = open(filename)
-            offsets = self.fields.keys()
-            offsets.sort()
-            for offset in offsets:
-                
-                # get field
-                field = self.fields[offset][0]
-                
-                # get value
-                spc.seek(offset)
-                field_name = self.fields[offset][0]
-                format = self.fields[offset][1]
-                rounded_digits = self.fields[offset][2]
-                unit = self.fields[offset][3]
-                byte_size = self.binary_format[format][1]
-                if format == 'c': # extract strings
-                    value_string = spc.next()
-                    string_length = value_string.find('\x00')
-                    value = ""
-                    if string_length > 0:
-                        spc.seek(offset)
-                        value_tuple = struct.unpack(format * string_length, spc.read(byte_size * string_length))
-                        value = string.join(value_tuple,"")
-                elif field_name == "Number of Peak ID Elements": # extract atomic peak numbers
-                    number_of_peak = struct.unpack(format, spc.read(byte_size))[0]
-                    atomic_offset = offset + 2 # should be 640 for the beginning offset of atomic numbers
-                    line_offset = 736 # the beginning offset of line numbers
-                    energy_offset = 832 # the beginning offset of energy numbers
-                    height_offset = 1024 # the beginning offset of height numbers
-                    energy_step = 0
-                    height_step = 0
-                    for peak_offset in range(atomic_offset, atomic_offset+number_of_peak*2, 2):
-                        # Atomic
-                        spc.seek(peak_offset)
-                        atomic_value = struct.unpack(format, spc.read(byte_size))[0]
-                        
-                        # Line
-                        spc.seek(line_offset+peak_offset-atomic_offset)
-                        line_value = struct.unpack(format, spc.read(byte_size))[0]
+            if isinstance(filename, basestring):
+                spc = open(filename, 'rb')
+            else:
+                spc = filename
+            # everything is in the header, read it once
+            spc.seek(0)
+            header = spc.read(self.header_size)
+
+            for (offset, field, unpacker, rounded_digits, unit) in self.layout:
+                if unpacker is None: # extract strings
+                    value = read_string(header, offset, self.terminator)
+                elif field == "Number of Peak ID Elements": # extract atomic peak numbers
+                    number_of_peak = unpacker.unpack_from(header, offset)[0]
+                    peaks = [self.read_peak_table(header, table, number_of_peak)
+                             for table in ('atomic', 'line', 'energy', 'height')]
+                    for i, (atomic_value, line_value, energy_value, height_value) \
+                            in enumerate(zip(*peaks)):
                         if line_value < 6: # K shells: 1-5
                             line_value = 1
                         elif line_value >= 6 and line_value <16: # L shells: 6-15
@@ -333,28 +318,16 @@ class SPCTagsFilter(object):
                         else: # M shells: 16~
                             line_value = 16
                         
-                        # Energy
-                        spc.seek(energy_offset + energy_step)
-                        energy_value = struct.unpack('f', spc.read(4))[0]
-                        energy_step += 4
-                        
-                        # Height
-                        #print "offset ", height_offset + height_step
-                        spc.seek(height_offset + height_step)
-                        height_value = struct.unpack('I', spc.read(4))[0]
-                        #print "height_value ", height_value
-                        height_step += 4
-                        
                         # compose the peak value
                         value = "Atomic=%s, Line=%s, Energy=%.4f, Height=%d" % \
                                 (self.atomic_elements[int(atomic_value)], 
                                  self.shells[line_value], 
                                  energy_value, 
                                  height_value)
-                        ret["Peak ID Element %s" % ((peak_offset-atomic_offset)/2+1)] = [value, unit]
+                        ret["Peak ID Element %s" % (i + 1)] = [value, unit]
                     continue
                 else: # extract numbers
-                    value = round( struct.unpack(format, spc.read(byte_size))[0], rounded_digits)
+                    value = round(unpacker.unpack_from(header, offset)[0], rounded_digits)
                 
                 # change field names
                 if field == 'Preset':
@@ -362,13 +335,9 @@ class SPCTagsFilter(object):
                 
                 # get field and its value
                 ret[field] = [value, unit]
-        except:
-            #print "Failed to extract spectral metadata from *.spc file."
-            import sys
-            #print sys.exc_info()
-            #print ret
+        except Exception:
             logger.debug("Failed to extract spectral metadata from *.spc file.")
-            return ret
+            raise
         
         logger.debug("Successed extracting spectral metadata from *.spc file.")
         return ret
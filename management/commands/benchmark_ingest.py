@@ -0,0 +1,191 @@
+"""
+Measures the ingest throughput of the post save filters.
+
+The sample files in testing/ and docs/_static/ are linked into a synthetic
+experiment of --files datafiles, which are saved and run through the
+configured filters like an ingest. Run it against a scratch database
+(SQLite, or a local MySQL copy of production) -- the experiment is deleted
+afterwards unless --keep is given.
+
+Usage: bin/django benchmark_ingest [--files N] [--dataset-size N]
+           [--output baseline.json] [--compare baseline.json]
+"""
+import json
+import os
+import resource
+import shutil
+import tempfile
+import time
+from datetime import datetime
+from optparse import make_option
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connection
+
+from tardis.tardis_portal import models
+from tardis.microtardis.filters import get_post_save_hooks
+from tardis.microtardis.filters.dispatcher import FilterDispatcher
+
+
+here = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
+
+# (instrument, sample file); the instrument directory in the path is how
+# the filters find the instrument
+SAMPLES = [('Quanta200', os.path.join(here, 'testing/Quanta200/test.tif')),
+           ('Quanta200', os.path.join(here, 'testing/Quanta200/test.spc')),
+           ('NovaNanoSEM', os.path.join(here, 'testing/NovaNanoSEM/test.tif')),
+           ('NovaNanoSEM', os.path.join(here, 'testing/NovaNanoSEM/test.spc')),
+           ('XL30', os.path.join(here, 'docs/_static/XL30.tif')),
+           ('XL30', os.path.join(here, 'docs/_static/XL30.dat')),
+           ]
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int(round(p * (len(values) - 1)))]
+
+
+def link_sample(sample, target):
+    try:
+        os.link(sample, target)
+    except (OSError, AttributeError):
+        shutil.copyfile(sample, target)
+
+
+class Command(BaseCommand):
+    help = "Measures files/s, queries per file, peak memory and per filter " \
+           "latency of metadata extraction over a synthetic experiment."
+    option_list = BaseCommand.option_list + (
+        make_option('--files', type='int', dest='files', default=1000,
+                    help='Number of datafiles to ingest'),
+        make_option('--dataset-size', type='int', dest='dataset_size',
+                    default=500,
+                    help='Number of datafiles per dataset'),
+        make_option('--workdir', dest='workdir', default=None,
+                    help='Directory for the sample file links'),
+        make_option('--output', dest='output', default=None,
+                    help='Write the results to this JSON file'),
+        make_option('--compare', dest='compare', default=None,
+                    help='Compare the results with this JSON file'),
+        make_option('--keep', action='store_true', dest='keep',
+                    default=False,
+                    help="Don't delete the experiment afterwards"),
+        )
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['compare']:
+            if not os.path.exists(options['compare']):
+                raise CommandError('%s does not exist' % options['compare'])
+            baseline = json.load(open(options['compare']))
+
+        workdir = options['workdir'] or tempfile.mkdtemp(prefix='benchmark_ingest')
+        for instrument, sample in SAMPLES:
+            if not os.path.isdir(os.path.join(workdir, instrument)):
+                os.makedirs(os.path.join(workdir, instrument))
+
+        user, created = User.objects.get_or_create(username='benchmark_ingest')
+        experiment = models.Experiment(title='benchmark_ingest %s' % datetime.now(),
+                                       institution_name='benchmark',
+                                       approved=True,
+                                       created_by=user,
+                                       public=False)
+        experiment.save()
+
+        hooks = get_post_save_hooks()
+        dispatchers = [hook for path, hook in hooks
+                       if isinstance(hook, FilterDispatcher)]
+
+        # count queries without turning on DEBUG for the whole process
+        connection.use_debug_cursor = True
+        latencies = {}
+        queries = 0
+        elapsed = 0.0
+        dataset = None
+        try:
+            for i in range(options['files']):
+                if i % options['dataset_size'] == 0:
+                    dataset = models.Dataset(experiment=experiment,
+                                             description='benchmark dataset %d' % i)
+                    dataset.save()
+
+                instrument, sample = SAMPLES[i % len(SAMPLES)]
+                filename = '%d_%s' % (i, os.path.basename(sample))
+                filepath = os.path.join(workdir, instrument, filename)
+                link_sample(sample, filepath)
+                datafile = models.Dataset_File(dataset=dataset,
+                                               filename=filename,
+                                               url=filepath,
+                                               protocol='staging',
+                                               size=str(os.path.getsize(filepath)))
+                datafile.save()
+
+                # the filter for this file type, for the latency breakdown
+                name = 'other'
+                for dispatcher in dispatchers:
+                    candidates = dispatcher.get_filters(filepath)
+                    if candidates:
+                        name = candidates[0].name
+
+                del connection.queries[:]
+                start = time.time()
+                for path, hook in hooks:
+                    hook(sender=models.Dataset_File, instance=datafile,
+                         created=True)
+                latency = time.time() - start
+                elapsed += latency
+                queries += len(connection.queries)
+                latencies.setdefault(name, []).append(latency)
+        finally:
+            connection.use_debug_cursor = None
+            if not options['keep']:
+                experiment.delete()
+                if not options['workdir']:
+                    shutil.rmtree(workdir)
+
+        files = options['files']
+        results = {'date': datetime.now().isoformat(),
+                   'database': settings.DATABASES['default']['ENGINE'],
+                   'files': files,
+                   'files_per_second': files / max(elapsed, 0.000001),
+                   'queries_per_file': float(queries) / max(files, 1),
+                   'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   'filters': {},
+                   }
+        for name, values in latencies.items():
+            results['filters'][name] = {
+                'files': len(values),
+                'p50_ms': percentile(values, 0.5) * 1000,
+                'p99_ms': percentile(values, 0.99) * 1000,
+                }
+
+        self.report(results, baseline)
+        if options['output']:
+            f = open(options['output'], 'w')
+            try:
+                json.dump(results, f, indent=2, sort_keys=True)
+            finally:
+                f.close()
+
+    def report(self, results, baseline):
+        def line(label, key, values, base):
+            text = "%-28s %10.2f" % (label, values[key])
+            if base and base.get(key):
+                change = (values[key] - base[key]) * 100.0 / base[key]
+                text += "  (%+.1f%%)" % change
+            self.stdout.write(text + "\n")
+
+        line("files/s", 'files_per_second', results, baseline)
+        line("queries/file", 'queries_per_file', results, baseline)
+        line("peak RSS (KB)", 'peak_rss_kb', results, baseline)
+        for name in sorted(results['filters']):
+            base = None
+            if baseline:
+                base = baseline.get('filters', {}).get(name)
+            line("%s p50 (ms)" % name, 'p50_ms', results['filters'][name], base)
+            line("%s p99 (ms)" % name, 'p99_ms', results['filters'][name], base)
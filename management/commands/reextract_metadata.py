@@ -0,0 +1,117 @@
+"""
+Re-runs the metadata extraction filters over stored datafiles.
+
+Usage: bin/django reextract_metadata [--experiment ID] [--dataset ID]
+           [--instrument NAME] [--since YYYY-MM-DD] [--until YYYY-MM-DD]
+           [--processes N] [--batch-size N] [--checkpoint FILE] [--metrics]
+"""
+import os
+import time
+from itertools import izip
+from datetime import datetime
+from datetime import timedelta
+from multiprocessing import Pool
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connection
+
+from tardis.microtardis.filters import metrics
+from tardis.microtardis.filters.backfill import select_datafiles
+from tardis.microtardis.filters.backfill import reextract
+
+
+def reextract_collecting_metrics(datafile_ids):
+    """Re-extract a batch in a worker and hand its metrics back to the
+    parent.
+    """
+    return reextract(datafile_ids), metrics.collect()
+
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise CommandError('"%s" is not a YYYY-MM-DD date' % value)
+
+
+class Command(BaseCommand):
+    help = "Re-runs the metadata extraction filters over stored datafiles."
+    option_list = BaseCommand.option_list + (
+        make_option('--experiment', type='int', action='append',
+                    dest='experiments', default=[],
+                    help='Only datafiles of this experiment (repeatable)'),
+        make_option('--dataset', type='int', action='append',
+                    dest='datasets', default=[],
+                    help='Only datafiles of this dataset (repeatable)'),
+        make_option('--instrument', dest='instrument', default=None,
+                    help='Only datafiles harvested from this instrument'),
+        make_option('--since', dest='since', default=None,
+                    help='Only datafiles harvested on or after this date'),
+        make_option('--until', dest='until', default=None,
+                    help='Only datafiles harvested on or before this date'),
+        make_option('--processes', type='int', dest='processes', default=4,
+                    help='Number of worker processes'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=50,
+                    help='Number of datafiles per transaction'),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+                    help='File recording progress; an interrupted run '
+                         'resumes from it'),
+        make_option('--metrics', action='store_true', dest='metrics',
+                    default=False,
+                    help='Print the filter metrics of all the workers as '
+                         'JSON when done'),
+        )
+
+    def handle(self, *args, **options):
+        since = until = None
+        if options['since']:
+            since = parse_date(options['since'])
+        if options['until']:
+            # the whole day is included
+            until = parse_date(options['until']) + timedelta(days=1)
+
+        datafile_ids = select_datafiles(experiments=options['experiments'],
+                                        datasets=options['datasets'],
+                                        instrument=options['instrument'],
+                                        since=since, until=until)
+
+        checkpoint = options['checkpoint']
+        if checkpoint and os.path.exists(checkpoint):
+            last_id = int(open(checkpoint).read().strip() or 0)
+            datafile_ids = [i for i in datafile_ids if i > last_id]
+            self.stdout.write("resuming after datafile %d\n" % last_id)
+
+        size = options['batch_size']
+        batches = [datafile_ids[i:i + size]
+                   for i in range(0, len(datafile_ids), size)]
+
+        # the workers must not inherit this process's database connection
+        connection.close()
+        pool = Pool(options['processes'])
+        total = len(datafile_ids)
+        done = 0
+        start = time.time()
+        try:
+            # results come back in order, so everything up to the last id
+            # of a finished batch has been processed
+            for batch, (count, collected) in izip(batches,
+                    pool.imap(reextract_collecting_metrics, batches)):
+                done += count
+                metrics.merge(collected)
+                if checkpoint:
+                    f = open(checkpoint, 'w')
+                    try:
+                        f.write("%d\n" % batch[-1])
+                    finally:
+                        f.close()
+                elapsed = time.time() - start
+                self.stdout.write("%d/%d datafiles, %.1f files/s\n" % (
+                                  done, total, done / max(elapsed, 0.001)))
+        finally:
+            pool.close()
+            pool.join()
+            if options['metrics']:
+                self.stdout.write(metrics.to_json() + "\n")
@@ -0,0 +1,41 @@
+"""
+Derives the parameters of datafiles from their stored raw metadata, without
+reading the files. Run it after adding a field to a filter's tag lists.
+
+Usage: bin/django remap_metadata [--kind KIND] [--instrument NAME]
+           [--batch-size N]
+"""
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from tardis.microtardis.filters.rawmetadata import select_raw_metadata
+from tardis.microtardis.filters.rawmetadata import remap
+
+
+class Command(BaseCommand):
+    help = "Derives datafile parameters from the stored raw metadata."
+    option_list = BaseCommand.option_list + (
+        make_option('--kind', action='append', dest='kinds', default=[],
+                    help='Only raw metadata of this kind, e.g. '
+                         '"Image Tag 0x877A" or "SPC header" (repeatable)'),
+        make_option('--instrument', dest='instrument', default=None,
+                    help='Only raw metadata from this instrument'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=500,
+                    help='Number of datafiles per transaction'),
+        )
+
+    def handle(self, *args, **options):
+        record_ids = select_raw_metadata(kinds=options['kinds'],
+                                         instrument=options['instrument'])
+        size = options['batch_size']
+        total = len(record_ids)
+        done = 0
+        start = time.time()
+        for i in range(0, total, size):
+            done += remap(record_ids[i:i + size])
+            elapsed = time.time() - start
+            self.stdout.write("%d/%d datafiles, %.1f files/s\n" % (
+                              done, total, done / max(elapsed, 0.001)))
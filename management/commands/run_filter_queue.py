@@ -0,0 +1,93 @@
+"""
+Runs the post save filters queued in the Filter_Job table.
+
+Usage: bin/django run_filter_queue [--processes N] [--batch-size N] [--once]
+           [--metrics]
+"""
+import logging
+import time
+from multiprocessing import Pool
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from tardis.microtardis.models import Filter_Job
+from tardis.microtardis.filters import metrics
+from tardis.microtardis.filters.queue import claim_jobs
+from tardis.microtardis.filters.queue import run_job
+
+
+logger = logging.getLogger(__name__)
+
+
+def run_job_collecting_metrics(job_id):
+    """Run a job in a worker and hand its metrics back to the parent.
+    """
+    return run_job(job_id), metrics.collect()
+
+
+class Command(BaseCommand):
+    help = "Runs the queued post save filters in a pool of worker processes."
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', dest='processes',
+                    default=getattr(settings, 'FILTER_QUEUE_PROCESSES', 4),
+                    help='Number of worker processes'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=100,
+                    help='Number of jobs claimed at a time'),
+        make_option('--interval', type='float', dest='interval',
+                    default=5.0,
+                    help='Seconds to wait when the queue is empty'),
+        make_option('--once', action='store_true', dest='once',
+                    default=False,
+                    help='Exit when the queue is empty'),
+        make_option('--requeue-running', action='store_true',
+                    dest='requeue_running', default=False,
+                    help='Put jobs left running by a dead runner back '
+                         'in the queue before starting'),
+        make_option('--metrics', action='store_true', dest='metrics',
+                    default=False,
+                    help='Print the filter metrics of all the workers as '
+                         'JSON when exiting'),
+        )
+
+    def handle(self, *args, **options):
+        if options['requeue_running']:
+            Filter_Job.objects.filter(status=Filter_Job.RUNNING) \
+                              .update(status=Filter_Job.PENDING)
+
+        # the workers must not inherit this process's database connection,
+        # so it is closed whenever the pool may fork
+        connection.close()
+        pool = Pool(options['processes'])
+        try:
+            while True:
+                job_ids = claim_jobs(options['batch_size'])
+                # also ends the transaction so the next poll sees new jobs
+                connection.close()
+                if not job_ids:
+                    if options['once']:
+                        break
+                    time.sleep(options['interval'])
+                    continue
+
+                start = time.time()
+                statuses = []
+                for status, collected in pool.map(run_job_collecting_metrics,
+                                                   job_ids):
+                    statuses.append(status)
+                    metrics.merge(collected)
+                elapsed = time.time() - start
+                self.stdout.write("%d jobs in %.1fs: %d done, %d retrying, "
+                                  "%d failed\n" % (
+                                  len(statuses), elapsed,
+                                  statuses.count(Filter_Job.DONE),
+                                  statuses.count(Filter_Job.PENDING),
+                                  statuses.count(Filter_Job.FAILED)))
+        finally:
+            pool.close()
+            pool.join()
+            if options['metrics']:
+                self.stdout.write(metrics.to_json() + "\n")
@@ -113,4 +113,60 @@ def delete_datafile_harvest(sender, instance, **kwargs):
         object = Datafile_Harvest.objects.get(datafile=instance)
         object.delete()
     except Datafile_Harvest.DoesNotExist:
-        pass
\ No newline at end of file
+        pass
+
+#-------------------
+# Filter Job
+#-------------------
+class Filter_Job(models.Model):
+    """A request to run the post save filters over a datafile, queued when
+    ``settings.FILTER_QUEUE_ENABLED`` is set and picked up by the
+    ``run_filter_queue`` management command.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = ((PENDING, 'Pending'),
+                      (RUNNING, 'Running'),
+                      (DONE, 'Done'),
+                      (FAILED, 'Failed'),
+                      )
+
+    datafile = models.ForeignKey(Dataset_File)
+    created = models.BooleanField(default=False)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=PENDING, db_index=True)
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    created_time = models.DateTimeField(auto_now_add=True)
+    updated_time = models.DateTimeField(auto_now=True)
+
+#-------------------
+# Datafile Fingerprint
+#-------------------
+class Datafile_Fingerprint(models.Model):
+    """Size, modification time and fast hash of a datafile's contents when
+    the post save filters last extracted its metadata.
+    """
+    datafile = models.ForeignKey(Dataset_File, unique=True)
+    size = models.BigIntegerField()
+    mtime = models.FloatField()
+    hash = models.CharField(max_length=32)
+    updated_time = models.DateTimeField(auto_now=True)
+
+class Datafile_Raw_Metadata(models.Model):
+    """The raw instrument metadata of a datafile as the post save filters
+    found it, such as the settings text of an FEI image or the header of an
+    EDAX spectrum. It is kept zlib compressed and base64 encoded so the
+    ``remap_metadata`` management command can derive parameters from it
+    without reading the file again.
+    """
+    datafile = models.ForeignKey(Dataset_File)
+    kind = models.CharField(max_length=40)
+    instrument = models.CharField(max_length=80)
+    data = models.TextField()
+    updated_time = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (('datafile', 'kind'),)
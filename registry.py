@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011-2011, RMIT e-Research Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2011, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+registry.py
+
+Process wide cache of the schemas and of the parameter names of each
+schema. Saving or deleting a Schema or ParameterName through the ORM
+invalidates the cached entries; parameter names created with a bulk insert
+have to be added with :func:`add_parameter_names`.
+
+The signals only reach the process which made the change, so everything
+cached is also dropped REGISTRY_CACHE_TTL seconds after it was loaded. That
+bounds how long other processes see stale schemas. Entries cached in a
+transaction which is rolled back would point at rows which don't exist, so
+the code rolling back calls :func:`invalidate`.
+
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.db.models.signals import post_save
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from tardis.tardis_portal.models import Schema
+from tardis.tardis_portal.models import ParameterName
+
+
+_lock = threading.RLock()
+# {schema id: Schema}
+_schemas = None
+# {schema id: {name: ParameterName}}
+_parameter_names = {}
+# time after which everything cached is reloaded
+_expires = 0
+
+
+def _expire():
+    """Forget everything cached once the TTL has passed. The caller holds
+    the lock.
+    """
+    global _schemas, _expires
+    now = time.time()
+    if now >= _expires:
+        _schemas = None
+        _parameter_names.clear()
+        _expires = now + getattr(settings, 'REGISTRY_CACHE_TTL', 60)
+
+
+def get_schemas():
+    """Return a list of all the schemas.
+    """
+    global _schemas
+    _lock.acquire()
+    try:
+        _expire()
+        if _schemas is None:
+            _schemas = dict((s.id, s) for s in Schema.objects.all())
+        return _schemas.values()
+    finally:
+        _lock.release()
+
+
+def get_schema(namespace):
+    """Return the schema with a namespace, or None.
+    """
+    for schema in get_schemas():
+        if schema.namespace == namespace:
+            return schema
+    return None
+
+
+def get_or_create_schema(namespace, name, type=Schema.DATAFILE):
+    """Return the schema with a namespace, creating it if needed.
+    """
+    schema = get_schema(namespace)
+    if schema is None:
+        (schema, created) = Schema.objects.get_or_create(namespace=namespace,
+                                  defaults={'name': name, 'type': type})
+    return schema
+
+
+def get_parameter_names(schema):
+    """Return a ``{name: ParameterName}`` dictionary of a schema's parameter
+    names. The dictionary is a copy and can be modified.
+    """
+    _lock.acquire()
+    try:
+        _expire()
+        if schema.id not in _parameter_names:
+            _parameter_names[schema.id] = dict((p.name, p) for p in
+                                  ParameterName.objects.filter(schema=schema))
+        return dict(_parameter_names[schema.id])
+    finally:
+        _lock.release()
+
+
+def add_parameter_names(schema, parameter_names):
+    """Add parameter names which were created without sending signals.
+    """
+    _lock.acquire()
+    try:
+        if schema.id in _parameter_names:
+            for p in parameter_names:
+                _parameter_names[schema.id][p.name] = p
+    finally:
+        _lock.release()
+
+
+def invalidate():
+    """Forget everything cached.
+    """
+    global _schemas
+    _lock.acquire()
+    try:
+        _schemas = None
+        _parameter_names.clear()
+    finally:
+        _lock.release()
+
+
+@receiver(post_save, sender=Schema)
+@receiver(post_delete, sender=Schema)
+def invalidate_schema(sender, instance, **kwargs):
+    global _schemas
+    _lock.acquire()
+    try:
+        _schemas = None
+        _parameter_names.pop(instance.id, None)
+    finally:
+        _lock.release()
+
+
+@receiver(post_save, sender=ParameterName)
+@receiver(post_delete, sender=ParameterName)
+def invalidate_parameter_name(sender, instance, **kwargs):
+    _lock.acquire()
+    try:
+        _parameter_names.pop(instance.schema_id, None)
+    finally:
+        _lock.release()
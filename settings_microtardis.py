@@ -95,6 +95,46 @@ GET_FULL_STAGING_PATH_TEST = path.join(STAGING_PATH, "test_user")
 # Filter middleware for auto-ingest
 FILTER_MIDDLEWARE = (("tardis.microtardis.filters","FilterInitMiddleware"),)
 
+# Queue the post save filters instead of running them while the datafile is
+# saved. The queue is run by "bin/django run_filter_queue".
+FILTER_QUEUE_ENABLED = False
+FILTER_QUEUE_PROCESSES = 4
+FILTER_QUEUE_MAX_ATTEMPTS = 3
+# Running jobs not finished after this many seconds are queued again
+FILTER_QUEUE_STALE_SECONDS = 3600
+
+# Number of datasets whose instrument each process remembers
+INSTRUMENT_CACHE_SIZE = 1024
+
+# Seconds each process keeps the schemas and parameter names it has loaded;
+# changes made by other processes show up after at most this long
+REGISTRY_CACHE_TTL = 60
+
+# Cache of the metadata parsed out of datafiles, off while None, e.g.
+# PARSE_CACHE_PATH = path.abspath(path.join(path.dirname(__file__),
+#     '../var/parse_cache/')).replace('\\', '/')
+PARSE_CACHE_PATH = None
+PARSE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Cache of the rendered spectrum images, None turns it off
+SPECTRA_CACHE_PATH = path.abspath(path.join(path.dirname(__file__),
+    '../var/spectra_cache/')).replace('\\', '/')
+SPECTRA_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Processes drawing the spectrum images, 0 draws them in the web server.
+# Each process draws SPECTRA_RENDER_MAX_TASKS images before it is replaced;
+# requests beyond SPECTRA_RENDER_QUEUE_SIZE waiting or running renders, or
+# renders taking more than SPECTRA_RENDER_TIMEOUT seconds, get a 503.
+# These limits apply to each web server process, which has render processes
+# and a queue of its own: 4 mod_wsgi processes with the values below run 8
+# render processes and queue up to 80 renders. The web server should call
+# tardis.microtardis.spectra.pool.start_pool() when it starts a process,
+# e.g. in django.wsgi, rather than leave it to the first render.
+SPECTRA_RENDER_PROCESSES = 2
+SPECTRA_RENDER_MAX_TASKS = 100
+SPECTRA_RENDER_QUEUE_SIZE = 20
+SPECTRA_RENDER_TIMEOUT = 30
+
 # URLs for EMBS authentication
 EMBS_URL = "http://embs.rmit.edu.au/auth.php?"
 EMBS_USER_GROUP_NAME = "embs_users_basic_permissions"
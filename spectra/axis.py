@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011-2011, RMIT e-Research Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2011, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+axis.py
+
+The energy axis of spectra: the energy of each channel, from the detector
+calibration in the file header, and the range of channels worth plotting.
+
+"""
+import numpy
+
+
+# the calibration of spectra whose header doesn't have one, 10 eV per
+# channel starting at 0 keV
+DEFAULT_CALIBRATION = (10.0, 0.0)
+
+# where the calibration is in the header of each spectrum file type
+# example: CALIBRATION_FIELDS = {"type": ((offset, "dtype") of eV/channel,
+#                                         (offset, "dtype") of the energy
+#                                         of the first channel in keV)}
+CALIBRATION_FIELDS = {'spc': ((384, '<i4'), (448, '<f4')), # EDAX Genesis
+                      }
+
+# counts a channel needs to be plotted
+SIGNIFICANT_COUNTS = 10
+
+
+def read_calibration(header, datafile_type):
+    """Return the (eV per channel, energy of the first channel in keV) of a
+    spectrum from its header.
+    """
+    fields = CALIBRATION_FIELDS.get(datafile_type)
+    if fields is None:
+        return DEFAULT_CALIBRATION
+    (gain_offset, gain_dtype), (zero_offset, zero_dtype) = fields
+    if len(header) < max(gain_offset + 4, zero_offset + 4):
+        return DEFAULT_CALIBRATION
+    gain = float(numpy.frombuffer(header, gain_dtype, 1, gain_offset)[0])
+    zero = float(numpy.frombuffer(header, zero_dtype, 1, zero_offset)[0])
+    if not gain > 0 or not numpy.isfinite(zero):
+        return DEFAULT_CALIBRATION
+    return (gain, zero)
+
+
+def get_energies(channels, calibration):
+    """Return the energy of each channel in keV.
+    """
+    gain, zero = calibration
+    return zero + numpy.arange(channels) * (gain / 1000.0)
+
+
+def significant_range(values, counts=SIGNIFICANT_COUNTS):
+    """Return the first and last channel with at least ``counts`` counts,
+    or the first and last channel if there is none.
+    """
+    significant = numpy.flatnonzero(numpy.asarray(values) >= counts)
+    if not len(significant):
+        return 0, len(values) - 1
+    return significant[0], significant[-1]
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011-2011, RMIT e-Research Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2011, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+cache.py
+
+On-disk cache of the rendered spectrum PNGs, so showing a spectrum again
+doesn't plot it again.
+
+Entries are kept under ``settings.SPECTRA_CACHE_PATH`` in a directory per
+datafile, named by the spectrum type, the image size, a key of the
+spectrum file's size and modification time, and the md5 of the PNG, which
+is also its ETag. Re-extracting the metadata of a datafile removes its
+entries, as the labelled peaks may have changed. Once
+``settings.SPECTRA_CACHE_MAX_BYTES`` is exceeded the least recently used
+entries are removed. The cache is off when ``SPECTRA_CACHE_PATH`` isn't
+set.
+
+"""
+import hashlib
+import logging
+import os
+import shutil
+
+from django.conf import settings
+
+from tardis.microtardis.filters import metrics
+from tardis.microtardis.filters.parsecache import evict
+
+
+logger = logging.getLogger(__name__)
+
+# part of every key, change it when the rendered images change
+CACHE_VERSION = 3
+
+# bytes written by this process since the cache size was last checked
+_written = 0
+
+
+def get_etag(content):
+    return hashlib.md5(content).hexdigest()
+
+
+def get_prefix(datafile_type, size, filepath):
+    """Return the start of the names of the entries for a spectrum file,
+    or None if the file can't be read.
+    """
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return None
+    key = hashlib.md5('\0'.join([str(CACHE_VERSION), filepath,
+                                 str(stat.st_size), repr(stat.st_mtime)])).hexdigest()
+    return '%s-%s-%s-' % (datafile_type, size, key)
+
+
+def find_png(datafile_id, datafile_type, size, filepath):
+    """Return the path and ETag of the cached PNG of a spectrum, or None.
+
+    :param datafile_id: the id of the spectrum's datafile.
+    :param datafile_type: 'spc' or 'spt'.
+    :param size: 'small' or 'full'.
+    :param filepath: the absolute path of the spectrum file.
+    """
+    root = getattr(settings, 'SPECTRA_CACHE_PATH', None)
+    if not root:
+        return None
+    prefix = get_prefix(datafile_type, size, filepath)
+    if prefix is None:
+        return None
+    try:
+        names = os.listdir(os.path.join(root, str(datafile_id)))
+    except OSError:
+        return None
+    for name in names:
+        if name.startswith(prefix) and name.endswith('.png'):
+            return (os.path.join(root, str(datafile_id), name),
+                    name[len(prefix):-len('.png')])
+    return None
+
+
+def read_png(path):
+    """Return the contents of a cache entry, or None if it has gone.
+    """
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        content = f.read()
+    finally:
+        f.close()
+    # the modification time orders the entries for eviction
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+    metrics.incr('spectra_cache.hit')
+    return content
+
+
+def store_png(datafile_id, datafile_type, size, filepath, content):
+    """Cache the PNG of a spectrum, replacing older images of the same
+    spectrum file and size.
+
+    :returns: the ETag of the image.
+    """
+    global _written
+    etag = get_etag(content)
+    metrics.incr('spectra_cache.miss')
+    root = getattr(settings, 'SPECTRA_CACHE_PATH', None)
+    if not root:
+        return etag
+    prefix = get_prefix(datafile_type, size, filepath)
+    if prefix is None:
+        return etag
+
+    directory = os.path.join(root, str(datafile_id))
+    path = os.path.join(directory, prefix + etag + '.png')
+    tmppath = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in os.listdir(directory):
+            if name.startswith('%s-%s-' % (datafile_type, size)) and \
+               name.endswith('.png'):
+                os.remove(os.path.join(directory, name))
+        f = open(tmppath, 'wb')
+        try:
+            f.write(content)
+        finally:
+            f.close()
+        os.rename(tmppath, path)
+    except EnvironmentError, e:
+        logger.debug("can't write spectra cache entry %s: %s" % (path, e))
+        return etag
+
+    _written += len(content)
+    max_bytes = getattr(settings, 'SPECTRA_CACHE_MAX_BYTES', 256 * 1024 * 1024)
+    if _written > max_bytes / 10:
+        _written = 0
+        evict(root, max_bytes, 'spectra_cache.evicted')
+    return etag
+
+
+def invalidate(datafile_id):
+    """Remove the cached PNGs of a datafile.
+    """
+    root = getattr(settings, 'SPECTRA_CACHE_PATH', None)
+    if not root:
+        return
+    directory = os.path.join(root, str(datafile_id))
+    if os.path.isdir(directory):
+        shutil.rmtree(directory, ignore_errors=True)
+        metrics.incr('spectra_cache.invalidated')
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011-2011, RMIT e-Research Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2011, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+downsample.py
+
+Reduces spectra to a few hundred points for plotting in the browser.
+
+``minmax`` keeps the lowest and highest count of each bucket of channels,
+so no peak is lost; ``lttb`` (Largest Triangle Three Buckets) keeps the
+channel of each bucket which best preserves the shape of the line.
+
+"""
+import numpy
+
+
+def select_range(energies, values, start_kev=None, end_kev=None):
+    """Return the channels whose energy is between ``start_kev`` and
+    ``end_kev``, either of which may be None for no limit.
+    """
+    first = 0
+    last = len(energies)
+    if start_kev is not None:
+        first = numpy.searchsorted(energies, start_kev, 'left')
+    if end_kev is not None:
+        last = numpy.searchsorted(energies, end_kev, 'right')
+    return energies[first:last], values[first:last]
+
+
+def minmax(energies, values, points):
+    """Return at most ``points`` channels, the lowest and the highest of
+    each of ``points / 2`` buckets in channel order.
+    """
+    channels = len(values)
+    buckets = points // 2
+    if channels <= points or buckets < 1:
+        return energies, values
+    starts = (numpy.arange(buckets + 1) * channels) // buckets
+    indices = []
+    for start, end in zip(starts[:-1].tolist(), starts[1:].tolist()):
+        bucket = values[start:end]
+        low = start + int(bucket.argmin())
+        high = start + int(bucket.argmax())
+        indices.extend(sorted(set((low, high))))
+    return energies[indices], values[indices]
+
+
+def lttb(energies, values, points):
+    """Return ``points`` channels picked by Largest Triangle Three Buckets:
+    the first and last channel, and from each bucket in between the one
+    making the largest triangle with the channel picked from the previous
+    bucket and the average of the next bucket.
+    """
+    channels = len(values)
+    if channels <= points or points < 3:
+        return energies, values
+    x = numpy.asarray(energies, dtype=float)
+    y = numpy.asarray(values, dtype=float)
+    every = float(channels - 2) / (points - 2)
+    indices = [0]
+    picked = 0
+    for i in range(points - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, channels)
+        average_x = x[end:next_end].mean()
+        average_y = y[end:next_end].mean()
+        areas = numpy.abs((x[picked] - average_x) * (y[start:end] - y[picked]) -
+                          (x[picked] - x[start:end]) * (average_y - y[picked]))
+        picked = start + int(areas.argmax())
+        indices.append(picked)
+    indices.append(channels - 1)
+    return energies[indices], values[indices]
+
+
+# the downsampling methods of the spectrum data view
+DOWNSAMPLERS = {'minmax': minmax,
+                'lttb': lttb,
+                }
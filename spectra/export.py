@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011-2011, RMIT e-Research Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2011, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+export.py
+
+Streams the spectra of a dataset as one download: a ZIP of per-file CSVs,
+a single wide CSV with one column per spectrum, or an NPZ of numpy
+arrays. The archives are written as they are sent, one spectrum at a
+time, so memory use doesn't grow with the size of the download; the wide
+CSV holds the channel counts of every spectrum (16 KB each) to write them
+side by side.
+
+"""
+import csv
+import logging
+import StringIO
+import zipfile
+
+import numpy
+
+from tardis.microtardis.spectra.loader import get_spectrum_type
+from tardis.microtardis.spectra.loader import load_spectrum
+
+
+logger = logging.getLogger(__name__)
+
+# channels per chunk of the wide CSV
+CHUNK_CHANNELS = 512
+
+
+class ZipStream(object):
+    """Write only file object which hands over what :class:`zipfile.ZipFile`
+    writes to it, so an archive can be sent while it is written.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.offset += len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        """Return what has been written since the last call.
+        """
+        data = ''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_zip(members):
+    """Yield a ZIP archive of ``(name, content)`` members in pieces.
+    """
+    stream = ZipStream()
+    archive = zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED)
+    for name, content in members:
+        archive.writestr(name, content)
+        yield stream.pop()
+    archive.close()
+    yield stream.pop()
+
+
+def iter_spectra(datafiles):
+    """Yield the (name, counts, energies in keV) of each spectrum among the
+    datafiles, skipping the ones which can't be read.
+    """
+    names = set()
+    for datafile in datafiles:
+        datafile_type = get_spectrum_type(datafile)
+        if datafile_type is None:
+            continue
+        try:
+            values, energies = load_spectrum(datafile, datafile_type)
+        except EnvironmentError, e:
+            logger.warning("can't export spectrum %s: %s" % (datafile.id, e))
+            continue
+        name = datafile.filename.replace('/', '_')
+        if name in names:
+            name = '%s_%s' % (datafile.id, name)
+        names.add(name)
+        yield name, values, energies
+
+
+def format_csv(values, energies):
+    """Return the CSV of a spectrum: the energy of each channel in eV, and
+    its counts.
+    """
+    buffer = StringIO.StringIO()
+    numpy.savetxt(buffer, numpy.column_stack(((energies * 1000).round(3), values)),
+                  fmt=('%.10g', '%d'), delimiter=',', newline='\r\n')
+    # newer numpy writes unicode
+    return str(buffer.getvalue())
+
+
+def export_csv_zip(datafiles):
+    """Yield a ZIP of the CSV of each spectrum.
+    """
+    return iter_zip(('%s.csv' % name[:-4], format_csv(values, energies))
+                    for name, values, energies in iter_spectra(datafiles))
+
+
+def export_npz(datafiles):
+    """Yield an NPZ (a ZIP of .npy files) with the counts of each spectrum
+    under its file name, and the energies in keV under the file name and
+    "_kev".
+    """
+    def members():
+        for name, values, energies in iter_spectra(datafiles):
+            for key, array in ((name, values), (name + '_kev', energies)):
+                buffer = StringIO.StringIO()
+                numpy.lib.format.write_array(buffer, numpy.asarray(array))
+                yield key + '.npy', buffer.getvalue()
+    return iter_zip(members())
+
+
+def export_wide_csv(datafiles):
+    """Yield a CSV with a row per channel and a column with the counts of
+    each spectrum. The first column is the energy in eV if all spectra
+    share a calibration, otherwise the channel number.
+    """
+    names = []
+    columns = []
+    axis = None
+    calibrated = True
+    for name, values, energies in iter_spectra(datafiles):
+        names.append(name)
+        columns.append(values)
+        if axis is None or len(energies) > len(axis):
+            longer, shorter = energies, axis
+            axis = energies
+        else:
+            longer, shorter = axis, energies
+        if shorter is not None and \
+           not numpy.array_equal(longer[:len(shorter)], shorter):
+            calibrated = False
+    if not columns:
+        return
+
+    if calibrated:
+        first = (axis * 1000).round(3)
+        header, first_format = 'eV', '%.10g'
+    else:
+        first = numpy.arange(len(axis))
+        header, first_format = 'channel', '%d'
+    # file names may contain commas or quotes
+    row = StringIO.StringIO()
+    csv.writer(row).writerow([header] + [
+        isinstance(name, unicode) and name.encode('utf-8') or name
+        for name in names])
+    yield row.getvalue()
+
+    for start in xrange(0, len(axis), CHUNK_CHANNELS):
+        end = min(start + CHUNK_CHANNELS, len(axis))
+        table = [numpy.char.mod(first_format, first[start:end])]
+        for values in columns:
+            part = values[start:end]
+            cells = numpy.zeros(end - start, dtype='S11')
+            cells[:len(part)] = numpy.char.mod('%d', part)
+            table.append(cells)
+        yield ''.join(','.join(row) + '\r\n' for row in zip(*table))
+
+
+# the export formats of a dataset's spectra
+# example: EXPORTERS = {"format": (exporter, "mimetype", "file extension")}
+EXPORTERS = {'zip': (export_csv_zip, 'application/zip', 'zip'),
+             'csv': (export_wide_csv, 'text/csv', 'csv'),
+             'npz': (export_npz, 'application/octet-stream', 'npz'),
+             }
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011-2011, RMIT e-Research Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2011, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+loader.py
+
+Reads the channel counts of EDAX Genesis spectra.
+
+"""
+import os
+
+import numpy
+
+from django.conf import settings
+
+from tardis.microtardis.spectra.axis import get_energies
+from tardis.microtardis.spectra.axis import read_calibration
+
+
+# the channel counts are little endian 32 bit integers
+COUNT_DTYPE = numpy.dtype('<i4')
+
+# the layout of each spectrum file type
+# example: SPECTRUM_LAYOUTS = {"type": (offset of the channel counts,
+#                                       offset of the number of channels
+#                                       in the header or None,
+#                                       default number of channels)}
+SPECTRUM_LAYOUTS = {'spc': (3840, 32,   4000), # EDAX Genesis spectrum
+                    'spt': (7,    None, 2048),
+                    }
+
+
+def get_datafile_path(datafile):
+    basepath = settings.FILE_STORE_PATH
+    experiment_id = str(datafile.dataset.experiment.id)
+    dataset_id = str(datafile.dataset.id)
+    raw_path = datafile.url.partition('//')[2]
+    return os.path.join(basepath,
+                        experiment_id,
+                        dataset_id,
+                        raw_path)
+
+
+def get_spectrum_type(datafile):
+    """Return the spectrum file type of a datafile, 'spc' or 'spt', or None.
+    """
+    extension = str(datafile.url)[-4:].lower()
+    if extension in ('.spc', '.spt'):
+        return extension[1:]
+    return None
+
+
+def read_spectrum(f, datafile_type):
+    """Return the channel counts in a spectrum file as a read only
+    :class:`numpy.ndarray`, and the energy of each channel in keV.
+
+    :param f: the open spectrum file, at its start.
+    :param datafile_type: 'spc' or 'spt'.
+    """
+    offset, channels_offset, channels = SPECTRUM_LAYOUTS[datafile_type]
+    header = f.read(offset)
+    if channels_offset is not None and len(header) >= channels_offset + 2:
+        number_of_channels = numpy.frombuffer(header, '<i2', 1, channels_offset)[0]
+        if number_of_channels > 0:
+            channels = int(number_of_channels)
+    data = f.read(COUNT_DTYPE.itemsize * channels)
+    values = numpy.frombuffer(data, COUNT_DTYPE, len(data) // COUNT_DTYPE.itemsize)
+    return values, get_energies(len(values),
+                                read_calibration(header, datafile_type))
+
+
+def load_spectrum(datafile, datafile_type=None):
+    """Return the channel counts of a spectrum datafile as a read only
+    :class:`numpy.ndarray`, and the energy of each channel in keV.
+
+    :param datafile: the spectrum's
+        :class:`~tardis.tardis_portal.models.Dataset_File`.
+    :param datafile_type: 'spc' or 'spt'; found from the file name if not
+        given.
+    """
+    if datafile_type is None:
+        datafile_type = get_spectrum_type(datafile)
+    f = open(get_datafile_path(datafile), 'rb')
+    try:
+        return read_spectrum(f, datafile_type)
+    finally:
+        f.close()
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011-2011, RMIT e-Research Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2011, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+pool.py
+
+Draws spectra in a pool of render processes, so matplotlib runs outside
+the web server's workers and a slow render only holds up its own request.
+
+Each web server process has a pool of its own of
+``settings.SPECTRA_RENDER_PROCESSES`` render processes, which
+:func:`start_pool` starts; call it when the web server process starts,
+before it runs any requests, otherwise the first render starts the pool.
+A render process draws at most ``SPECTRA_RENDER_MAX_TASKS`` images before
+it is replaced. At most ``SPECTRA_RENDER_QUEUE_SIZE`` renders may be
+waiting or running at a time. A render which hasn't finished
+``SPECTRA_RENDER_TIMEOUT`` seconds after it was requested fails, whether it
+was still waiting for a render process or being drawn; in the latter case
+only its own render process, which may be stuck, is replaced. With
+``SPECTRA_RENDER_PROCESSES = 0`` spectra are drawn in the calling process.
+
+"""
+import logging
+import threading
+import time
+import Queue
+from multiprocessing import Pipe
+from multiprocessing import Process
+
+from django.conf import settings
+
+from tardis.microtardis.filters import metrics
+
+
+logger = logging.getLogger(__name__)
+
+_pool_lock = threading.Lock()
+# all the render processes, and those waiting for a spectrum to draw
+_workers = []
+_idle = None
+_slots = None
+
+
+class RenderError(Exception):
+    """The spectrum couldn't be drawn in time, or the pool is busy."""
+
+
+def draw_png(values, energies, size, peaks):
+    # runs in the render processes, which import matplotlib once
+    from tardis.microtardis.spectra.render import render_png
+    return render_png(values, energies, size, peaks)
+
+
+def serve(conn):
+    """Draw the spectra sent through ``conn`` until it is closed.
+    """
+    while True:
+        try:
+            args = conn.recv()
+        except EOFError:
+            return
+        try:
+            conn.send((True, draw_png(*args)))
+        except Exception, e:
+            conn.send((False, repr(e)))
+
+
+class RenderProcess(object):
+    """A render process and the pipe to it.
+    """
+    def __init__(self):
+        self.conn, child_conn = Pipe()
+        self.process = Process(target=serve, args=(child_conn,))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        self.tasks = 0
+
+    def stop(self):
+        self.conn.close()
+        self.process.terminate()
+        self.process.join()
+
+
+def start_pool():
+    """Start the render processes of this process, unless they are running
+    already.
+    """
+    global _idle, _slots
+    _pool_lock.acquire()
+    try:
+        if _idle is not None:
+            return
+        _idle = Queue.Queue()
+        for i in range(getattr(settings, 'SPECTRA_RENDER_PROCESSES', 2)):
+            worker = RenderProcess()
+            _workers.append(worker)
+            _idle.put(worker)
+        _slots = threading.BoundedSemaphore(
+            getattr(settings, 'SPECTRA_RENDER_QUEUE_SIZE', 20))
+    finally:
+        _pool_lock.release()
+
+
+def stop_pool():
+    """Stop the render processes; the next render starts new ones.
+    """
+    global _idle, _slots
+    _pool_lock.acquire()
+    try:
+        for worker in _workers:
+            worker.stop()
+        del _workers[:]
+        _idle = _slots = None
+    finally:
+        _pool_lock.release()
+
+
+def replace(worker):
+    """Stop a render process and start another one in its place.
+    """
+    worker.stop()
+    _pool_lock.acquire()
+    try:
+        if worker not in _workers:
+            # the pool has been stopped
+            return worker
+        new_worker = RenderProcess()
+        _workers[_workers.index(worker)] = new_worker
+        metrics.incr('spectra_render.replaced')
+        return new_worker
+    finally:
+        _pool_lock.release()
+
+
+def render(values, energies, size, peaks=[]):
+    """Return a PNG plot of a spectrum drawn by the render pool, see
+    :func:`tardis.microtardis.spectra.render.render_png`.
+
+    :raises RenderError: if the queue is full, or the render failed or
+        timed out.
+    """
+    if not getattr(settings, 'SPECTRA_RENDER_PROCESSES', 2):
+        return draw_png(values, energies, size, peaks)
+
+    start_pool()
+    idle, slots = _idle, _slots
+    if not slots.acquire(False):
+        metrics.incr('spectra_render.busy')
+        raise RenderError("too many spectra are being drawn")
+    try:
+        timeout = getattr(settings, 'SPECTRA_RENDER_TIMEOUT', 30)
+        deadline = time.time() + timeout
+        try:
+            worker = idle.get(True, timeout)
+        except Queue.Empty:
+            metrics.incr('spectra_render.timeout')
+            raise RenderError("drawing the spectrum took too long")
+        try:
+            worker.conn.send((values, energies, size, peaks))
+            if not worker.conn.poll(max(deadline - time.time(), 0)):
+                metrics.incr('spectra_render.timeout')
+                logger.warning("drawing a spectrum took more than %ss" % timeout)
+                worker = replace(worker)
+                raise RenderError("drawing the spectrum took too long")
+            success, result = worker.conn.recv()
+            worker.tasks += 1
+            if worker.tasks >= getattr(settings, 'SPECTRA_RENDER_MAX_TASKS', 100):
+                worker = replace(worker)
+        except (EOFError, IOError), e:
+            logger.warning("render process failed: %s" % e)
+            worker = replace(worker)
+            raise RenderError("drawing the spectrum failed")
+        finally:
+            idle.put(worker)
+    finally:
+        slots.release()
+
+    if not success:
+        logger.warning("drawing a spectrum failed: %s" % result)
+        raise RenderError("drawing the spectrum failed")
+    return result
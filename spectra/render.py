@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011-2011, RMIT e-Research Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2011, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+render.py
+
+Plots spectra as PNG images with matplotlib, which is configured here. Only
+import this module where a spectrum is actually drawn; the web views draw
+through :mod:`tardis.microtardis.spectra.pool`.
+
+Each image is drawn on its own :class:`~matplotlib.figure.Figure` rather
+than through the global state of ``pyplot``, so renders can't interfere
+with each other and a failed render leaves nothing behind.
+
+"""
+import os
+import StringIO
+
+import Image
+
+from django.conf import settings
+
+from tardis.microtardis.spectra.axis import significant_range
+
+# import and configure matplotlib library
+try:
+    os.environ['HOME'] = settings.MATPLOTLIB_HOME
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    is_matplotlib_imported = True
+except ImportError:
+    is_matplotlib_imported = False
+
+
+def render_png(values, energies, size, peaks=[]):
+    """Return a PNG plot of a spectrum, or an empty string if matplotlib
+    isn't installed.
+
+    :param values: the counts of each channel, a :class:`numpy.ndarray`.
+    :param energies: the energy of each channel in keV.
+    :param size: 'small' for the preview size.
+    :param peaks: the "Peak ID Element" parameter values to label.
+    """
+    if not is_matplotlib_imported:
+        return ''
+
+    fig = Figure()
+    canvas = FigureCanvasAgg(fig)
+    axes = fig.add_subplot(111)
+
+    # truncate the values on x axis to the channels with 10 counts or more
+    left_end, right_end = significant_range(values)
+    axes.plot(energies[left_end:right_end+1], values[left_end:right_end+1])
+    
+    axes.set_xlabel("keV")
+    axes.set_ylabel("Counts")
+    axes.grid(True)
+    
+    # set size
+    ratio = 1.5
+    if size == "small":
+        ratio = 0.75
+    default_size = fig.get_size_inches()
+    fig.set_size_inches(default_size[0] * ratio, default_size[1] * ratio)
+    
+    # label peak values
+    for peak in peaks:
+        data = str(peak).split(', ')
+        atomic = data[0].split('=')[-1]
+        line = data[1].split('=')[-1]
+        energy = float(data[2].split('=')[-1])
+        height= int(data[3].split('=')[-1])
+        axes.annotate('%s%s' % (atomic, line), 
+                      xy=(energy, height), 
+                      xytext=(energy-0.5, height+50),
+                      )
+    
+    # Write PNG image
+    buffer = StringIO.StringIO()
+    canvas.draw()
+    img = Image.fromstring('RGB', canvas.get_width_height(), canvas.tostring_rgb())
+    img.save(buffer, 'PNG')
+    return buffer.getvalue()
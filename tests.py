@@ -57,6 +57,12 @@ class EXIFTagsTestCase(TestCase):
           
     def setUp(self):
         from django.contrib.auth.models import User
+        from tardis.microtardis import registry
+        from tardis.microtardis.filters import instruments
+        # the test rollbacks leave the cached schemas, parameter names and
+        # dataset instruments
+        registry.invalidate()
+        instruments.reset()
         user = 'tardis_user1'
         pwd = 'secret'
         email = ''
@@ -139,10 +145,92 @@ class EXIFTagsTestCase(TestCase):
         self.assertEqual(str(psm.get_param("[TLD] Brightness").numerical_value), "51.6")
                 
 
+class EXIFReaderTestCase(TestCase):
+
+    def get_images(self):
+        from os import path
+        root = path.abspath(path.dirname(__file__))
+        return [path.join(root, 'docs/_static/XL30.tif'),
+                path.join(root, 'testing/Quanta200/test.tif'),
+                path.join(root, 'testing/NovaNanoSEM/test.tif')]
+
+    def test_find_tags(self):
+        from tardis.microtardis.filters.lib.sourceforge.exif_py import EXIF
+
+        for filename in self.get_images():
+            f = open(filename, 'rb')
+            try:
+                found = EXIF.find_tags(f, (0x8778, 0x877A))
+                f.seek(0)
+                processed = EXIF.process_file(f)
+            finally:
+                f.close()
+            self.assertTrue(found, filename)
+            for key, tag in found.items():
+                self.assertEqual(str(processed[key]), str(tag))
+                self.assertEqual(processed[key].values, tag.values)
+            self.assertEqual(sorted(found.keys()),
+                             sorted(key for key, tag in processed.items()
+                                    if tag.tag in (0x8778, 0x877A)))
+
+    def test_read_ifd_entries(self):
+        from tardis.microtardis.filters.lib.sourceforge.exif_py import EXIF
+
+        for filename in self.get_images():
+            f = open(filename, 'rb')
+            try:
+                hdr, offset, buffer = EXIF.open_header(f)
+                ifd = hdr.first_IFD()
+                while ifd:
+                    entries = hdr.s2n(ifd, 2)
+                    tags, field_types, counts, pointers = hdr.read_IFD_entries(ifd, entries)
+                    for i in range(entries):
+                        # the tables decode the same as field by field
+                        entry = ifd + 2 + 12 * i
+                        self.assertEqual(hdr.s2n(entry, 2), tags[i])
+                        self.assertEqual(hdr.s2n(entry + 2, 2), field_types[i])
+                        self.assertEqual(hdr.s2n(entry + 4, 4), counts[i])
+                        self.assertEqual(hdr.s2n(entry + 8, 4), pointers[i])
+
+                        if field_types[i] not in EXIF.ARRAY_CODES:
+                            continue
+                        count = min(counts[i], 64)
+                        value_offset = entry + 8
+                        if counts[i] * EXIF.FIELD_TYPES[field_types[i]][0] > 4:
+                            value_offset = pointers[i]
+                        self.assertEqual(
+                            [str(v) for v in hdr.s2n_values(value_offset, field_types[i], count)],
+                            [str(v) for v in hdr.s2n_array(value_offset, field_types[i], count)])
+                    ifd = hdr.next_IFD(ifd)
+                if buffer is not None:
+                    buffer.close()
+            finally:
+                f.close()
+
+    def test_image_tags(self):
+        import Image
+        from tardis.microtardis.filters.exiftags import EXIFTagsFilter
+
+        exif_filter = EXIFTagsFilter("EXIF", "http://rmmf.isis.rmit.edu.au/schemas")
+        for filename in self.get_images():
+            exifs = exif_filter.getExif(filename, exif_filter.metadata_tags)
+            image_tags = exif_filter.getImageTags(Image.open(filename),
+                                                  exif_filter.metadata_tags)
+            self.assertTrue(exifs, filename)
+            self.assertEqual(dict((key, str(value)) for key, value in exifs.items()),
+                             image_tags)
+
+
 class SPCTagsTestCase(TestCase):
 
     def setUp(self):
         from django.contrib.auth.models import User
+        from tardis.microtardis import registry
+        from tardis.microtardis.filters import instruments
+        # the test rollbacks leave the cached schemas, parameter names and
+        # dataset instruments
+        registry.invalidate()
+        instruments.reset()
         user = 'tardis_user1'
         pwd = 'secret'
         email = ''
@@ -218,3 +306,924 @@ class SPCTagsTestCase(TestCase):
         self.assertEqual(str(psm.get_param("Live Time").numerical_value), "343.9")
         self.assertEqual(str(psm.get_param("Time Constant").numerical_value), "500.0")
         self.assertEqual(str(psm.get_param("Sample Type (Label)").string_value), "Surface")
+
+
+class TagPlanTestCase(TestCase):
+
+    def test_apply_tag_plan(self):
+        from tardis.microtardis.filters.exiftags import parse_ini
+        from tardis.microtardis.filters.exiftags import compile_tag_plan
+        from tardis.microtardis.filters.exiftags import apply_tag_plan
+
+        sections = parse_ini("[Beam]\r\nHV=20000\r\n"
+                             "[Scan]\r\nPixelWidth=2.5e-007\r\n"
+                             "[Vacuum]\r\nCHPressure=133.322368\r\n"
+                             "[Detectors]\r\nName=ETD\r\n"
+                             "[ETD]\r\nContrast=54.321\r\n")
+        plan = compile_tag_plan((['Beam', 'HV', 'HV', 'kV', 0.001],
+                                 ['Beam', 'Spot', 'Spot', None, None],
+                                 ['Scan', 'PixelWidth', 'PixelWidth', None, None],
+                                 ['Vacuum', 'CHPressure', 'CHPressure', None, None],
+                                 ['Detectors', 'Name', 'Name', None, None],
+                                 ['Detector_Name', 'Contrast', 'Contrast', None, None],
+                                 ))
+        metadata, pixel_width = apply_tag_plan(plan, sections)
+        self.assertEqual({'[Beam] HV': [20.0, 'kV'],
+                          '[Scan] PixelWidth': ['2.5e-007', None],
+                          '[Vacuum] CHPressure': ['1 Torr (1.333 mbar)', None],
+                          '[Detectors] Name': ['ETD', None],
+                          '[ETD] Contrast': [54.3, None],
+                          }, metadata)
+        self.assertEqual(2.5e-007, pixel_width)
+
+
+class SpectrumLoaderTestCase(TestCase):
+
+    def test_read_spectrum(self):
+        from os import path
+        import struct
+        from tardis.microtardis.spectra.loader import read_spectrum
+
+        here = path.abspath(path.dirname(__file__))
+        for (filename, datafile_type, offset, channels) in (
+                ('testing/Quanta200/test.spc', 'spc', 3840, 4000),
+                ('docs/_static/XL30.spt', 'spt', 7, 2048)):
+            f = open(path.join(here, filename), 'rb')
+            try:
+                values, energies = read_spectrum(f, datafile_type)
+                f.seek(offset)
+                expected = struct.unpack('<%di' % channels, f.read(channels * 4))
+            finally:
+                f.close()
+            self.assertEqual(channels, len(values))
+            self.assertEqual(list(expected), values.tolist())
+            # 10 eV per channel from 0 keV
+            self.assertEqual([0.0, 0.01, 0.02], energies[:3].tolist())
+
+    def test_preview(self):
+        from os import path
+        from StringIO import StringIO
+        import Image
+        from tardis.microtardis.spectra.loader import read_spectrum
+        from tardis.microtardis.spectra.preview import render_preview_png
+
+        filename = path.join(path.abspath(path.dirname(__file__)), 'testing/Quanta200/test.spc')
+        f = open(filename, 'rb')
+        try:
+            values, energies = read_spectrum(f, 'spc')
+        finally:
+            f.close()
+        png = render_preview_png(values, energies, ["Atomic=O, Line=K, Energy=0.5150, Height=2209"])
+        img = Image.open(StringIO(png))
+        self.assertEqual('PNG', img.format)
+        self.assertEqual((480, 360), img.size)
+
+
+class DownsampleTestCase(TestCase):
+
+    def test_downsample(self):
+        import numpy
+        from tardis.microtardis.spectra.axis import get_energies
+        from tardis.microtardis.spectra.downsample import lttb
+        from tardis.microtardis.spectra.downsample import minmax
+        from tardis.microtardis.spectra.downsample import select_range
+
+        values = numpy.arange(4000) % 97
+        values[1234] = 5000
+        energies = get_energies(4000, (10.0, 0.0))
+
+        kev, counts = select_range(energies, values, 1.0, 2.0)
+        self.assertEqual(101, len(counts))
+        self.assertEqual((1.0, 2.0), (kev[0], kev[-1]))
+
+        for downsample in (minmax, lttb):
+            kev, counts = downsample(energies, values, 200)
+            self.assertTrue(len(counts) <= 200)
+            self.assertEqual(5000, counts.max())
+            self.assertTrue((numpy.diff(kev) > 0).all())
+        kev, counts = lttb(energies, values, 200)
+        self.assertEqual(200, len(counts))
+        self.assertEqual((energies[0], energies[-1]), (kev[0], kev[-1]))
+
+
+class ExportTestCase(TestCase):
+
+    def test_streamed_zip(self):
+        import zipfile
+        from StringIO import StringIO
+        from tardis.microtardis.spectra.axis import get_energies
+        from tardis.microtardis.spectra.export import format_csv
+        from tardis.microtardis.spectra.export import iter_zip
+
+        csv = format_csv(range(4), get_energies(4, (10.0, 0.0)))
+        self.assertEqual('0,0\r\n10,1\r\n20,2\r\n30,3\r\n', csv)
+
+        pieces = list(iter_zip([('a.csv', csv), ('b.csv', 'x' * 100000)]))
+        self.assertEqual(3, len(pieces))
+        archive = zipfile.ZipFile(StringIO(''.join(pieces)))
+        self.assertEqual(None, archive.testzip())
+        self.assertEqual(csv, archive.read('a.csv'))
+        self.assertEqual('x' * 100000, archive.read('b.csv'))
+
+    def test_wide_csv_header(self):
+        import numpy
+        from tardis.microtardis.spectra import export
+        from tardis.microtardis.spectra.axis import get_energies
+
+        spectra = [('a,b.spc', numpy.arange(2), get_energies(2, (10.0, 0.0))),
+                   ('say "c".spc', numpy.arange(2), get_energies(2, (10.0, 0.0)))]
+        saved_iter_spectra = export.iter_spectra
+        export.iter_spectra = lambda datafiles: iter(spectra)
+        try:
+            csv = ''.join(export.export_wide_csv([]))
+        finally:
+            export.iter_spectra = saved_iter_spectra
+        self.assertEqual('eV,"a,b.spc","say ""c"".spc"\r\n0,0,0\r\n10,1,1\r\n', csv)
+
+
+class ParseCacheTestCase(TestCase):
+
+    def setUp(self):
+        from tempfile import mkdtemp
+        self.cache_path = mkdtemp()
+        self.saved_cache_path = getattr(settings, 'PARSE_CACHE_PATH', None)
+        settings.PARSE_CACHE_PATH = self.cache_path
+
+    def tearDown(self):
+        from shutil import rmtree
+        settings.PARSE_CACHE_PATH = self.saved_cache_path
+        rmtree(self.cache_path)
+
+    def test_cached_result(self):
+        import os
+        from os import path
+        from tardis.microtardis.filters.dispatcher import map_file
+        from tardis.microtardis.filters.parsecache import get_or_parse
+        from tardis.microtardis.filters.spctags import SPCTagsFilter
+
+        filename = path.join(path.abspath(path.dirname(__file__)), 'testing/Quanta200/test.spc')
+        data = map_file(filename)
+        spc_filter = SPCTagsFilter("EDAXGenesis_SPC", "http://rmmf.isis.rmit.edu.au/schemas")
+        parsed = []
+        def parse(data):
+            parsed.append(data)
+            return spc_filter.getSpectra(data)
+
+        metadata = get_or_parse('spc', filename, data, parse)
+        self.assertEqual(metadata, get_or_parse('spc', filename, data, parse))
+        self.assertEqual(1, len(parsed))
+        self.assertEqual(metadata, spc_filter.getSpectra(data))
+
+        # a modified file is parsed again
+        stat = os.stat(filename)
+        os.utime(filename, (stat.st_atime, stat.st_mtime + 1))
+        try:
+            get_or_parse('spc', filename, data, parse)
+        finally:
+            os.utime(filename, (stat.st_atime, stat.st_mtime))
+        self.assertEqual(2, len(parsed))
+
+    def test_cache_hit_skips_image(self):
+        from os import path
+        from tardis.microtardis.filters import exiftags
+        from tardis.microtardis.filters.dispatcher import map_file
+        from tardis.microtardis.filters.parsecache import lookup
+
+        filename = path.join(path.abspath(path.dirname(__file__)), 'testing/Quanta200/test.tif')
+        exif_filter = exiftags.EXIFTagsFilter("EXIF", "http://rmmf.isis.rmit.edu.au/schemas")
+        exifs = exif_filter.getExif(map_file(filename), exif_filter.metadata_tags)
+        exiftags.store('exif', filename, exifs)
+        self.assertEqual(exifs, lookup('exif', filename))
+
+        class Unopenable(object):
+            @staticmethod
+            def open(data):
+                raise AssertionError("image opened on a cache hit")
+
+        class Datafile(object):
+            id = 0
+
+        saved_image = exiftags.Image
+        saved_store = exiftags.store_raw_metadata
+        exiftags.Image = Unopenable
+        exiftags.store_raw_metadata = lambda instance, kind, instrument, raw: None
+        exif_filter.needsThumbnails = lambda instance, filepath: False
+        saved = []
+        exif_filter.saveInstrumentMetadata = lambda instance, instrument, raw: saved.append(raw)
+        try:
+            instrument = exif_filter.process(Datafile(), filename, map_file(filename))
+        finally:
+            exiftags.Image = saved_image
+            exiftags.store_raw_metadata = saved_store
+        self.assertEqual('Quanta200', instrument)
+        self.assertTrue(saved)
+
+
+class SpectraCacheTestCase(TestCase):
+
+    def setUp(self):
+        from tempfile import mkdtemp
+        self.cache_path = mkdtemp()
+        self.saved_cache_path = getattr(settings, 'SPECTRA_CACHE_PATH', None)
+        settings.SPECTRA_CACHE_PATH = self.cache_path
+
+    def tearDown(self):
+        from shutil import rmtree
+        settings.SPECTRA_CACHE_PATH = self.saved_cache_path
+        rmtree(self.cache_path)
+
+    def test_cached_png(self):
+        from os import path
+        from tardis.microtardis.spectra import cache
+
+        filename = path.join(path.abspath(path.dirname(__file__)), 'testing/Quanta200/test.spc')
+        self.assertEqual(None, cache.find_png(1, 'spc', 'small', filename))
+
+        etag = cache.store_png(1, 'spc', 'small', filename, 'png 1')
+        entry, found_etag = cache.find_png(1, 'spc', 'small', filename)
+        self.assertEqual(etag, found_etag)
+        self.assertEqual('png 1', cache.read_png(entry))
+        self.assertEqual(None, cache.find_png(1, 'spc', 'full', filename))
+
+        # a new image replaces the old one
+        self.assertNotEqual(etag, cache.store_png(1, 'spc', 'small', filename, 'png 2'))
+        entry, found_etag = cache.find_png(1, 'spc', 'small', filename)
+        self.assertEqual('png 2', cache.read_png(entry))
+
+        # re-extracting the metadata removes the images
+        cache.invalidate(1)
+        self.assertEqual(None, cache.find_png(1, 'spc', 'small', filename))
+
+
+class RenderPoolTestCase(TestCase):
+
+    def setUp(self):
+        from tardis.microtardis.spectra import pool
+        self.saved_settings = dict((name, getattr(settings, name, None)) for name in
+                                   ('SPECTRA_RENDER_PROCESSES', 'SPECTRA_RENDER_QUEUE_SIZE',
+                                    'SPECTRA_RENDER_TIMEOUT'))
+        settings.SPECTRA_RENDER_PROCESSES = 1
+        settings.SPECTRA_RENDER_QUEUE_SIZE = 1
+        settings.SPECTRA_RENDER_TIMEOUT = 1
+
+        # the render processes are forked, so they draw with this too
+        def draw_png(values, energies, size, peaks):
+            import os
+            import time
+            time.sleep(values)
+            return 'png %d' % os.getpid()
+        self.saved_draw_png = pool.draw_png
+        pool.draw_png = draw_png
+
+    def tearDown(self):
+        from tardis.microtardis.spectra import pool
+        pool.stop_pool()
+        pool.draw_png = self.saved_draw_png
+        for name, value in self.saved_settings.items():
+            setattr(settings, name, value)
+
+    def test_render_in_process(self):
+        import os
+        from tardis.microtardis.spectra import pool
+
+        settings.SPECTRA_RENDER_PROCESSES = 0
+        self.assertEqual('png %d' % os.getpid(), pool.render(0, [], 'full'))
+        self.assertEqual([], pool._workers)
+
+    def test_queue_bound(self):
+        from tardis.microtardis.spectra import pool
+
+        pool.start_pool()
+        self.assertTrue(pool._slots.acquire(False))
+        try:
+            self.assertRaises(pool.RenderError, pool.render, 0, [], 'full')
+        finally:
+            pool._slots.release()
+        self.assertTrue(pool.render(0, [], 'full').startswith('png'))
+
+    def test_timeout_replaces_render_process(self):
+        from tardis.microtardis.spectra import pool
+
+        pool.start_pool()
+        pid = pool._workers[0].process.pid
+        self.assertEqual('png %d' % pid, pool.render(0, [], 'full'))
+        self.assertRaises(pool.RenderError, pool.render, 5, [], 'full')
+        self.assertEqual(1, len(pool._workers))
+        self.assertNotEqual(pid, pool._workers[0].process.pid)
+        self.assertEqual('png %d' % pool._workers[0].process.pid,
+                         pool.render(0, [], 'full'))
+
+
+class FilterQueueTestCase(TestCase):
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from tardis.microtardis import registry
+        from tardis.microtardis.filters import instruments
+        # the test rollbacks leave the cached schemas, parameter names and
+        # dataset instruments
+        registry.invalidate()
+        instruments.reset()
+        user = 'tardis_user1'
+        pwd = 'secret'
+        email = ''
+        self.user = User.objects.create_user(user, email, pwd)
+
+    def test_queue_job(self):
+        from os import path
+        from tardis.microtardis.models import Filter_Job
+        from tardis.microtardis.filters.queue import enqueue_job
+        from tardis.microtardis.filters.queue import claim_jobs
+        from tardis.microtardis.filters.queue import run_job
+
+        exp = models.Experiment(title='exp: test filter queue',
+                                institution_name='rmit',
+                                approved=True,
+                                created_by=self.user,
+                                public=False)
+        exp.save()
+        dataset = models.Dataset(description="dataset description...", experiment=exp)
+        dataset.save()
+
+        filename = path.join(path.abspath(path.dirname(__file__)), 'testing/Quanta200/test.spc')
+        df_file = models.Dataset_File(dataset=dataset, filename='test.spc', url=filename, protocol='staging')
+        df_file.save()
+
+        # repeated saves only queue one job
+        enqueue_job(models.Dataset_File, instance=df_file, created=True)
+        enqueue_job(models.Dataset_File, instance=df_file, created=False)
+        jobs = Filter_Job.objects.filter(datafile=df_file)
+        self.assertEqual(1, jobs.count())
+        self.assertEqual(Filter_Job.PENDING, jobs[0].status)
+
+        job_ids = claim_jobs(10)
+        self.assertEqual([jobs[0].id], job_ids)
+        self.assertEqual([], claim_jobs(10))
+        self.assertEqual(Filter_Job.RUNNING, Filter_Job.objects.get(pk=job_ids[0]).status)
+
+        self.assertEqual(Filter_Job.DONE, run_job(job_ids[0]))
+        job = Filter_Job.objects.get(pk=job_ids[0])
+        self.assertEqual(1, job.attempts)
+        sch = models.Schema.objects.get(name="EDAXGenesis_SPC")
+        self.assertTrue(models.DatafileParameterSet.objects.filter(schema=sch, dataset_file=df_file).exists())
+
+    def test_failed_job_is_retried(self):
+        from os import path
+        from tardis.microtardis.models import Filter_Job
+        from tardis.microtardis.filters.queue import claim_jobs
+        from tardis.microtardis.filters.queue import run_job
+
+        exp = models.Experiment(title='exp: test filter queue',
+                                institution_name='rmit',
+                                approved=True,
+                                created_by=self.user,
+                                public=False)
+        exp.save()
+        dataset = models.Dataset(description="dataset description...", experiment=exp)
+        dataset.save()
+
+        filename = path.join(path.abspath(path.dirname(__file__)), 'testing/Quanta200/missing.spc')
+        df_file = models.Dataset_File(dataset=dataset, filename='missing.spc', url=filename, protocol='staging')
+        df_file.save()
+        job = Filter_Job(datafile=df_file)
+        job.save()
+
+        saved_max_attempts = getattr(settings, 'FILTER_QUEUE_MAX_ATTEMPTS', 3)
+        settings.FILTER_QUEUE_MAX_ATTEMPTS = 2
+        try:
+            self.assertEqual([job.id], claim_jobs(10))
+            self.assertEqual(Filter_Job.PENDING, run_job(job.id))
+            self.assertEqual([job.id], claim_jobs(10))
+            self.assertEqual(Filter_Job.FAILED, run_job(job.id))
+        finally:
+            settings.FILTER_QUEUE_MAX_ATTEMPTS = saved_max_attempts
+        job = Filter_Job.objects.get(pk=job.id)
+        self.assertEqual(2, job.attempts)
+        self.assertTrue(job.last_error)
+
+    def test_stale_and_deleted_jobs(self):
+        from datetime import datetime
+        from datetime import timedelta
+        from os import path
+        from tardis.microtardis.models import Filter_Job
+        from tardis.microtardis.filters.queue import claim_jobs
+        from tardis.microtardis.filters.queue import run_job
+
+        exp = models.Experiment(title='exp: test filter queue',
+                                institution_name='rmit',
+                                approved=True,
+                                created_by=self.user,
+                                public=False)
+        exp.save()
+        dataset = models.Dataset(description="dataset description...", experiment=exp)
+        dataset.save()
+
+        filename = path.join(path.abspath(path.dirname(__file__)), 'testing/Quanta200/test.spc')
+        df_file = models.Dataset_File(dataset=dataset, filename='test.spc', url=filename, protocol='staging')
+        df_file.save()
+
+        job = Filter_Job(datafile=df_file)
+        job.save()
+        self.assertEqual([job.id], claim_jobs(10))
+
+        # a job left running by a dead runner is claimed again
+        Filter_Job.objects.filter(pk=job.id).update(
+            updated_time=datetime.now() - timedelta(days=1))
+        self.assertEqual([job.id], claim_jobs(10))
+
+        job.delete()
+        self.assertEqual(None, run_job(job.id))
+
+
+class FingerprintTestCase(TestCase):
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from tardis.microtardis import registry
+        from tardis.microtardis.filters import instruments
+        # the test rollbacks leave the cached schemas, parameter names and
+        # dataset instruments
+        registry.invalidate()
+        instruments.reset()
+        user = 'tardis_user1'
+        pwd = 'secret'
+        email = ''
+        self.user = User.objects.create_user(user, email, pwd)
+
+    def test_unchanged_file_is_skipped(self):
+        from os import path
+        from tardis.microtardis.models import Datafile_Fingerprint
+        from tardis.microtardis.filters import load_filters
+        from tardis.microtardis.filters import metrics
+        from tardis.microtardis.filters.dispatcher import FilterDispatcher
+
+        exp = models.Experiment(title='exp: test fingerprint',
+                                institution_name='rmit',
+                                approved=True,
+                                created_by=self.user,
+                                public=False)
+        exp.save()
+        dataset = models.Dataset(description="dataset description...", experiment=exp)
+        dataset.save()
+
+        filename = path.join(path.abspath(path.dirname(__file__)), 'testing/NovaNanoSEM/test.spc')
+        df_file = models.Dataset_File(dataset=dataset, filename='test.spc', url=filename, protocol='staging')
+        df_file.save()
+
+        dispatcher = FilterDispatcher(load_filters())
+        dispatcher(models.Dataset_File, instance=df_file, created=False)
+        self.assertEqual(1, Datafile_Fingerprint.objects.filter(datafile=df_file).count())
+
+        skipped = metrics.get_counters().get('fingerprint.unchanged', 0)
+        dispatcher(models.Dataset_File, instance=df_file, created=False)
+        self.assertEqual(skipped + 1, metrics.get_counters()['fingerprint.unchanged'])
+
+        # forced re-extraction ignores the fingerprint
+        dispatcher(models.Dataset_File, instance=df_file, created=False, force=True)
+        self.assertEqual(skipped + 1, metrics.get_counters()['fingerprint.unchanged'])
+
+    def test_unknown_instrument_is_retried(self):
+        import shutil
+        from os import path
+        from tempfile import mkdtemp
+        from tardis.microtardis.models import Datafile_Fingerprint
+        from tardis.microtardis.filters import load_filters
+        from tardis.microtardis.filters.dispatcher import FilterDispatcher
+
+        exp = models.Experiment(title='exp: test fingerprint',
+                                institution_name='rmit',
+                                approved=True,
+                                created_by=self.user,
+                                public=False)
+        exp.save()
+        dataset = models.Dataset(description="dataset description...", experiment=exp)
+        dataset.save()
+
+        # neither the path nor the dataset name the instrument
+        tempdir = mkdtemp()
+        filename = path.join(tempdir, 'test.spc')
+        shutil.copy(path.join(path.abspath(path.dirname(__file__)), 'testing/NovaNanoSEM/test.spc'), filename)
+        try:
+            df_file = models.Dataset_File(dataset=dataset, filename='test.spc', url=filename, protocol='staging')
+            df_file.save()
+
+            dispatcher = FilterDispatcher(load_filters())
+            dispatcher(models.Dataset_File, instance=df_file, created=False)
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertEqual(0, Datafile_Fingerprint.objects.filter(datafile=df_file).count())
+
+
+class RawMetadataTestCase(TestCase):
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from tardis.microtardis import registry
+        from tardis.microtardis.filters import instruments
+        # the test rollbacks leave the cached schemas, parameter names and
+        # dataset instruments
+        registry.invalidate()
+        instruments.reset()
+        user = 'tardis_user1'
+        pwd = 'secret'
+        email = ''
+        self.user = User.objects.create_user(user, email, pwd)
+
+    def test_remap(self):
+        from os import path
+        from tardis.microtardis.models import Datafile_Raw_Metadata
+        from tardis.microtardis.filters import rawmetadata
+
+        exp = models.Experiment(title='exp: test raw metadata',
+                                institution_name='rmit',
+                                approved=True,
+                                created_by=self.user,
+                                public=False)
+        exp.save()
+        dataset = models.Dataset(description="dataset description...", experiment=exp)
+        dataset.save()
+
+        filename = path.join(path.abspath(path.dirname(__file__)), 'testing/Quanta200/test.spc')
+        df_file = models.Dataset_File(dataset=dataset, filename='test.spc', url=filename, protocol='staging')
+        df_file.save()
+
+        record = Datafile_Raw_Metadata.objects.get(datafile=df_file, kind='SPC header')
+        self.assertEqual('Quanta200', record.instrument)
+        self.assertEqual(3840, len(rawmetadata.decode(record.data)))
+
+        # the parameters come back from the stored header alone
+        models.DatafileParameterSet.objects.filter(dataset_file=df_file).delete()
+        record_ids = rawmetadata.select_raw_metadata(kinds=['SPC header'])
+        self.assertEqual(1, rawmetadata.remap(record_ids))
+        sch = models.Schema.objects.get(name="EDAXGenesis_SPC")
+        datafileparameterset = models.DatafileParameterSet.objects.get(schema=sch, dataset_file=df_file)
+        psm = ParameterSetManager(parameterset=datafileparameterset)
+        self.assertEqual(10, len(psm.parameters))
+        self.assertEqual(str(psm.get_param("Acc. Voltage").numerical_value), "19.981")
+
+
+class BackfillTestCase(TestCase):
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from tardis.microtardis import registry
+        from tardis.microtardis.filters import instruments
+        # the test rollbacks leave the cached schemas, parameter names and
+        # dataset instruments
+        registry.invalidate()
+        instruments.reset()
+        user = 'tardis_user1'
+        pwd = 'secret'
+        email = ''
+        self.user = User.objects.create_user(user, email, pwd)
+
+    def test_reextract_selected_datafiles(self):
+        from datetime import datetime
+        from os import path
+        from tardis.microtardis.models import Datafile_Harvest
+        from tardis.microtardis.filters.backfill import select_datafiles
+        from tardis.microtardis.filters.backfill import reextract
+
+        exp = models.Experiment(title='exp: test backfill',
+                                institution_name='rmit',
+                                approved=True,
+                                created_by=self.user,
+                                public=False)
+        exp.save()
+        dataset = models.Dataset(description="dataset description...", experiment=exp)
+        dataset.save()
+
+        filename = path.join(path.abspath(path.dirname(__file__)), 'testing/Quanta200/test.spc')
+        df_files = []
+        for harvested in (datetime(2012, 3, 1, 15, 0), datetime(2012, 3, 2, 0, 0)):
+            df_file = models.Dataset_File(dataset=dataset, filename='test.spc', url=filename, protocol='staging')
+            df_file.save()
+            Datafile_Harvest.objects.filter(datafile=df_file).update(created_time=harvested)
+            df_files.append(df_file)
+
+        # a datafile harvested in the afternoon of the last day is included
+        self.assertEqual([df_files[0].id],
+                         select_datafiles(datasets=[dataset.id],
+                                          since=datetime(2012, 3, 1),
+                                          until=datetime(2012, 3, 2)))
+        self.assertEqual([df_files[1].id],
+                         select_datafiles(datasets=[dataset.id],
+                                          since=datetime(2012, 3, 2)))
+
+        self.assertEqual(1, reextract([df_files[0].id]))
+        sch = models.Schema.objects.get(name="EDAXGenesis_SPC")
+        self.assertTrue(models.DatafileParameterSet.objects.filter(schema=sch, dataset_file=df_files[0]).exists())
+
+        # a database error only fails its own datafile
+        from django.db import DatabaseError
+        from tardis.microtardis.filters import backfill
+
+        def failing_hook(sender, instance, **kwargs):
+            if instance.id == df_files[0].id:
+                raise DatabaseError("deadlock")
+        saved_get_hooks = backfill.get_hooks
+        backfill.get_hooks = lambda: [('failing', failing_hook)] + saved_get_hooks()
+        try:
+            self.assertEqual(1, reextract([df_files[0].id, df_files[1].id]))
+        finally:
+            backfill.get_hooks = saved_get_hooks
+        self.assertTrue(models.DatafileParameterSet.objects.filter(schema=sch, dataset_file=df_files[1]).exists())
+
+
+class PersistenceTestCase(TestCase):
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from tardis.microtardis import registry
+        registry.invalidate()
+        user = 'tardis_user1'
+        pwd = 'secret'
+        email = ''
+        self.user = User.objects.create_user(user, email, pwd)
+
+    def test_save_parameters_merges(self):
+        from tardis.microtardis.filters.persistence import save_parameters
+
+        exp = models.Experiment(title='exp: test persistence',
+                                institution_name='rmit',
+                                approved=True,
+                                created_by=self.user,
+                                public=False)
+        exp.save()
+        dataset = models.Dataset(description="dataset description...", experiment=exp)
+        dataset.save()
+        df_file = models.Dataset_File(dataset=dataset, filename='test.tif',
+                                      url='/data/test.tif', protocol='staging')
+        df_file.save()
+        schema = models.Schema(namespace='http://rmmf.isis.rmit.edu.au/schemas/persistence',
+                               name='Persistence', type=models.Schema.DATAFILE)
+        schema.save()
+
+        metadata = {'[Beam] HV': [20.0, 'kV'], '[User] Date': ['11/09/2010', None]}
+        ps = save_parameters(df_file, schema, metadata)
+
+        # a re-extraction which maps one more tag adds just that parameter,
+        # with a fixed number of queries
+        metadata['[Stage] WorkingDistance'] = [5.2, 'mm']
+        with self.assertNumQueries(6):
+            self.assertEqual(ps, save_parameters(df_file, schema, metadata))
+
+        parameters = models.DatafileParameter.objects.filter(parameterset__dataset_file=df_file)
+        names = sorted(parameters.values_list('name__name', flat=True))
+        self.assertEqual(['[Beam] HV', '[Stage] WorkingDistance', '[User] Date'], names)
+        self.assertEqual(1, models.DatafileParameterSet.objects.filter(dataset_file=df_file).count())
+        self.assertEqual(5.2, parameters.get(name__name='[Stage] WorkingDistance').numerical_value)
+        self.assertEqual('11/09/2010', parameters.get(name__name='[User] Date').string_value)
+
+
+class InstrumentTestCase(TestCase):
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from tardis.microtardis.filters import instruments
+        instruments.reset()
+        user = 'tardis_user1'
+        pwd = 'secret'
+        email = ''
+        self.user = User.objects.create_user(user, email, pwd)
+
+    def create_dataset(self, exp, instrument):
+        dataset = models.Dataset(description="dataset description...", experiment=exp)
+        dataset.save()
+        schema, created = models.Schema.objects.get_or_create(
+            namespace='http://rmmf.isis.rmit.edu.au/schemas/harvest',
+            defaults={'name': 'Harvest', 'type': models.Schema.DATASET})
+        name, created = models.ParameterName.objects.get_or_create(
+            schema=schema, name='source', full_name='Source',
+            data_type=models.ParameterName.STRING)
+        parameterset = models.DatasetParameterSet(schema=schema, dataset=dataset)
+        parameterset.save()
+        models.DatasetParameter(parameterset=parameterset, name=name,
+            string_value='http://rmmf.isis.rmit.edu.au/instruments/%s' % instrument).save()
+        return dataset
+
+    def test_dataset_instrument(self):
+        from tardis.microtardis.models import Dataset_Harvest
+        from tardis.microtardis.filters import instruments
+
+        exp = models.Experiment(title='exp: test instruments',
+                                institution_name='rmit',
+                                approved=True,
+                                created_by=self.user,
+                                public=False)
+        exp.save()
+        quanta = self.create_dataset(exp, 'Quanta200')
+        nova = self.create_dataset(exp, 'NovaNanoSEM')
+        known = {'Quanta200': None, 'NovaNanoSEM': None}
+
+        lookups = []
+        saved_find = instruments.find_dataset_instrument
+        def find_dataset_instrument(dataset_id):
+            lookups.append(dataset_id)
+            return saved_find(dataset_id)
+        instruments.find_dataset_instrument = find_dataset_instrument
+        saved_size = getattr(settings, 'INSTRUMENT_CACHE_SIZE', 1024)
+        settings.INSTRUMENT_CACHE_SIZE = 1
+        try:
+            for i in range(3):
+                df_file = models.Dataset_File(dataset=quanta, filename='test%d.spc' % i,
+                                              url='/data/test%d.spc' % i, protocol='staging')
+                df_file.save()
+                self.assertEqual('Quanta200', instruments.get_instrument(
+                                 df_file, '/data/test%d.spc' % i, known))
+            # resolved from the metadata once, then remembered
+            self.assertEqual([quanta.id], lookups)
+            self.assertEqual(['Quanta200'], list(Dataset_Harvest.objects.filter(dataset=quanta)
+                                                 .values_list('instrument', flat=True)))
+
+            df_file = models.Dataset_File(dataset=nova, filename='test.spc',
+                                          url='/data/test.spc', protocol='staging')
+            df_file.save()
+            self.assertEqual('NovaNanoSEM', instruments.get_instrument(
+                             df_file, '/data/test.spc', known))
+            self.assertEqual([quanta.id, nova.id], lookups)
+
+            # the first dataset has been evicted, it is read back from
+            # Dataset_Harvest rather than the metadata
+            self.assertEqual([nova.id], list(instruments._dataset_instruments))
+            self.assertEqual('Quanta200', instruments.get_dataset_instrument(quanta.id))
+            self.assertEqual([quanta.id, nova.id], lookups)
+        finally:
+            instruments.find_dataset_instrument = saved_find
+            settings.INSTRUMENT_CACHE_SIZE = saved_size
+
+
+class RegistryTestCase(TestCase):
+
+    def setUp(self):
+        from tardis.microtardis import registry
+        registry.invalidate()
+
+    def test_changes_from_other_processes_expire(self):
+        from tardis.microtardis import registry
+
+        schema = models.Schema(namespace='http://rmmf.isis.rmit.edu.au/schemas/test',
+                               name='Test', type=models.Schema.DATAFILE)
+        schema.save()
+        self.assertEqual('Test', registry.get_schema(schema.namespace).name)
+
+        # an update sends no signals, like a change made by another process
+        models.Schema.objects.filter(id=schema.id).update(name='Renamed')
+        self.assertEqual('Test', registry.get_schema(schema.namespace).name)
+
+        registry._expires = 0
+        self.assertEqual('Renamed', registry.get_schema(schema.namespace).name)
+
+    def test_failed_transaction_clears_cache(self):
+        from tardis.microtardis import registry
+        from tardis.microtardis.filters.persistence import in_transaction
+
+        def fail():
+            registry.get_or_create_schema('http://rmmf.isis.rmit.edu.au/schemas/rolled-back',
+                                          'Rolled back')
+            self.assertNotEqual(None, registry.get_schema(
+                'http://rmmf.isis.rmit.edu.au/schemas/rolled-back'))
+            raise ValueError("corrupt file")
+
+        self.assertRaises(ValueError, in_transaction, fail)
+        self.assertEqual(None, registry._schemas)
+        self.assertEqual({}, registry._parameter_names)
+
+
+class InstrumentationTestCase(TestCase):
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from tardis.microtardis import registry
+        from tardis.microtardis.filters import instruments
+        # the test rollbacks leave the cached schemas, parameter names and
+        # dataset instruments
+        registry.invalidate()
+        instruments.reset()
+        user = 'tardis_user1'
+        pwd = 'secret'
+        email = ''
+        self.user = User.objects.create_user(user, email, pwd)
+
+    def test_filter_metrics(self):
+        from os import path
+        from django.test.client import RequestFactory
+        from django.utils import simplejson as json
+        from tardis.microtardis.filters import load_filters
+        from tardis.microtardis.filters import metrics
+        from tardis.microtardis.filters.dispatcher import FilterDispatcher
+        from tardis.microtardis.views import filter_metrics
+
+        exp = models.Experiment(title='exp: test filter metrics',
+                                institution_name='rmit',
+                                approved=True,
+                                created_by=self.user,
+                                public=False)
+        exp.save()
+        dataset = models.Dataset(description="dataset description...", experiment=exp)
+        dataset.save()
+
+        filename = path.join(path.abspath(path.dirname(__file__)), 'testing/Quanta200/test.spc')
+        df_file = models.Dataset_File(dataset=dataset, filename='test.spc', url=filename, protocol='staging')
+        df_file.save()
+
+        metrics.reset()
+        dispatcher = FilterDispatcher(load_filters())
+        dispatcher(models.Dataset_File, instance=df_file, created=False)
+        dispatcher(models.Dataset_File, instance=df_file, created=False)
+
+        prefix = 'filter.SPCTagsFilter.spc.Quanta200'
+        counters = metrics.get_counters()
+        self.assertEqual(1, counters['%s.parsed' % prefix])
+        self.assertEqual(1, counters['filter.SPCTagsFilter.spc.unknown.skipped'])
+        histograms = metrics.get_histograms()
+        self.assertEqual(1, histograms['%s.seconds' % prefix]['count'])
+        self.assertEqual(path.getsize(filename), histograms['%s.bytes' % prefix]['max'])
+        self.assertTrue(histograms['%s.queries' % prefix]['max'] > 0)
+
+        request = RequestFactory().get('/microtardis/metrics/')
+        request.user = self.user
+        self.assertEqual(403, filter_metrics(request).status_code)
+        self.user.is_staff = True
+        response = filter_metrics(request)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, json.loads(response.content)['counters']['%s.parsed' % prefix])
+
+    def test_merge_worker_metrics(self):
+        from tardis.microtardis.filters import metrics
+
+        metrics.reset()
+        metrics.incr('files', 2)
+        metrics.observe('seconds', 0.5)
+        collected = metrics.collect()
+        self.assertEqual({}, metrics.get_counters())
+
+        metrics.incr('files')
+        metrics.observe('seconds', 3)
+        metrics.merge(collected)
+        self.assertEqual(3, metrics.get_counters()['files'])
+        histogram = metrics.get_histograms()['seconds']
+        self.assertEqual(2, histogram['count'])
+        self.assertEqual(0.5, histogram['min'])
+        self.assertEqual(3, histogram['max'])
+        self.assertEqual({0.5: 1, 4.0: 1}, histogram['buckets'])
+
+    def test_query_counter_keeps_debug_log(self):
+        from django.conf import settings
+        from django.db import connection
+        from tardis.microtardis.filters.instrumentation import QueryCounter
+
+        saved_debug = settings.DEBUG
+        saved_debug_cursor = connection.use_debug_cursor
+        settings.DEBUG = True
+        connection.use_debug_cursor = None
+        try:
+            counter = QueryCounter()
+            counter.start()
+            list(models.Experiment.objects.all())
+            self.assertEqual(1, counter.stop())
+            self.assertTrue(connection.queries)
+            self.assertEqual(None, connection.use_debug_cursor)
+        finally:
+            settings.DEBUG = saved_debug
+            connection.use_debug_cursor = saved_debug_cursor
+
+
+class ImportTimeTestCase(TestCase):
+
+    # seconds a fresh process may spend importing the views and filters;
+    # generous, so a loaded test machine doesn't fail it, while loading the
+    # plotting stack at import time would
+    IMPORT_TIME_BUDGET = 10.0
+    # only loaded when a spectrum is read or drawn
+    LAZY_MODULES = ('matplotlib', 'pylab', 'numpy')
+
+    def test_import_time_budget(self):
+        import os
+        import sys
+        from subprocess import Popen, PIPE
+
+        script = "\n".join([
+            "import sys, time",
+            "from django.conf import settings",
+            "settings.INSTALLED_APPS",
+            "start = time.time()",
+            "import tardis.microtardis.views",
+            "import tardis.microtardis.filters",
+            "import tardis.microtardis.filters.exiftags",
+            "import tardis.microtardis.filters.spctags",
+            "import tardis.microtardis.filters.dattags",
+            "print time.time() - start",
+            "print ','.join(name for name in %r if name in sys.modules) or '-'"
+                % (self.LAZY_MODULES,),
+            ])
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        process = Popen([sys.executable, '-c', script], env=env, stdout=PIPE)
+        output = process.communicate()[0]
+        self.assertEqual(0, process.returncode)
+        seconds, loaded = output.split()[-2:]
+
+        self.assertEqual('-', loaded, "importing loaded %s" % loaded)
+        self.assertTrue(float(seconds) < self.IMPORT_TIME_BUDGET,
+                        "importing took %ss, the budget is %ss" %
+                        (seconds, self.IMPORT_TIME_BUDGET))
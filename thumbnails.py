@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2011-2011, RMIT e-Research Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2011, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+thumbnails.py
+
+JPEG thumbnails of the instrument images, written by the EXIF filter when an
+image is saved and served by :func:`tardis.microtardis.views.display_thumbnails`.
+
+"""
+import os
+
+import Image
+
+from django.conf import settings
+
+
+# [ThumbSize, Extenstion]
+THUMBNAILS = [(None,       ".jpg"),
+              ((400, 400), "_small.jpg")
+              ]
+
+
+def thumbnails_exist(datafile):
+    """Return True if all the thumbnails of a datafile have been written.
+    """
+    basepath = settings.THUMBNAILS_PATH
+    for size, extention in THUMBNAILS:
+        if not os.path.exists(os.path.join(basepath, str(datafile.id) + extention)):
+            return False
+    return True
+
+
+def write_thumbnails(datafile, img):
+    basepath = settings.THUMBNAILS_PATH
+    if not os.path.exists(basepath):
+        os.makedirs(basepath)
+    
+    for thumb in THUMBNAILS:
+        size = thumb[0]
+        extention = thumb[1]
+        if size: # None for creating thumbnail with original size
+            img.thumbnail( size, Image.ANTIALIAS )
+        if img.mode != "L": 
+            # "L": 8-bit grayscale TIFF images, PIL can process it without problem.
+            # "I;16": 16-bit grayscale TIFF images, need conversion before processing it.
+            img = img.convert('I')
+            table=[ i/256 for i in range(65536) ]
+            img = img.point(table, 'L')
+        thumbname = str(datafile.id) + extention
+        thumbpath = os.path.join(basepath, thumbname)
+        out = file(thumbpath, "w")
+        try:
+            img.save(out, "JPEG")
+        finally:
+            out.close()
@@ -16,10 +16,13 @@ urlpatterns = patterns('tardis.microtardis.views',
     (r'^microtardis/spectra_png/(?P<size>[\w\.]+)/(?P<datafile_id>\d+)/(?P<datafile_type>[\w\.]+)/$', 'get_spectra_png'),
     (r'^microtardis/spectra_csv/(?P<datafile_id>\d+)/$', 'get_spectra_csv'),
     (r'^microtardis/spectra_json/(?P<datafile_id>\d+)/$', 'get_spectra_json'),
+    (r'^microtardis/spectrum_data/(?P<dataset_file_id>\d+)/$', 'get_spectrum_data'),
+    (r'^microtardis/spectra_export/(?P<dataset_id>\d+)/$', 'export_dataset_spectra'),
     (r'^microtardis/thumbnails/(?P<size>[\w\.]+)/(?P<datafile_id>[\w\.]+)/$', 'display_thumbnails'),
     (r'^microtardis/(?P<datafile_id>\d+)/(?P<datafile_type>[\w\.]+)/$', 'direct_to_thumbnail_html'),
     (r'^microtardis/hide/$', 'hide_objects'),
     (r'^microtardis/unhide/$', 'unhide_objects'),
+    (r'^microtardis/metrics/$', 'filter_metrics'),
 )
 
 # Media for MicroTardis
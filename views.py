@@ -1,11 +1,4 @@
 import os
-import Image
-import imghdr
-import struct
-import csv
-import StringIO
-import numpy
-import urllib2
 import hashlib
 import json
 import sys
@@ -14,11 +7,15 @@ from django.template import Context
 from django.http import HttpResponse
 from django.http import HttpResponseRedirect
 from django.http import HttpResponseForbidden
+from django.http import HttpResponseBadRequest
+from django.http import HttpResponseNotModified
 from django.views.decorators.cache import never_cache
 from django.conf import settings
 from django.utils import simplejson as json
 from django.shortcuts import render_to_response
 from django.core.urlresolvers import reverse
+from django.utils.http import parse_etags
+from django.utils.http import quote_etag
 # for experiment_description
 from django.contrib.auth.models import User
 # for retrieve_datafile_list
@@ -60,45 +57,39 @@ from tardis.microtardis.models import Dataset_Hidden
 from tardis.microtardis.models import Datafile_Hidden
 from tardis.microtardis.models import Dataset_Harvest
 from tardis.microtardis.models import Datafile_Harvest
+from tardis.microtardis import registry
 
 # for view_experiment
 from tardis.urls import getTardisApps
 
-# import and configure matplotlib library
-try:
-    os.environ['HOME'] = settings.MATPLOTLIB_HOME
-    import matplotlib
-    matplotlib.use('Agg')
-    import matplotlib.pyplot as pyplot
-    is_matplotlib_imported = True
-except ImportError:
-    is_matplotlib_imported = False
     
 
 @never_cache
 @authz.datafile_access_required
 def retrieve_parameters(request, dataset_file_id):
+    schemas = registry.get_schemas()
     # get schema id of EDAX Genesis spectra schema
-    schema_spc = Schema.objects.filter(name="EDAXGenesis_SPC")
     schema_ids_spc = []
-    for schema in schema_spc:
-        schema_ids_spc.append(schema.id)
+    for schema in schemas:
+        if schema.name == "EDAXGenesis_SPC":
+            schema_ids_spc.append(schema.id)
     field_order_spc = ["Sample Type (Label)", "Preset", "Live Time", "Acc. Voltage"]
     
     # get schema id of EXIF image metadata schema
-    schema_exif = Schema.objects.filter(name__endswith="EXIF")
     schema_ids_exif = []
-    for schema in schema_exif:
-        schema_ids_exif.append(schema.id)
+    for schema in schemas:
+        if (schema.name or '').endswith("EXIF"):
+            schema_ids_exif.append(schema.id)
     field_order_exif = ["[User] Date", "[User] Time"]
 
-    datafileparametersets = DatafileParameterSet.objects.filter(dataset_file__pk=dataset_file_id)
+    datafileparametersets = DatafileParameterSet.objects.filter(dataset_file__pk=dataset_file_id) \
+                                                        .select_related('schema')
     parametersets = {}
     for parameterset in datafileparametersets:
         unsorted = {}
         sorted = []
         # get list of parameters
-        parameters = parameterset.datafileparameter_set.all()
+        parameters = parameterset.datafileparameter_set.select_related('name')
         for parameter in parameters:
             unsorted[str(parameter.name.full_name)] = parameter
                 
@@ -207,6 +198,7 @@ def login(request):
         # user doesn't exist, create one if EMBS authentication succeeded
         
         # authenticate username and password with EMBS system
+        import urllib2
         embs_url = settings.EMBS_URL
         embs_url += "username=%s&passwordmd5=%s" % ( str(username).lower(), 
                                                      hashlib.md5(password).hexdigest() )
@@ -696,35 +688,6 @@ def retrieve_datafile_list(request, dataset_id, template_name='tardis_portal/aja
 
 
 
-def write_thumbnails(datafile, img):
-    basepath = settings.THUMBNAILS_PATH
-    if not os.path.exists(basepath):
-        os.makedirs(basepath)
-    
-    # [ThumbSize, Extenstion]
-    thumbnails = [(None,       ".jpg"),
-                  ((400, 400), "_small.jpg")
-                  ]
-    
-    for thumb in thumbnails:
-        size = thumb[0]
-        extention = thumb[1]
-        if size: # None for creating thumbnail with original size
-            img.thumbnail( size, Image.ANTIALIAS )
-        if img.mode != "L": 
-            # "L": 8-bit grayscale TIFF images, PIL can process it without problem.
-            # "I;16": 16-bit grayscale TIFF images, need conversion before processing it.
-            img = img.convert('I')
-            table=[ i/256 for i in range(65536) ]
-            img = img.point(table, 'L')
-        thumbname = str(datafile.id) + extention
-        thumbpath = os.path.join(basepath, thumbname)
-        out = file(thumbpath, "w")
-        try:
-            img.save(out, "JPEG")
-        finally:
-            out.close()
-        
 def display_thumbnails(request, size, datafile_id):
     basepath = settings.THUMBNAILS_PATH
     datafile = Dataset_File.objects.get(pk=datafile_id)
@@ -741,156 +704,186 @@ def direct_to_thumbnail_html(request, datafile_id, datafile_type):
     return render_to_response("microtardis/thumbnail.html", {"datafile_id": datafile_id,
                                                  "datafile_type": datafile_type,})
 
-def get_spc_spectra(datafile):
-    basepath = settings.FILE_STORE_PATH
-    experiment_id = str(datafile.dataset.experiment.id)
-    dataset_id = str(datafile.dataset.id)
-    raw_path = datafile.url.partition('//')[2]
-    file_path = os.path.join(basepath,
-                            experiment_id,
-                            dataset_id,
-                            raw_path)
-    spc = open(file_path)
-    offset = 3840
-    channel = 4000 # number of spectral channels
-    format = 'i' # long integer
-    byte_size = 4
-    
-    spc.seek(offset)
-    values_tuple = struct.unpack(format * channel, spc.read(byte_size * channel))
-    
-    return values_tuple
-
-def get_spt_spectra(datafile):
-    basepath = settings.FILE_STORE_PATH
-    experiment_id = str(datafile.dataset.experiment.id)
-    dataset_id = str(datafile.dataset.id)
-    raw_path = datafile.url.partition('//')[2]
-    file_path = os.path.join(basepath,
-                            experiment_id,
-                            dataset_id,
-                            raw_path)
-    spc = open(file_path)
-    offset = 7
-    channel = 2048 # number of spectral channels
-    format = 'i' # long integer
-    byte_size = 4
-    
-    spc.seek(offset)
-    values_tuple = struct.unpack(format * channel, spc.read(byte_size * channel))
-    
-    return values_tuple
-
 def get_spectra_csv(request, datafile_id):
+    # numpy is only loaded once the first spectrum is read
+    from tardis.microtardis.spectra.export import format_csv
+    from tardis.microtardis.spectra.loader import load_spectrum
+
     datafile = Dataset_File.objects.get(pk=datafile_id)
     filename = str(datafile.url).split('/')[-1][:-4].replace(' ', '_')
     extension = str(datafile.url)[-4:]
     response = HttpResponse(mimetype='text/csv')
     response['Content-Disposition'] = 'attachment; filename=%s.csv' % filename
-    writer = csv.writer(response)
-    if extension == '.spc':
-        values = get_spc_spectra(datafile)
-        index = 0
-        for value in values:
-            index += 1
-            row = [index, value]
-            writer.writerow(row)
-    elif extension == '.spt':
-        values = get_spt_spectra(datafile)
-        index = 0
-        for value in values:
-            row = [index*10, value]
-            writer.writerow(row)
-            index += 1
+    if extension in ('.spc', '.spt'):
+        # the energy of each channel in eV, and its counts
+        values, energies = load_spectrum(datafile, extension[1:])
+        response.write(format_csv(values, energies))
+
+    return response
+
+@authz.dataset_access_required
+def export_dataset_spectra(request, dataset_id):
+    """Download all the spectra of a dataset, streamed as they are read.
 
+    The ``format`` GET parameter is 'zip' for a ZIP of CSV files (the
+    default), 'csv' for a CSV with a column per spectrum, or 'npz' for
+    numpy arrays.
+    """
+    from tardis.microtardis.spectra.export import EXPORTERS
+
+    format = request.GET.get('format', 'zip')
+    if format not in EXPORTERS:
+        return HttpResponseBadRequest("format must be zip, csv or npz")
+    exporter, mimetype, extension = EXPORTERS[format]
+    dataset = Dataset.objects.get(pk=dataset_id)
+    datafiles = Dataset_File.objects.filter(dataset=dataset).order_by('filename')
+    response = HttpResponse(exporter(datafiles.iterator()), mimetype=mimetype)
+    response['Content-Disposition'] = 'attachment; filename=dataset_%s_spectra.%s' % (
+                                      dataset.id, extension)
     return response
 
 # this function is obsolete. It's no longer to be used by javascript codes.
 def get_spectra_json(request, datafile_id):
+    from tardis.microtardis.spectra.loader import load_spectrum
+
     datafile = Dataset_File.objects.get(pk=datafile_id)
     filename = str(datafile.url).split('/')[-1][:-4].replace(' ', '_')
-    values = get_spc_spectra(datafile)
-    index = 0
-    data = []
-    for value in values:
-        data.append([index, value])
-        index += 1
+    values, energies = load_spectrum(datafile, 'spc')
+    data = zip(energies.round(6).tolist(), values.tolist())
     content = '{"label": "%s", "data": %s}' % (filename, json.dumps(data))
     response = HttpResponse(content, mimetype='application/json')
     
     return response
 
+@authz.datafile_access_required
+def get_spectrum_data(request, dataset_file_id):
+    """Return the counts of a spectrum for plotting in the browser.
+
+    GET parameters:
+
+    - ``start_kev``, ``end_kev``: the energy range, the whole spectrum by
+      default.
+    - ``points``: the most channels to return, 500 by default; the range
+      is downsampled to them with ``method``, 'minmax' or 'lttb'.
+    - ``format``: 'json' for ``{"label": ..., "kev": [...], "counts":
+      [...]}``, or 'binary' for the energies as little endian float32
+      followed by the counts as little endian int32, with the number of
+      points in the X-Spectrum-Points header.
+    """
+    from tardis.microtardis.spectra.downsample import DOWNSAMPLERS
+    from tardis.microtardis.spectra.downsample import select_range
+    from tardis.microtardis.spectra.loader import get_spectrum_type
+    from tardis.microtardis.spectra.loader import load_spectrum
+
+    datafile = Dataset_File.objects.get(pk=dataset_file_id)
+    datafile_type = get_spectrum_type(datafile)
+    if datafile_type is None:
+        return HttpResponseBadRequest("not a spectrum")
+    try:
+        start_kev = request.GET.get('start_kev')
+        if start_kev is not None:
+            start_kev = float(start_kev)
+        end_kev = request.GET.get('end_kev')
+        if end_kev is not None:
+            end_kev = float(end_kev)
+        points = int(request.GET.get('points', 500))
+    except ValueError:
+        return HttpResponseBadRequest("start_kev, end_kev and points must be numbers")
+    method = request.GET.get('method', 'minmax')
+    format = request.GET.get('format', 'json')
+    if points < 3 or method not in DOWNSAMPLERS or \
+       format not in ('json', 'binary'):
+        return HttpResponseBadRequest("points must be at least 3, method "
+                                      "minmax or lttb and format json or binary")
+
+    values, energies = load_spectrum(datafile, datafile_type)
+    energies, values = select_range(energies, values, start_kev, end_kev)
+    energies, values = DOWNSAMPLERS[method](energies, values, points)
+
+    if format == 'binary':
+        content = energies.astype('<f4').tostring() + values.astype('<i4').tostring()
+        response = HttpResponse(content, mimetype='application/octet-stream')
+        response['X-Spectrum-Points'] = str(len(values))
+        return response
+
+    filename = str(datafile.url).split('/')[-1][:-4]
+    content = json.dumps({'label': filename,
+                          'kev': energies.round(4).tolist(),
+                          'counts': values.tolist(),
+                          }, separators=(',', ':'))
+    return HttpResponse(content, mimetype='application/json')
+
+def is_not_modified(request, etag):
+    """Return True if the client's copy of a response with this ETag is
+    current.
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        return etag in etags or '*' in etags
+    return False
+
 def get_spectra_png(request, size, datafile_id, datafile_type):
-    if is_matplotlib_imported:
-        datafile = Dataset_File.objects.get(pk=datafile_id)
-        if datafile_type == 'spc':
-            values = list( get_spc_spectra(datafile) )
-        elif datafile_type == 'spt':
-            values = list( get_spt_spectra(datafile) )
-        # truncate the values on x axis
-        nonzero_values = numpy.nonzero(values)
-        for i in range(0, len(nonzero_values[0])+1, 1):
-            if values[nonzero_values[0][i]] < 10:
-                continue
-            else:
-                left_end = nonzero_values[0][i]
-                break
-        for i in range(-1, 0-len(nonzero_values[0])+1, -1):
-            if values[nonzero_values[0][i]] < 10:
-                continue
-            else:
-                right_end = nonzero_values[0][i]
-                break
-        values = values[left_end:right_end+1]
-        pyplot.plot([x * 0.01 for x in range(left_end, right_end+1)], values)
-        
-        #pyplot.plot([x * 0.01 for x in range(0, 4000)], values)
-        pyplot.xlabel("keV")
-        pyplot.ylabel("Counts")
-        pyplot.grid(True)
-        
-        # set size
-        ratio = 1.5
-        if size == "small":
-            ratio = 0.75
-        fig = pyplot.gcf()
-        default_size = fig.get_size_inches()
-        fig.set_size_inches(default_size[0] * ratio, default_size[1] * ratio)
-        
-        # label peak values
-        datafileparametersets = DatafileParameterSet.objects.filter(dataset_file__pk=datafile_id)
-        peaks = []
-        label = {}
-        for parameterset in datafileparametersets:
-            # get list of parameters
-            parameters = parameterset.datafileparameter_set.all()
-            for parameter in parameters:
-                if str(parameter.name.full_name).startswith("Peak ID Element"):
-                    peaks.append(parameter.string_value)
-        for peak in peaks:
-            data = str(peak).split(', ')
-            atomic = data[0].split('=')[-1]
-            line = data[1].split('=')[-1]
-            energy = float(data[2].split('=')[-1])
-            height= int(data[3].split('=')[-1])
-            pyplot.annotate('%s%s' % (atomic, line), 
-                            xy=(energy, height), 
-                            xytext=(energy-0.5, height+50),
-                            )
-        
-        # Write PNG image
-        buffer = StringIO.StringIO()
-        canvas = pyplot.get_current_fig_manager().canvas
-        canvas.draw()
-        img = Image.fromstring('RGB', canvas.get_width_height(), canvas.tostring_rgb())
-        img.save(buffer, 'PNG')
-        pyplot.close()
-        # Django's HttpResponse reads the buffer and extracts the image
-        return HttpResponse(buffer.getvalue(), mimetype='image/png')
-    
-    else:
-        buffer = StringIO.StringIO()
-        return HttpResponse(buffer.getvalue(), mimetype='image/png')
+    from tardis.microtardis.spectra import cache
+    from tardis.microtardis.spectra.pool import RenderError
+    from tardis.microtardis.spectra.loader import get_datafile_path
+
+    datafile = Dataset_File.objects.get(pk=datafile_id)
+    filepath = get_datafile_path(datafile)
+    if size != 'small':
+        size = 'full'
+
+    content = None
+    entry = cache.find_png(datafile.id, datafile_type, size, filepath)
+    if entry:
+        path, etag = entry
+        if is_not_modified(request, etag):
+            return HttpResponseNotModified()
+        content = cache.read_png(path)
+
+    if content is None:
+        try:
+            content = render_spectrum_png(datafile, datafile_type, size)
+        except RenderError, e:
+            response = HttpResponse(str(e), mimetype='text/plain', status=503)
+            response['Retry-After'] = '10'
+            return response
+        if not content:
+            return HttpResponse(content, mimetype='image/png')
+        etag = cache.store_png(datafile.id, datafile_type, size, filepath,
+                               content)
+        if is_not_modified(request, etag):
+            return HttpResponseNotModified()
+
+    # browsers revalidate the image with the ETag; the image also changes
+    # with the peaks found when the metadata is re-extracted, so the
+    # spectrum file's modification time can't serve as Last-Modified
+    response = HttpResponse(content, mimetype='image/png')
+    response['ETag'] = quote_etag(etag)
+    return response
+
+def render_spectrum_png(datafile, datafile_type, size):
+    from tardis.microtardis.spectra.loader import load_spectrum
+    from tardis.microtardis.spectra.preview import render_preview_png
+    # matplotlib is only loaded by the render processes
+    from tardis.microtardis.spectra.pool import render
+
+    values, energies = load_spectrum(datafile, datafile_type)
+
+    # label peak values
+    peaks = []
+    datafileparametersets = DatafileParameterSet.objects.filter(dataset_file=datafile)
+    for parameterset in datafileparametersets:
+        # get list of parameters
+        parameters = parameterset.datafileparameter_set.all()
+        for parameter in parameters:
+            if str(parameter.name.full_name).startswith("Peak ID Element"):
+                peaks.append(parameter.string_value)
+
+    # previews are quick enough to draw here
+    if size == 'small':
+        return render_preview_png(values, energies, peaks)
+    return render(values, energies, size, peaks)
     
 def hide_objects(request):
     expid = request.POST['expid']
@@ -935,3 +928,20 @@ def unhide_objects(request):
                 Datafile_Hidden.objects.filter(datafile=datafile.id).update(hidden=False)
                 
     return HttpResponseRedirect(reverse('tardis.tardis_portal.views.view_experiment', args=(expid,)))
+
+@never_cache
+def filter_metrics(request):
+    """Return the post save filter counters and histograms as JSON. Staff
+    only.
+
+    The metrics are those of the web server process which happens to serve
+    the request, not of the whole site: each process counts only the files
+    it filtered itself, and the queue runner's workers are not included.
+    The ``run_filter_queue`` and ``reextract_metadata`` commands print the
+    metrics of their own run with ``--metrics``.
+    """
+    if not request.user.is_staff:
+        return HttpResponseForbidden()
+
+    from tardis.microtardis.filters import metrics
+    return HttpResponse(metrics.to_json(), mimetype='application/json')